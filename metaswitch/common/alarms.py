@@ -26,6 +26,8 @@ import atexit
 from monotonic import monotonic
 import threading
 import imp
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 from alarm_severities import (CLEARED,
                               INDETERMINATE,
                               CRITICAL,
@@ -53,6 +55,32 @@ _sendrequest = None
 # How often to re-sync alarms in seconds.
 RE_SYNC_INTERVAL = 30
 
+# The maximum number of alarms to re-sync at once.
+RE_SYNC_WORKERS = 16
+
+# Alarms for an issuer are only sent to the alarm agent in a single
+# "issue-alarms" request once the agent has listed that request in its reply
+# to a "get-capabilities" request.  Until then, each alarm is sent in its own
+# "issue-alarm" request, as older agents expect.
+CAPABILITIES_REQUEST = "get-capabilities"
+BATCH_REQUEST = "issue-alarms"
+
+# How long to wait before asking the alarm agent for its capabilities again
+# after it didn't list batches, or rejected one.
+BATCH_RETRY_INTERVAL = 600
+
+# How long to wait before asking again, or sending another batch, after the
+# alarm agent didn't reply.  This doubles each time it doesn't reply, up to
+# BATCH_RETRY_INTERVAL.
+NO_REPLY_BACKOFF = 30
+
+# Whether the alarm agent has said that it accepts batches, the time before
+# which neither batches nor capability requests are sent, and the current
+# backoff for when it doesn't reply.
+_batching_confirmed = False
+_batch_retry_at = 0
+_no_reply_backoff = NO_REPLY_BACKOFF
+
 
 class _AlarmManager(threading.Thread):
     """
@@ -62,7 +90,8 @@ class _AlarmManager(threading.Thread):
     handling code.
 
     Keeps a record of all alarms and makes sure they are re-raised
-    every RE_SYNC_INTERVAL seconds.
+    every RE_SYNC_INTERVAL seconds. Also delivers alarm state changes, so
+    that setting or clearing an alarm never blocks the caller.
     """
 
     def __init__(self):
@@ -82,6 +111,11 @@ class _AlarmManager(threading.Thread):
         self._should_terminate = False
         self._running = False
 
+        # Alarms whose state has changed since it was last delivered, and
+        # whether the run loop is currently delivering any.
+        self._pending_alarms = OrderedDict()
+        self._delivering = False
+
     def get_alarm(self, issuer, alarm_handle):
         """Get a control for an alarm.
 
@@ -113,22 +147,32 @@ class _AlarmManager(threading.Thread):
                 severities.remove(CLEARED)
 
                 if len(severities) == 1:
-                    alarm = Alarm(issuer, index, severities[0])
+                    alarm = Alarm(issuer, index, severities[0], self)
                 elif len(severities) > 1:
-                    alarm = MultiSeverityAlarm(issuer, index, severities)
+                    alarm = MultiSeverityAlarm(issuer, index, severities, self)
                 else:
                     raise ValueError('alarm_handle must contain a severity.')
 
                 self._alarm_registry[(issuer, alarm_handle)] = alarm
-                should_start = ((not self._running) and
-                                (not self._should_terminate))
-
-                # Make sure that no other thread tries to start the thread
-                # as threads must only be started once.
-                self._running = True
+                should_start = True
 
         # It would be wasteful to start the alarm re-sync thread with
         # no alarms present.
+        if should_start:
+            self._ensure_running()
+
+        return alarm
+
+    def _ensure_running(self):
+        """Start the run loop if it hasn't already been started."""
+        with self._registry_lock:
+            should_start = ((not self._running) and
+                            (not self._should_terminate))
+
+            # Make sure that no other thread tries to start the thread
+            # as threads must only be started once.
+            self._running = True
+
         if should_start:
             self.start()
 
@@ -137,7 +181,37 @@ class _AlarmManager(threading.Thread):
             # fine for a singleton which is expected to run until exit.
             atexit.register(self.terminate)
 
-        return alarm
+    def update_alarm(self, alarm, state):
+        """Record the desired state of an alarm, to be delivered to the
+        alarm agent by the run loop.
+
+        If the state changes again before it is delivered, only the latest
+        state is delivered, and nothing is delivered if that is the state
+        the alarm agent already has.
+
+        Once the manager is terminating (for example, alarms cleared by
+        shutdown code after the atexit hook has run) the run loop may
+        already have finished, so the state is delivered before this
+        returns."""
+        with self._condition:
+            alarm._last_state_raised = state
+            self._pending_alarms[alarm] = None
+            if self._should_terminate:
+                self._deliver_pending_alarms()
+                return
+            self._condition.notify_all()
+        self._ensure_running()
+
+    def flush(self, timeout=5):
+        """Wait up to timeout seconds for pending alarm states to be
+        delivered."""
+        deadline = monotonic() + timeout
+        with self._condition:
+            while self._pending_alarms or self._delivering:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
 
     def run(self):
         """Run loop to keep alarms in sync."""
@@ -145,31 +219,34 @@ class _AlarmManager(threading.Thread):
             while True:
                 sleep_time = self._update_resync_time()
 
-                # Cope with the fact that we may be woken up early and
-                # have to sleep again.
-                while (sleep_time > 0):
-                    self.loop_done_hook()
-                    self._condition.wait(sleep_time)
-                    if self._should_terminate:
-                        break
-                    sleep_time = self._next_resync_time - monotonic() # pragma: no cover
+                # Deliver alarm state changes as they come in. Cope with the
+                # fact that we may be woken up early and have to sleep again.
+                while sleep_time > 0 and not self._should_terminate:
+                    if self._pending_alarms:
+                        self._deliver_pending_alarms()
+                    else:
+                        self.loop_done_hook()
+                        self._condition.wait(sleep_time)
+                    sleep_time = self._next_resync_time - monotonic()
 
                 if self._should_terminate:
                     break
-                self._re_sync_alarms() # pragma: no cover
+                self._unlocked(self._re_sync_alarms) # pragma: no cover
 
-            # Tell the terminating thread that it's safe to
-            # exit.
+            # Deliver any last changes (such as alarms cleared on shutdown),
+            # then tell the terminating thread that it's safe to exit.
+            if self._pending_alarms:
+                self._deliver_pending_alarms()
             _log.info('Alarm manager shut down.')
             self.loop_done_hook()
-            self._condition.notify()
+            self._condition.notify_all()
 
     def terminate(self):
         """Stop the run loop cleanly."""
         _log.info('Shutting down alarm manager.')
         with self._condition:
             self._should_terminate = True
-            self._condition.notify()
+            self._condition.notify_all()
 
             # Wait for the run loop to finish. It should finish
             # after 2s as this is when an attempt to send a message
@@ -184,21 +261,51 @@ class _AlarmManager(threading.Thread):
         runloop, then test the result."""
         pass
 
-    def _re_sync_alarms(self): # pragma: no cover
+    def _unlocked(self, function, *args):
+        """Call function without holding the run loop's lock, so that alarms
+        can be updated while it sends requests to the alarm agent."""
+        self._condition.release()
+        try:
+            function(*args)
+        finally:
+            self._condition.acquire()
+
+    def _deliver_pending_alarms(self):
+        """Send the alarm agent the latest state of each alarm that has
+        changed. Called with the lock held."""
+        states = []
+        for alarm in self._pending_alarms:
+            state = alarm._last_state_raised
+            if state is not alarm._last_state_sent:
+                alarm._last_state_sent = state
+                states.append(state)
+        self._pending_alarms.clear()
+
+        if states:
+            self._delivering = True
+            try:
+                self._unlocked(self._issue_states, states)
+            finally:
+                self._delivering = False
+        self._condition.notify_all()
+
+    def _issue_states(self, states):
+        """Send alarm states to the alarm agent, batched by issuer if the
+        alarm agent has said it accepts batches, and with an issue-alarm
+        request for each state if not."""
+        _issue_alarms(_group_by_issuer(states))
+
+    def _re_sync_alarms(self):
         """Re-sync each alarm in the registry."""
-        current_alarms = self._alarm_registry.values()
-
-        # Each alarm sync may take up to 2s on failure. This could
-        # easily add up to more than the RE_SYNC_INTERVAL. In this case,
-        # a log will be written by _get_sleep_time. The expected cause
-        # of long request times is that alarm agent is not available;
-        # in this case it makes little difference which alarms we are
-        # failing to re-sync, so there is no need for timeout logic.
-        for alarm in current_alarms:
-            if self._should_terminate: # pragma: no cover
-                # There is no way of ensuring that we hit this condition.
-                break
-            alarm.re_sync()
+        with self._condition:
+            current_states = []
+            for alarm in self._alarm_registry.values():
+                if alarm._last_state_raised is not None:
+                    alarm._last_state_sent = alarm._last_state_raised
+                    current_states.append(alarm._last_state_raised)
+        if current_states:
+            _issue_alarms(_group_by_issuer(current_states),
+                          lambda: self._should_terminate)
 
     def _update_resync_time(self):
         """Calculate how long to sleep before the next re-sync."""
@@ -220,14 +327,22 @@ alarm_manager = _AlarmManager()
 
 
 class BaseAlarm(object):
-    def __init__(self, issuer, index):
+    """Base class for alarms.
+
+    Setting or clearing an alarm returns immediately. The new state is
+    delivered to the alarm agent by manager (by default, alarm_manager)."""
+    def __init__(self, issuer, index, manager=None):
         self._clear_state = AlarmState(issuer, index, CLEARED)
+        self._manager = manager if manager is not None else alarm_manager
+
+        # The state the alarm should be in, and the state last sent to the
+        # alarm agent. These are protected by the manager's lock.
         self._last_state_raised = None
+        self._last_state_sent = None
 
     def clear(self):
         """Send the alarm's cleared state to the alarm agent."""
-        self._last_state_raised = self._clear_state
-        self.re_sync()
+        self._manager.update_alarm(self, self._clear_state)
 
     def re_sync(self):
         """Send or re-send the alarm's state to the alarm agent."""
@@ -240,14 +355,13 @@ class Alarm(BaseAlarm):
 
     The parameter severity should be passed a severity constant from this
     module"""
-    def __init__(self, issuer, index, severity):
-        super(Alarm, self).__init__(issuer, index)
+    def __init__(self, issuer, index, severity, manager=None):
+        super(Alarm, self).__init__(issuer, index, manager)
         self._alarm_state = AlarmState(issuer, index, severity)
 
     def set(self):
         """Send the alarm's raised state to the alarm agent."""
-        self._last_state_raised = self._alarm_state
-        self.re_sync()
+        self._manager.update_alarm(self, self._alarm_state)
 
 
 class MultiSeverityAlarm(BaseAlarm):
@@ -256,8 +370,8 @@ class MultiSeverityAlarm(BaseAlarm):
     The parameter severities should be passed an iterable of severity
     constants from this module.
     """
-    def __init__(self, issuer, index, severities):
-        super(MultiSeverityAlarm, self).__init__(issuer, index)
+    def __init__(self, issuer, index, severities, manager=None):
+        super(MultiSeverityAlarm, self).__init__(issuer, index, manager)
         self._severities = {severity: AlarmState(issuer, index, severity) for
                             severity in severities}
 
@@ -268,13 +382,13 @@ class MultiSeverityAlarm(BaseAlarm):
         module. If this alarm cannot be raised with that severity, a KeyError
         is raised."""
         try:
-            self._last_state_raised = self._severities[severity]
+            state = self._severities[severity]
         except KeyError:
             _log.error('Attempted to raise incorrect alarm state %s',
                        severity)
             raise
 
-        self.re_sync()
+        self._manager.update_alarm(self, state)
 
 
 class AlarmState(object):
@@ -283,18 +397,24 @@ class AlarmState(object):
         self.issuer = issuer
         self.index = index
         self.severity = severity
+        self.identifier = '{}.{}'.format(index, severity)
 
     def issue(self):
         """Tell the alarm agent that this is the current state of the alarm."""
-        identifier = '{}.{}'.format(self.index, self.severity)
-        _issue_alarm(self.issuer, identifier)
+        _issue_alarm(self.issuer, self.identifier)
 
 
-def _issue_alarm(process, identifier):
-    """Attempt to send an alarm to the alarm agent.
+def _group_by_issuer(states):
+    """Returns a dictionary of the identifiers of states, keyed by issuer."""
+    identifiers_by_issuer = {}
+    for state in states:
+        identifiers_by_issuer.setdefault(state.issuer, []).append(state.identifier)
+    return identifiers_by_issuer
 
-    This function will time out after 2s.
-    """
+
+def _get_sendrequest():
+    """Returns the function used to send requests to the alarm agent, or None
+    if it isn't available."""
     # Clearwater nodes all have clearwater-infrastructure installed.
     # It includes a command-line script that can be used to issue an alarm.
     # We import the function used by the script and re-use it.
@@ -312,6 +432,160 @@ def _issue_alarm(process, identifier):
             _log.info("Imported /usr/share/clearwater/bin/alarms.py")
         except ImportError:
             _log.error("Could not import /usr/share/clearwater/bin/alarms.py, alarms will not be sent")
+    return _sendrequest
+
+
+def _issue_alarm(process, identifier):
+    """Attempt to send an alarm to the alarm agent.
+
+    This function will time out after 2s.
+    """
+    sendrequest = _get_sendrequest()
+    if sendrequest:
+        sendrequest(["issue-alarm", process, identifier])
+
+
+def _batching_supported():
+    """Returns whether to send batches of alarms to the alarm agent."""
+    return _batching_confirmed and monotonic() >= _batch_retry_at
+
+
+def _capabilities_check_due():
+    """Returns whether to ask the alarm agent whether it accepts batches."""
+    return not _batching_confirmed and monotonic() >= _batch_retry_at
+
 
-    if _sendrequest:
-        _sendrequest(["issue-alarm", process, identifier])
+def _no_reply():
+    """Back off from batching after the alarm agent didn't reply."""
+    global _batch_retry_at, _no_reply_backoff
+    _batch_retry_at = monotonic() + _no_reply_backoff
+    _no_reply_backoff = min(_no_reply_backoff * 2, BATCH_RETRY_INTERVAL)
+
+
+def _batching_unavailable():
+    """Stop batching, and don't ask about it again for a while."""
+    global _batching_confirmed, _batch_retry_at, _no_reply_backoff
+    _batching_confirmed = False
+    _batch_retry_at = monotonic() + BATCH_RETRY_INTERVAL
+    _no_reply_backoff = NO_REPLY_BACKOFF
+
+
+def _check_capabilities():
+    """Ask the alarm agent whether it accepts batches of alarms.
+
+    This function will time out after 2s.
+    """
+    global _batching_confirmed, _no_reply_backoff
+    sendrequest = _get_sendrequest()
+    if not sendrequest:
+        return
+    reply = sendrequest([CAPABILITIES_REQUEST])
+    if reply is None:
+        _no_reply()
+    elif BATCH_REQUEST in reply.split():
+        _log.info("Alarm agent accepts batches of alarms")
+        _batching_confirmed = True
+        _no_reply_backoff = NO_REPLY_BACKOFF
+    else:
+        _batching_unavailable()
+
+
+def _issue_batch(process, identifiers):
+    """Attempt to send several alarms for an issuer to the alarm agent in a
+    single request. Returns whether the alarm agent accepted them.
+
+    Only call this once the alarm agent has said it accepts batches.  If it
+    rejects one, batching is turned off until it says so again.
+
+    This function will time out after 2s.
+    """
+    global _no_reply_backoff
+    sendrequest = _get_sendrequest()
+    if not sendrequest:
+        return True
+    reply = sendrequest([BATCH_REQUEST, process] + list(identifiers))
+    if reply == "ok":
+        _no_reply_backoff = NO_REPLY_BACKOFF
+        return True
+    if reply is None:
+        _no_reply()
+    else:
+        _log.info("Alarm agent rejected a batch of alarms, "
+                  "sending alarms individually")
+        _batching_unavailable()
+    return False
+
+
+def _in_pool(function, items):
+    """Call function on each of items, up to RE_SYNC_WORKERS at once.
+
+    Each alarm request may take up to 2s on failure, which would easily add
+    up to more than the RE_SYNC_INTERVAL if they were sent one at a time.
+    Each request uses its own socket, so they can safely be sent in
+    parallel."""
+    if len(items) == 1:
+        function(items[0])
+    elif items:
+        pool = ThreadPool(min(RE_SYNC_WORKERS, len(items)))
+        try:
+            pool.map(function, items)
+        finally:
+            pool.close()
+            pool.join()
+
+
+def _issue_alarms(identifiers_by_issuer, should_stop=lambda: False):
+    """Attempt to send alarms to the alarm agent, given a dictionary of
+    alarm identifiers keyed by issuer.
+
+    The alarms for each issuer are sent in a single request if the alarm
+    agent has said that it accepts batches, and one at a time if not (or if
+    it doesn't accept the batch).  If there are several alarms for an issuer
+    and the agent hasn't said, it is asked alongside the single requests.
+    Requests are sent in parallel, so this takes little more than two
+    timeouts even when the alarm agent is not available. Sending stops
+    early if should_stop returns True.
+    """
+    batching = _batching_supported()
+    batches = []
+    singles = []
+    for issuer, identifiers in identifiers_by_issuer.items():
+        if batching and len(identifiers) > 1:
+            batches.append((issuer, identifiers))
+        else:
+            singles.extend((issuer, identifier) for identifier in identifiers)
+
+    if (not batching and
+            any(len(identifiers) > 1
+                for identifiers in identifiers_by_issuer.values()) and
+            _capabilities_check_due()):
+        # None stands for the capabilities request.
+        singles.append(None)
+
+    def send_batch(batch):
+        if should_stop(): # pragma: no cover
+            return
+        issuer, identifiers = batch
+        try:
+            accepted = _issue_batch(issuer, identifiers)
+        except Exception:
+            _log.exception('Failed to issue alarms')
+            accepted = False
+        if not accepted:
+            singles.extend((issuer, identifier) for identifier in identifiers)
+
+    def send_single(single):
+        if should_stop(): # pragma: no cover
+            return
+        try:
+            if single is None:
+                _check_capabilities()
+            else:
+                _issue_alarm(*single)
+        except Exception:
+            _log.exception('Failed to issue alarm')
+            if single is None:
+                _no_reply()
+
+    _in_pool(send_batch, batches)
+    _in_pool(send_single, singles)
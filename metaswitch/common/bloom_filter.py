@@ -0,0 +1,102 @@
+# @file bloom_filter.py
+#
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+import hashlib
+import math
+import struct
+
+# File header: magic, format version, number of bits, number of hash
+# functions and number of items added.
+_FILE_MAGIC = "CWBF"
+_FILE_VERSION = 1
+_FILE_HEADER = struct.Struct("!4sBQBQ")
+
+
+class BloomFilter(object):
+    """Compact probabilistic set of strings.
+
+    Membership tests may return false positives, at no more than the
+    error_rate given on construction provided no more than capacity items
+    are added, but never false negatives.  The filter is backed by a single
+    bytearray, so it can be saved to and loaded from disk cheaply."""
+
+    def __init__(self, capacity, error_rate=0.001):
+        """Constructor.
+
+        Arguments:
+        capacity -- the number of items the filter is sized for.
+        error_rate -- the false positive rate to allow once capacity items
+        have been added.
+        """
+        num_bits = int(math.ceil(-capacity * math.log(error_rate) /
+                                 (math.log(2) ** 2)))
+        num_hashes = int(round(float(num_bits) / capacity * math.log(2)))
+        self._init(num_bits, max(1, num_hashes))
+
+    def _init(self, num_bits, num_hashes, bits=None, count=0):
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.count = count
+        self._bits = bits if bits is not None else bytearray((num_bits + 7) // 8)
+
+    def _positions(self, item):
+        """Returns the bit positions for an item, using double hashing on
+        the two halves of a single digest."""
+        if isinstance(item, unicode):
+            item = item.encode("utf-8")
+        # This isn't used for security, just to spread items over the bits.
+        digest = hashlib.md5(item).digest() # nosec
+        h1, h2 = struct.unpack("<QQ", digest)
+        num_bits = self.num_bits
+        return [(h1 + i * h2) % num_bits for i in xrange(self.num_hashes)]
+
+    def add(self, item):
+        """Adds an item to the filter."""
+        bits = self._bits
+        for position in self._positions(item):
+            bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        bits = self._bits
+        for position in self._positions(item):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def save(self, filename):
+        """Writes the filter to the named file."""
+        with open(filename, "wb") as f:
+            f.write(_FILE_HEADER.pack(_FILE_MAGIC,
+                                      _FILE_VERSION,
+                                      self.num_bits,
+                                      self.num_hashes,
+                                      self.count))
+            f.write(self._bits)
+
+    @classmethod
+    def load(cls, filename):
+        """Reads a filter previously written by save from the named file.
+
+        Raises ValueError if the file doesn't contain a valid filter."""
+        with open(filename, "rb") as f:
+            header = f.read(_FILE_HEADER.size)
+            bits = bytearray(f.read())
+
+        if len(header) != _FILE_HEADER.size:
+            raise ValueError("Bloom filter file %s is truncated" % filename)
+        magic, version, num_bits, num_hashes, count = _FILE_HEADER.unpack(header)
+        if magic != _FILE_MAGIC or version != _FILE_VERSION:
+            raise ValueError("%s is not a bloom filter file" % filename)
+        if len(bits) != (num_bits + 7) // 8:
+            raise ValueError("Bloom filter file %s is truncated" % filename)
+
+        bloom_filter = cls.__new__(cls)
+        bloom_filter._init(num_bits, num_hashes, bits, count)
+        return bloom_filter
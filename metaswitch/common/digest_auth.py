@@ -0,0 +1,176 @@
+# @file digest_auth.py
+#
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+"""
+SIP/HTTP digest authentication (RFC 2617 and RFC 7616).
+
+Provides functions to calculate HA1, HA2 and the digest response, and a
+DigestAuthenticator that verifies responses while caching the HA1 for each
+user.
+"""
+
+import hashlib
+import hmac
+import logging
+from metaswitch.common.lru_cache import LRUCache
+from metaswitch.common.utils import md5, map_in_chunks, DEFAULT_PARALLEL_THRESHOLD
+
+_log = logging.getLogger(__name__)
+
+MD5 = "MD5"
+MD5_SESS = "MD5-sess"
+SHA256 = "SHA-256"
+SHA256_SESS = "SHA-256-sess"
+
+QOP_AUTH = "auth"
+QOP_AUTH_INT = "auth-int"
+
+DEFAULT_CACHE_SIZE = 10000
+
+
+def _sha256(s):
+    return hashlib.sha256(s).hexdigest()
+
+_HASH_FUNCTIONS = {"md5": md5, "sha-256": _sha256}
+
+
+def _base_algorithm(algorithm):
+    """Returns the lower-case name of an algorithm without any -sess suffix.
+    Raises ValueError for unsupported algorithms."""
+    name = algorithm.lower()
+    if name.endswith("-sess"):
+        name = name[:-5]
+    if name not in _HASH_FUNCTIONS:
+        raise ValueError("Unsupported digest algorithm %s" % algorithm)
+    return name
+
+
+def _hash_function(algorithm):
+    return _HASH_FUNCTIONS[_base_algorithm(algorithm)]
+
+
+def _to_bytes(s):
+    return s.encode("utf-8") if isinstance(s, unicode) else s
+
+
+def calculate_ha1(username, realm, password, algorithm=MD5):
+    """Calculates H(username:realm:password)."""
+    h = _hash_function(algorithm)
+    return h(_to_bytes("%s:%s:%s" % (username, realm, password)))
+
+
+def calculate_ha2(method, uri, qop=None, body="", algorithm=MD5):
+    """Calculates H(method:uri), or H(method:uri:H(body)) for auth-int."""
+    h = _hash_function(algorithm)
+    if qop == QOP_AUTH_INT:
+        return h(_to_bytes("%s:%s:%s" % (method, uri, h(_to_bytes(body)))))
+    return h(_to_bytes("%s:%s" % (method, uri)))
+
+
+def calculate_response(ha1, nonce, method, uri,
+                       qop=None, nc=None, cnonce=None, body="", algorithm=MD5):
+    """Calculates the digest response from a (non-session) HA1."""
+    h = _hash_function(algorithm)
+    if algorithm.lower().endswith("-sess"):
+        ha1 = h(_to_bytes("%s:%s:%s" % (ha1, nonce, cnonce)))
+    ha2 = calculate_ha2(method, uri, qop, body, algorithm)
+    if qop:
+        return h(_to_bytes("%s:%s:%s:%s:%s:%s" % (ha1, nonce, nc, cnonce, qop, ha2)))
+    return h(_to_bytes("%s:%s:%s" % (ha1, nonce, ha2)))
+
+
+def verify_response(response, ha1, nonce, method, uri,
+                    qop=None, nc=None, cnonce=None, body="", algorithm=MD5):
+    """Checks a digest response against a (non-session) HA1, in constant
+    time."""
+    expected = calculate_response(ha1, nonce, method, uri,
+                                  qop, nc, cnonce, body, algorithm)
+    return hmac.compare_digest(expected, _to_bytes(response).lower())
+
+
+def _calculate_ha1_chunk(args):
+    """Calculates a chunk of HA1s in a pool worker.  This is module-level so
+    that it can be pickled."""
+    algorithm, credentials = args
+    return [calculate_ha1(username, realm, password, algorithm)
+            for username, realm, password in credentials]
+
+
+def calculate_ha1s(credentials,
+                   algorithm=MD5,
+                   processes=None,
+                   parallel_threshold=DEFAULT_PARALLEL_THRESHOLD):
+    """Calculates the HA1 for each of a list of (username, realm, password)
+    tuples, e.g. for bulk provisioning, returning a list in the same order.
+
+    If there are more than parallel_threshold credentials they are shared
+    out over a pool of processes (by default, one per CPU)."""
+    return map_in_chunks(_calculate_ha1_chunk,
+                         algorithm,
+                         credentials,
+                         processes,
+                         parallel_threshold)
+
+
+class DigestAuthenticator(object):
+    """Verifies digest responses, caching the HA1 for each user and realm so
+    it only needs to be fetched once rather than for every challenge."""
+
+    def __init__(self, get_ha1, cache_size=DEFAULT_CACHE_SIZE):
+        """Constructor.
+
+        Arguments:
+        get_ha1 -- function taking (username, realm, algorithm) that returns
+        the stored HA1 for the user, or None if the user doesn't exist.
+        cache_size -- the number of HA1s to keep.
+        """
+        self._get_ha1 = get_ha1
+        self._cache = LRUCache(cache_size)
+
+    @property
+    def hits(self):
+        return self._cache.hits
+
+    @property
+    def misses(self):
+        return self._cache.misses
+
+    def ha1(self, username, realm, algorithm=MD5):
+        """Returns the HA1 for a user, from the cache if possible."""
+        key = (username, realm, _base_algorithm(algorithm))
+        ha1 = self._cache.get(key)
+        if ha1 is None:
+            ha1 = self._get_ha1(username, realm, algorithm)
+            if ha1 is not None:
+                self._cache.put(key, ha1)
+        return ha1
+
+    def prime(self, entries, algorithm=MD5):
+        """Adds HA1s to the cache from an iterable of (username, realm, ha1)
+        tuples, e.g. the output of calculate_ha1s."""
+        base_algorithm = _base_algorithm(algorithm)
+        for username, realm, ha1 in entries:
+            self._cache.put((username, realm, base_algorithm), ha1)
+
+    def invalidate(self, username, realm):
+        """Forgets any cached HA1s for a user, e.g. when their password
+        changes."""
+        for base_algorithm in _HASH_FUNCTIONS:
+            self._cache.pop((username, realm, base_algorithm))
+
+    def verify(self, username, realm, nonce, method, uri, response,
+               qop=None, nc=None, cnonce=None, body="", algorithm=MD5):
+        """Checks a digest response.  Returns False if the user doesn't
+        exist."""
+        ha1 = self.ha1(username, realm, algorithm)
+        if ha1 is None:
+            _log.debug("No HA1 for %s in realm %s", username, realm)
+            return False
+        return verify_response(response, ha1, nonce, method, uri,
+                               qop, nc, cnonce, body, algorithm)
@@ -0,0 +1,248 @@
+# @file log_compressor.py
+#
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+import gzip
+import logging
+import os
+import re
+import threading
+import time
+from fcntl import flock, LOCK_EX, LOCK_NB
+
+try:
+    import zstandard
+except ImportError: #pragma: no cover
+    zstandard = None
+
+_log = logging.getLogger(__name__)
+
+# Supported compression methods, and the suffix each adds to a log file.
+GZIP = "gzip"
+ZSTD = "zstd"
+_SUFFIXES = {GZIP: ".gz", ZSTD: ".zst"}
+
+# By default, look for work every five minutes (as well as on rollover).
+DEFAULT_CHECK_INTERVAL = 300
+
+# Don't compress files that have been written to in the last minute, to give
+# other processes sharing the file time to roll over to the next one.
+DEFAULT_SETTLE_TIME = 60
+
+# How long stop() waits for the background thread to abandon its work.
+STOP_TIMEOUT = 5
+
+# Size of the chunks files are read and compressed in.
+_CHUNK_SIZE = 64 * 1024
+
+
+class LogCompressor(object):
+    """Compresses closed hourly log files and enforces a disk budget for them.
+
+    Work is done on a background thread, which wakes up every check_interval
+    seconds or when notify() is called (ClearwaterLogHandler does this when
+    it moves on to a new file).  Each time it wakes it:
+    - compresses any files for earlier hours that haven't been written to
+      in the last settle_time seconds, if method is set
+    - deletes any partially compressed files left by a compressor that was
+      stopped or killed part way through
+    - deletes the oldest files until the files for this prefix take up no
+      more than max_total_bytes of disk space, if that is set.  This
+      includes any space preallocated beyond the end of a file (see
+      ClearwaterLogHandler), so it is measured in allocated blocks.
+
+    max_bytes_per_second limits how fast files are read for compression, so
+    that the compressor doesn't compete with the service for disk I/O.
+
+    Several processes may share a prefix (see ClearwaterLogHandler's shared
+    option), so each pass holds an exclusive lock on a lock file for the
+    prefix, and is skipped if another process's compressor holds it."""
+
+    def __init__(self,
+                 log_directory,
+                 logfile_prefix,
+                 method=GZIP,
+                 max_total_bytes=None,
+                 max_bytes_per_second=None,
+                 check_interval=DEFAULT_CHECK_INTERVAL,
+                 settle_time=DEFAULT_SETTLE_TIME):
+        if method is not None and method not in _SUFFIXES:
+            raise ValueError("Unknown compression method: {}".format(method))
+        if method == ZSTD and zstandard is None:
+            raise ValueError("zstd compression requires the zstandard module")
+
+        self._log_directory = log_directory
+        self._method = method
+        self._max_total_bytes = max_total_bytes
+        self._max_bytes_per_second = max_bytes_per_second
+        self._check_interval = check_interval
+        self._settle_time = settle_time
+        self._lock_filename = os.path.join(
+            log_directory, ".{}.compress.lock".format(logfile_prefix))
+        self._file_pattern = re.compile(
+            r"^{}_\d{{8}}T\d{{2}}0000Z\.txt(\.gz|\.zst)?(\.\d+\.tmp)?$".format(
+                re.escape(logfile_prefix)))
+
+        self._wakeup = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="LogCompressor")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops the background thread.  A file being compressed is left
+        uncompressed."""
+        self._stop_event.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join(STOP_TIMEOUT)
+            self._thread = None
+
+    def notify(self):
+        """Asks the background thread to look for work now."""
+        self._wakeup.set()
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            self._wakeup.wait(self._check_interval)
+            self._wakeup.clear()
+            if self._stop_event.is_set():
+                break
+            try:
+                self.run_once()
+            except Exception:
+                _log.exception("Failed to compress or clean up log files")
+
+    def run_once(self, now=None):
+        """Compresses and deletes files as described above.  This is normally
+        called on the background thread."""
+        now = time.time() if now is None else now
+        current = time.strftime("_%Y%m%dT%H0000Z.txt", time.gmtime(now))
+
+        with open(self._lock_filename, "a") as lockfile:
+            try:
+                flock(lockfile, LOCK_EX | LOCK_NB)
+            except IOError:
+                _log.debug("Log files for %s are being compressed by another "
+                           "process", self._lock_filename)
+                return
+            self._run_locked(now, current)
+
+    def _run_locked(self, now, current):
+        # Any temporary files are left over from an earlier pass, as we hold
+        # the lock.
+        for filename in self._log_files():
+            if filename.endswith(".tmp"):
+                _log.info("Deleting partially compressed file %s", filename)
+                self._unlink(filename)
+
+        if self._method:
+            for filename in self._log_files():
+                if (filename.endswith(".txt") and
+                        not filename.endswith(current) and
+                        os.path.getmtime(filename) <= now - self._settle_time):
+                    self._compress(filename)
+                if self._stop_event.is_set():
+                    return
+
+        if self._max_total_bytes is not None:
+            self._enforce_budget(current)
+
+    def _log_files(self):
+        """Returns the paths of this prefix's log files, oldest first.
+
+        The timestamp in the filename sorts correctly as a string, and a
+        compressed file sorts after the file it was compressed from."""
+        try:
+            names = os.listdir(self._log_directory)
+        except OSError:
+            return []
+        return [os.path.join(self._log_directory, name)
+                for name in sorted(names)
+                if self._file_pattern.match(name)]
+
+    def _compress(self, filename):
+        """Compresses a file, then deletes the original.  The compressed file
+        is written under a temporary name first so that a partially
+        compressed file is never mistaken for a complete one."""
+        target = filename + _SUFFIXES[self._method]
+        tmp_target = "{}.{}.tmp".format(target, os.getpid())
+
+        try:
+            with open(filename, "rb") as source:
+                if self._method == GZIP:
+                    output = gzip.open(tmp_target, "wb")
+                else:
+                    compressor = zstandard.ZstdCompressor()
+                    output = compressor.stream_writer(open(tmp_target, "wb"))
+                try:
+                    completed = self._copy(source, output)
+                finally:
+                    output.close()
+        except Exception:
+            self._unlink(tmp_target)
+            raise
+
+        if not completed:
+            # We're stopping.
+            self._unlink(tmp_target)
+            return
+
+        os.rename(tmp_target, target)
+        os.unlink(filename)
+
+    def _copy(self, source, output):
+        """Copies source to output, no faster than max_bytes_per_second.
+        Returns False if it gave up because the compressor is stopping."""
+        start = time.time()
+        copied = 0
+        while True:
+            if self._stop_event.is_set():
+                return False
+            chunk = source.read(_CHUNK_SIZE)
+            if not chunk:
+                return True
+            output.write(chunk)
+            copied += len(chunk)
+            if self._max_bytes_per_second:
+                delay = (start + float(copied) / self._max_bytes_per_second -
+                         time.time())
+                if delay > 0 and self._stop_event.wait(delay):
+                    return False
+
+    def _enforce_budget(self, current):
+        """Deletes the oldest files until the disk space they use is within
+        budget.  The file currently being written to is counted, but never
+        deleted."""
+        sizes = []
+        for filename in self._log_files():
+            try:
+                sizes.append((filename, os.stat(filename).st_blocks * 512))
+            except OSError: #pragma: no cover
+                pass
+
+        total = sum(size for _, size in sizes)
+        for filename, size in sizes:
+            if total <= self._max_total_bytes:
+                break
+            if filename.endswith(current):
+                continue
+            if self._unlink(filename):
+                total -= size
+
+    @staticmethod
+    def _unlink(filename):
+        """Deletes a file, returning whether it was deleted."""
+        try:
+            os.unlink(filename)
+            return True
+        except OSError: #pragma: no cover
+            return False
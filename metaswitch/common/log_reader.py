@@ -0,0 +1,265 @@
+# @file log_reader.py
+#
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+"""Reads the hourly log files written by logging_config.ClearwaterLogHandler.
+
+Files are memory-mapped and searched by time using a sparse index of record
+timestamps, so a query for a few minutes of logs only reads those minutes of
+the file.  Files the log compressor has got to are first decompressed, a
+chunk at a time, into a temporary file, which is mapped in the same way.
+Reading zstd-compressed files requires the zstandard module."""
+
+import bisect
+import calendar
+import gzip
+import heapq
+import logging
+import mmap
+import os
+import re
+import shutil
+import tempfile
+from collections import namedtuple
+
+try:
+    import zstandard
+except ImportError: #pragma: no cover
+    zstandard = None
+
+from metaswitch.common.lru_cache import LRUCache
+
+# A log record: when it was logged (in seconds since the epoch), its level
+# name, its full text (including any continuation lines, such as a
+# traceback) and the file it came from.
+LogEntry = namedtuple("LogEntry", "timestamp level text filename")
+
+# By default, index the first record after every 64KB of each file.
+DEFAULT_INDEX_INTERVAL = 64 * 1024
+
+# The start of a record, for each of the output formats configure_logging
+# supports.
+_TEXT_RECORD_START = re.compile(
+    r"(\d\d)-(\d\d)-(\d{4}) (\d\d):(\d\d):(\d\d)\.(\d{3}) UTC (\w+) ")
+_JSON_RECORD_START = re.compile(
+    r'\{.*?"timestamp":"(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)\.(\d{3})Z"')
+_JSON_LEVEL = re.compile(r'"level":"(\w+)"')
+
+_LOG_FILE_PATTERN = r"^{}_(\d{{4}})(\d\d)(\d\d)T(\d\d)0000Z\.txt(\.gz|\.zst)?$"
+
+# Size of the chunks compressed files are decompressed in.
+_DECOMPRESS_CHUNK_SIZE = 1024 * 1024
+
+# Indexes of the files read recently, keyed by filename, size and
+# modification time so that an index is rebuilt when its file changes.
+_index_cache = LRUCache(1000)
+
+
+def _level_number(level):
+    number = logging.getLevelName(level)
+    return number if isinstance(number, int) else 0
+
+
+def _parse_record_start(buf, pos):
+    """Returns the timestamp and level of the record starting at pos, or None
+    if pos isn't the start of a record."""
+    match = _TEXT_RECORD_START.match(buf, pos)
+    if match:
+        day, month, year, hour, minute, second, msecs, level = match.groups()
+    else:
+        match = _JSON_RECORD_START.match(buf, pos)
+        if not match:
+            return None
+        year, month, day, hour, minute, second, msecs = match.groups()
+        line_end = buf.find("\n", pos)
+        level_match = _JSON_LEVEL.search(buf[pos:line_end if line_end >= 0 else len(buf)])
+        level = level_match.group(1) if level_match else ""
+
+    timestamp = calendar.timegm((int(year), int(month), int(day),
+                                 int(hour), int(minute), int(second)))
+    return timestamp + int(msecs) / 1000.0, level
+
+
+def _iter_records(buf, pos):
+    """Yields the timestamp, level, start and end offset of each record from
+    pos onwards.  A record runs until the next line that starts a record.
+    Lines before the first record start are skipped."""
+    size = len(buf)
+    current = None
+    current_end = pos
+    while pos < size:
+        line_end = buf.find("\n", pos)
+        if line_end < 0:
+            line_end = size
+        start = _parse_record_start(buf, pos)
+        if start:
+            if current:
+                yield current + (current_end,)
+            current = start + (pos,)
+        current_end = line_end
+        pos = line_end + 1
+    if current:
+        yield current + (current_end,)
+
+
+def _build_index(buf, interval):
+    """Returns the timestamps and offsets of the first record after each
+    interval bytes of buf.  Only the pages around each of those points are
+    read."""
+    timestamps = []
+    offsets = []
+    size = len(buf)
+    point = 0
+    while point < size:
+        # Start from the beginning of a line.
+        if point > 0:
+            point = buf.find("\n", point - 1) + 1
+            if point == 0:
+                break
+        for timestamp, _, start, end in _iter_records(buf, point):
+            if not offsets or start > offsets[-1]:
+                timestamps.append(timestamp)
+                offsets.append(start)
+            point = max(end + 1, point + interval)
+            break
+        else:
+            break
+    return timestamps, offsets
+
+
+def _decompress(filename):
+    """Decompresses a gzip- or zstd-compressed file into an anonymous
+    temporary file, and returns it."""
+    if filename.endswith(".zst") and zstandard is None:
+        raise ValueError("Reading {} requires the zstandard module".format(filename))
+
+    raw = open(filename, "rb")
+    output = tempfile.TemporaryFile()
+    try:
+        if filename.endswith(".zst"):
+            source = zstandard.ZstdDecompressor().stream_reader(raw)
+        else:
+            source = gzip.GzipFile(fileobj=raw, mode="rb")
+        shutil.copyfileobj(source, output, _DECOMPRESS_CHUNK_SIZE)
+        output.flush()
+    except:
+        output.close()
+        raise
+    finally:
+        raw.close()
+    return output
+
+
+class LogFile(object):
+    """A single hourly log file, compressed or not."""
+
+    def __init__(self, filename, index_interval=DEFAULT_INDEX_INTERVAL):
+        self.filename = filename
+        self._index_interval = index_interval
+        stat = os.stat(filename)
+        self._cache_key = (filename, stat.st_size, stat.st_mtime, index_interval)
+
+        if filename.endswith((".gz", ".zst")):
+            f = _decompress(filename)
+        else:
+            f = open(filename, "rb")
+        with f:
+            if os.fstat(f.fileno()).st_size == 0:
+                # Empty files can't be mapped.
+                self._buf = ""
+            else:
+                self._buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        if isinstance(self._buf, mmap.mmap):
+            self._buf.close()
+        self._buf = ""
+
+    def index(self):
+        """Returns the timestamps and offsets of the file's sparse index."""
+        index = _index_cache.get(self._cache_key)
+        if index is None:
+            index = _build_index(self._buf, self._index_interval)
+            _index_cache.put(self._cache_key, index)
+        return index
+
+    def records(self, start=None, end=None, min_level=None):
+        """Yields the records logged between start and end (inclusive, in
+        seconds since the epoch) at min_level or above (a number or level
+        name), as LogEntry tuples in file order."""
+        buf = self._buf
+        pos = 0
+        if start is not None:
+            # Start from the last index point before start.
+            timestamps, offsets = self.index()
+            point = bisect.bisect_left(timestamps, start) - 1
+            if point >= 0:
+                pos = offsets[point]
+
+        if isinstance(min_level, basestring):
+            min_level = _level_number(min_level)
+
+        for timestamp, level, record_start, record_end in _iter_records(buf, pos):
+            if start is not None and timestamp < start:
+                continue
+            if end is not None and timestamp > end:
+                break
+            if min_level and _level_number(level) < min_level:
+                continue
+            yield LogEntry(timestamp, level, buf[record_start:record_end], self.filename)
+
+
+def find_log_files(log_directory, prefix, start=None, end=None):
+    """Returns the log files for prefix that may contain records logged
+    between start and end, oldest first.  If an hour has both a compressed
+    and an uncompressed file (while it is being compressed), only the
+    uncompressed one is returned."""
+    pattern = re.compile(_LOG_FILE_PATTERN.format(re.escape(prefix)))
+    files = []
+    last_hour = None
+    for name in sorted(os.listdir(log_directory)):
+        match = pattern.match(name)
+        if not match:
+            continue
+        hour = calendar.timegm(tuple(int(part) for part in match.groups()[:4]) +
+                               (0, 0))
+        if hour == last_hour:
+            continue
+        last_hour = hour
+        if start is not None and hour + 3600 <= start:
+            continue
+        if end is not None and hour > end:
+            continue
+        files.append(os.path.join(log_directory, name))
+    return files
+
+
+def _iter_prefix(log_directory, prefix, start, end, min_level, index_interval):
+    for filename in find_log_files(log_directory, prefix, start, end):
+        log_file = LogFile(filename, index_interval)
+        try:
+            for entry in log_file.records(start, end, min_level):
+                yield entry
+        finally:
+            log_file.close()
+
+
+def iter_log_records(log_directory,
+                     prefixes,
+                     start=None,
+                     end=None,
+                     min_level=None,
+                     index_interval=DEFAULT_INDEX_INTERVAL):
+    """Yields the records logged between start and end at min_level or above
+    (see LogFile.records) in the files for each of prefixes (including any
+    task ID suffix), as LogEntry tuples merged into timestamp order."""
+    if isinstance(prefixes, basestring):
+        prefixes = [prefixes]
+    return heapq.merge(*[_iter_prefix(log_directory, prefix, start, end,
+                                      min_level, index_interval)
+                         for prefix in prefixes])
@@ -9,18 +9,105 @@
 
 import time
 import os, sys, traceback
+import ctypes
+import ctypes.util
+import errno
+import json
+import mmap
+import select
+import socket
+import signal
+import struct
+import threading
+from collections import deque
 from datetime import datetime
 import logging
 from logging.handlers import BaseRotatingHandler, SysLogHandler
+from metaswitch.common.log_compressor import LogCompressor
+from metaswitch.common.throttler import Throttler
+from metaswitch.common.utils import write_core_file
+
+class ClearwaterFormatter(logging.Formatter):
+    """Formatter that only formats the time once per second.
+
+    Our time formats have second resolution (the milliseconds are added
+    separately), so the result of formatTime only changes once a second but
+    logging.Formatter calls strftime for every record."""
+
+    def __init__(self, fmt=None, datefmt=None):
+        logging.Formatter.__init__(self, fmt, datefmt)
+        # The second, converter and date format that _cached_time was
+        # formatted for.  These are kept in a single tuple so that threads
+        # can update and read them without locking.
+        self._cached_time = (None, None, None, None)
+
+    def formatTime(self, record, datefmt=None):
+        if datefmt is None:
+            # The default format includes the milliseconds.
+            return logging.Formatter.formatTime(self, record, datefmt)
+
+        second = int(record.created)
+        cached_second, converter, cached_datefmt, formatted_time = self._cached_time
+        if (second != cached_second or
+                converter is not self.converter or
+                datefmt != cached_datefmt):
+            formatted_time = logging.Formatter.formatTime(self, record, datefmt)
+            self._cached_time = (second, self.converter, datefmt, formatted_time)
+        return formatted_time
 
 # Make the same log formatters available to test code, event though
 # it doesn't want to use the full logging config.
-THREAD_FORMAT = logging.Formatter('%(asctime)s.%(msecs)03d UTC %(levelname)s %(filename)s:%(lineno)d (thread %(threadName)s): %(message)s', "%d-%m-%Y %H:%M:%S")
-NO_THREAD_FORMAT = logging.Formatter('%(asctime)s.%(msecs)03d UTC %(levelname)s %(filename)s:%(lineno)d: %(message)s', "%d-%m-%Y %H:%M:%S")
+THREAD_FORMAT = ClearwaterFormatter('%(asctime)s.%(msecs)03d UTC %(levelname)s %(filename)s:%(lineno)d (thread %(threadName)s): %(message)s', "%d-%m-%Y %H:%M:%S")
+NO_THREAD_FORMAT = ClearwaterFormatter('%(asctime)s.%(msecs)03d UTC %(levelname)s %(filename)s:%(lineno)d: %(message)s', "%d-%m-%Y %H:%M:%S")
 
 # We insert a tag into this string before turning it into a formatter.
 NO_TIME_FORMAT_STRING = '{tag}: %(levelname)s %(filename)s:%(lineno)d: %(message)s'
 
+# Output formats for configure_logging and configure_syslog.
+OUTPUT_TEXT = "text"
+OUTPUT_JSON = "json"
+
+# The attributes every LogRecord has, which JsonFormatter doesn't treat as
+# extra fields.
+_STANDARD_RECORD_ATTRIBUTES = frozenset(
+    logging.LogRecord("", 0, "", 0, "", None, None).__dict__.keys() +
+    ["message", "asctime"])
+
+# Encoder for JSON log lines, created once rather than for every record.
+# Values it doesn't know how to serialize are logged as their repr.
+_JSON_ENCODER = json.JSONEncoder(separators=(",", ":"), default=repr)
+
+
+class JsonFormatter(ClearwaterFormatter):
+    """Formatter writing each record as a JSON object, with the fields
+    timestamp, level, file, line, thread, message and any extra fields
+    passed to the logging call, plus exception if there is one.
+
+    If tag is given, it is written before the JSON object (followed by a
+    colon), for syslog to pick out."""
+
+    def __init__(self, tag=None):
+        ClearwaterFormatter.__init__(self, datefmt="%Y-%m-%dT%H:%M:%S")
+        self._prefix = "{}: ".format(tag) if tag else ""
+
+    def format(self, record):
+        record.message = record.getMessage()
+        fields = {"timestamp": "%s.%03dZ" % (self.formatTime(record, self.datefmt),
+                                             record.msecs),
+                  "level": record.levelname,
+                  "file": record.filename,
+                  "line": record.lineno,
+                  "thread": record.threadName,
+                  "message": record.message}
+        for name in record.__dict__.viewkeys() - _STANDARD_RECORD_ATTRIBUTES:
+            if name[0] != "_":
+                fields.setdefault(name, record.__dict__[name])
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            fields["exception"] = record.exc_text
+        return self._prefix + _JSON_ENCODER.encode(fields)
+
 
 def getCurrentFilename(currentTime, log_dir, prefix):
     filename = "{prefix}_{year}{month:02}{day:02}T{hour:02}0000Z.txt".format(prefix=prefix,
@@ -30,18 +117,104 @@ def getCurrentFilename(currentTime, log_dir, prefix):
                                                                              hour=currentTime.hour)
     return os.path.join(log_dir, filename)
 
+# Defaults for the buffered-write mode of ClearwaterLogHandler.
+DEFAULT_FLUSH_BYTES = 64 * 1024
+DEFAULT_FLUSH_INTERVAL = 0.2
+DEFAULT_FLUSH_LEVEL = logging.ERROR
+
+# fallocate mode flag to allocate space without changing the file size.
+FALLOC_FL_KEEP_SIZE = 1
+
+# libc's fallocate, once we've looked for it.  False if it isn't available.
+_fallocate = None
+
+
+def _preallocate(fd, length):
+    """Reserves disk space for the first length bytes of a file without
+    changing its size, so that appending to it doesn't have to allocate
+    blocks (and update the file's metadata) as it goes.
+
+    This is only an optimization, so failures are ignored."""
+    global _fallocate
+    if _fallocate is None:
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            _fallocate = libc.fallocate
+            _fallocate.argtypes = [ctypes.c_int,
+                                   ctypes.c_int,
+                                   ctypes.c_longlong,
+                                   ctypes.c_longlong]
+        except (OSError, AttributeError): #pragma: no cover
+            _fallocate = False
+    if _fallocate:
+        _fallocate(fd, FALLOC_FL_KEEP_SIZE, 0, length)
+
+
 class ClearwaterLogHandler(BaseRotatingHandler):
-    def __init__(self, log_directory, logfile_prefix):
+    def __init__(self,
+                 log_directory,
+                 logfile_prefix,
+                 buffered=False,
+                 flush_bytes=DEFAULT_FLUSH_BYTES,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 flush_level=DEFAULT_FLUSH_LEVEL,
+                 preallocate_bytes=0,
+                 compressor=None,
+                 shared=False):
+        """Handler writing to hourly log files.
+
+        By default each record is written to the file as it is logged.  If
+        buffered is True, records are instead written in batches, when
+        flush_bytes are waiting, when they have been waiting for
+        flush_interval seconds, or when a record of flush_level or above is
+        logged.
+
+        If preallocate_bytes is non-zero, that much disk space is reserved
+        for each file when it is opened.  Whatever isn't used is given back
+        when the handler moves on to the next file or is closed, except for
+        shared files (where another process may still be appending), which
+        keep it until they are compressed or deleted.  The reserved space
+        counts towards the file's allocated blocks (st_blocks, and du) but
+        not its size.
+
+        If a LogCompressor is given, it is notified each time the handler
+        moves on to a new file, and stopped when the handler is closed.
+
+        If shared is True, several processes can safely log to the same
+        files: they are opened for appending, and each record (or batch of
+        records, if buffered) is written with a single write, so records from
+        different processes never overwrite or split each other."""
         BaseRotatingHandler.__init__(self, "", 'a', encoding=None, delay=True)
         self._log_directory = log_directory
         self._logfile_prefix = logfile_prefix
+        self._buffered = buffered
+        self._flush_bytes = flush_bytes
+        self._flush_interval = flush_interval
+        self._flush_level = flush_level
+        self._preallocate_bytes = preallocate_bytes
+        self._pending = []
+        self._pending_bytes = 0
+        self._compressor = compressor
+        self._shared = shared
         self.doRollover()
 
-    def shouldRollover(self, record): #pragma: no cover
-        now = int(time.time())
-        return (now > self.next_file_change)
+        if buffered:
+            # Make sure records don't wait much longer than flush_interval if
+            # nothing else is logged.
+            self._stop_flushing = threading.Event()
+            self._flusher = threading.Thread(target=self._flush_periodically,
+                                             name="LogFlusher")
+            self._flusher.daemon = True
+            self._flusher.start()
+
+    def shouldRollover(self, record):
+        # Use the time the record was created rather than calling
+        # time.time() for every record.
+        return (record.created >= self.next_file_change)
 
     def doRollover(self):
+        self._write_pending()
+        self._release_preallocation()
         tmpstream = self.stream
         self.stream = None
         if tmpstream:
@@ -50,53 +223,907 @@ class ClearwaterLogHandler(BaseRotatingHandler):
         self.baseFilename = getCurrentFilename(datetime.utcfromtimestamp(currentTime),
                                                self._log_directory,
                                                self._logfile_prefix)
-        self.stream = os.fdopen(os.open(self.baseFilename, os.O_WRONLY | os.O_CREAT, 0644), self.mode)
+        flags = os.O_WRONLY | os.O_CREAT
+        if self._shared:
+            flags |= os.O_APPEND
+        self.stream = os.fdopen(os.open(self.baseFilename, flags, 0644), self.mode)
+        if self._preallocate_bytes:
+            _preallocate(self.stream.fileno(), self._preallocate_bytes)
         self.next_file_change = (int(currentTime / 3600) * 3600) + 3600
+        if self._compressor:
+            self._compressor.notify()
+
+    def _release_preallocation(self):
+        """Gives back any preallocated space beyond the end of the current
+        file."""
+        if self._preallocate_bytes and self.stream and not self._shared:
+            self.stream.flush()
+            fd = self.stream.fileno()
+            os.ftruncate(fd, os.fstat(fd).st_size)
+
+    def emit(self, record):
+        if not (self._buffered or self._shared):
+            BaseRotatingHandler.emit(self, record)
+            return
+
+        try:
+            if self.shouldRollover(record):
+                self.doRollover()
+            msg = self.format(record) + "\n"
+            if isinstance(msg, unicode):
+                msg = msg.encode("utf-8")
+            self._pending.append(msg)
+            self._pending_bytes += len(msg)
+            if (not self._buffered or
+                    record.levelno >= self._flush_level or
+                    self._pending_bytes >= self._flush_bytes):
+                self._write_pending()
+        except (KeyboardInterrupt, SystemExit): #pragma: no cover
+            raise
+        except:
+            self.handleError(record)
+
+    def _write_pending(self):
+        """Writes any buffered records to the file with a single write."""
+        if not self._pending:
+            return
+        data = "".join(self._pending)
+        self._pending = []
+        self._pending_bytes = 0
+        fd = self.stream.fileno()
+        while data:
+            written = os.write(fd, data)
+            data = data[written:]
+
+    def _flush_periodically(self):
+        while not self._stop_flushing.wait(self._flush_interval):
+            self.flush()
+
+    def flush(self):
+        self.acquire()
+        try:
+            if self.stream:
+                self._write_pending()
+        finally:
+            self.release()
+        BaseRotatingHandler.flush(self)
+
+    def close(self):
+        if self._buffered:
+            self._stop_flushing.set()
+            self._flusher.join(ASYNC_FLUSH_TIMEOUT)
+        self.flush()
+        self.acquire()
+        try:
+            self._release_preallocation()
+        finally:
+            self.release()
+        if self._compressor:
+            self._compressor.stop()
+        BaseRotatingHandler.close(self)
+
+
+# What AsyncLogHandler does with a record when its queue is full.
+#  - OVERFLOW_BLOCK waits for the writer thread to make room.
+#  - OVERFLOW_DROP_DEBUG_FIRST drops a queued DEBUG record (or the new
+#    record, if it is DEBUG), falling back to dropping the oldest record.
+#  - OVERFLOW_DROP_OLDEST drops the oldest queued record.
+OVERFLOW_BLOCK = "block"
+OVERFLOW_DROP_DEBUG_FIRST = "drop-debug-first"
+OVERFLOW_DROP_OLDEST = "drop-oldest"
+
+DEFAULT_ASYNC_QUEUE_SIZE = 10000
+
+# How long to wait for queued records to be written on flush.
+ASYNC_FLUSH_TIMEOUT = 5
+
+
+class AsyncLogHandler(logging.Handler):
+    """Handler that queues records on a bounded queue, and passes them to
+    another handler on a dedicated writer thread, so that logging threads
+    never wait for the disk.
+
+    The record's message is formatted when it is queued, so later changes to
+    the arguments don't affect it."""
+
+    def __init__(self,
+                 target,
+                 queue_size=DEFAULT_ASYNC_QUEUE_SIZE,
+                 overflow_policy=OVERFLOW_DROP_DEBUG_FIRST):
+        logging.Handler.__init__(self)
+        if overflow_policy not in (OVERFLOW_BLOCK,
+                                   OVERFLOW_DROP_DEBUG_FIRST,
+                                   OVERFLOW_DROP_OLDEST):
+            raise ValueError("Unknown overflow policy {}".format(overflow_policy))
+        self.target = target
+        self._queue_size = queue_size
+        self._overflow_policy = overflow_policy
+        self._queue = deque()
+        self._writing = False
+
+        # The number of records in _queue that will be written, and, for the
+        # drop-debug-first policy, the queued DEBUG records in order.  DEBUG
+        # records dropped to make room are left in _queue (so the queue
+        # doesn't have to be searched for them) and skipped by the writer.
+        self._queued = 0
+        self._debug_queue = deque()
+        self._dropped_ids = set()
+        self._closed = False
+        self._condition = threading.Condition()
+
+        # Counts of records dropped because the queue was full.
+        self.dropped = 0
+        self.dropped_debug = 0
+
+        self._thread = threading.Thread(target=self._run, name="AsyncLogWriter")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def setFormatter(self, fmt):
+        logging.Handler.setFormatter(self, fmt)
+        self.target.setFormatter(fmt)
+
+    def emit(self, record):
+        try:
+            # Fix the message now, while the arguments are as the caller
+            # intended.
+            record.msg = record.getMessage()
+            record.args = None
+
+            with self._condition:
+                if self._closed:
+                    return
+                if self._queued >= self._queue_size and not self._make_room(record):
+                    return
+                self._queue.append(record)
+                self._queued += 1
+                if (self._overflow_policy == OVERFLOW_DROP_DEBUG_FIRST and
+                        record.levelno <= logging.DEBUG):
+                    self._debug_queue.append(record)
+                self._condition.notify_all()
+        except (KeyboardInterrupt, SystemExit): #pragma: no cover
+            raise
+        except:
+            self.handleError(record)
+
+    def _make_room(self, record):
+        """Applies the overflow policy to a full queue.  Must be called with
+        the condition held.  Returns False if record should be dropped."""
+        if self._overflow_policy == OVERFLOW_BLOCK:
+            while self._queued >= self._queue_size and not self._closed:
+                self._condition.wait(0.1)
+            return not self._closed
+
+        if self._overflow_policy == OVERFLOW_DROP_DEBUG_FIRST:
+            if record.levelno <= logging.DEBUG:
+                self._count_drop(record)
+                return False
+            if self._debug_queue:
+                dropped = self._debug_queue.popleft()
+                self._dropped_ids.add(id(dropped))
+                self._queued -= 1
+                self._count_drop(dropped)
+                return True
+
+        # Drop the oldest record, discarding any already-dropped DEBUG
+        # records in front of it.  There are no queued DEBUG records left if
+        # we get here with the drop-debug-first policy.
+        oldest = self._queue.popleft()
+        while id(oldest) in self._dropped_ids:
+            self._dropped_ids.discard(id(oldest))
+            oldest = self._queue.popleft()
+        self._queued -= 1
+        self._count_drop(oldest)
+        return True
+
+    def _count_drop(self, record):
+        self.dropped += 1
+        if record.levelno <= logging.DEBUG:
+            self.dropped_debug += 1
+
+    def _run(self):
+        """Writer thread loop."""
+        while True:
+            with self._condition:
+                while not self._queue and not self._closed:
+                    self._condition.wait()
+                if not self._queue:
+                    self._condition.notify_all()
+                    return
+                records = [record for record in self._queue
+                           if id(record) not in self._dropped_ids]
+                self._queue.clear()
+                self._debug_queue.clear()
+                self._dropped_ids.clear()
+                self._queued = 0
+                self._writing = True
+                self._condition.notify_all()
+
+            try:
+                for record in records:
+                    self.target.handle(record)
+            finally:
+                with self._condition:
+                    self._writing = False
+                    self._condition.notify_all()
+
+    def flush(self, timeout=ASYNC_FLUSH_TIMEOUT):
+        """Waits for queued records to be written, then flushes the target."""
+        deadline = time.time() + timeout
+        with self._condition:
+            while (self._queue or self._writing) and self._thread.is_alive():
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+        self.target.flush()
+
+    def close(self):
+        """Writes any queued records and stops the writer thread."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join(ASYNC_FLUSH_TIMEOUT)
+        self.target.close()
+        logging.Handler.close(self)
+
+
+def _flush_on_sigterm(handler): #pragma: no cover
+    """Installs a SIGTERM handler that flushes handler before carrying on with
+    whatever SIGTERM would otherwise have done.  Normal exit flushes it via
+    logging's own atexit hook.
+
+    This can only be done from the main thread, and has no effect if the
+    SIGTERM handler is replaced later (e.g. by utils.install_sigterm_handler,
+    which leads to a normal exit)."""
+    previous = signal.getsignal(signal.SIGTERM)
+
+    def sigterm_handler(sig, frame):
+        handler.flush()
+        if callable(previous):
+            previous(sig, frame)
+        elif previous != signal.SIG_IGN:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            os.kill(os.getpid(), signal.SIGTERM)
+
+    try:
+        signal.signal(signal.SIGTERM, sigterm_handler)
+    except ValueError:
+        pass
+
+
+# Defaults for BatchingSysLogHandler.
+SYSLOG_ADDRESS = "/dev/log"
+DEFAULT_SYSLOG_BACKLOG = 10000
+DEFAULT_SYSLOG_RECONNECT_INTERVAL = 1.0
+
+# Errors meaning syslog is busy, rather than gone.
+_SYSLOG_BUSY_ERRORS = (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS)
+
+# Errors sending to syslog that mean it has gone away.  Any other error (such
+# as EMSGSIZE for an oversized record) is specific to the message, which is
+# dropped.
+_SYSLOG_DISCONNECTED_ERRORS = (errno.ECONNREFUSED, errno.ENOENT, errno.ENOTCONN)
+
+
+class BatchingSysLogHandler(SysLogHandler):
+    """Handler sending logs to the local syslog daemon without blocking.
+
+    Records are formatted on the logging thread and added to a backlog of up
+    to backlog_size messages, which a background thread sends in batches
+    over a non-blocking unix datagram socket.  If syslog is busy the sender
+    waits for the socket to become writable; if it has gone away (e.g. while
+    rsyslog restarts) the sender reconnects every reconnect_interval seconds.
+    Meanwhile the backlog fills, and once it is full the oldest messages are
+    dropped.
+
+    dropped counts messages dropped from the backlog or rejected by the
+    socket, and delayed counts messages that could not be sent straight
+    away."""
+
+    def __init__(self,
+                 address=SYSLOG_ADDRESS,
+                 facility=SysLogHandler.LOG_USER,
+                 backlog_size=DEFAULT_SYSLOG_BACKLOG,
+                 reconnect_interval=DEFAULT_SYSLOG_RECONNECT_INTERVAL):
+        # Don't call SysLogHandler's constructor, which connects a blocking
+        # socket straight away.  Its priority encoding is reused though.
+        logging.Handler.__init__(self)
+        self.address = address
+        self.facility = facility
+        self.unixsocket = True
+        self.socket = None
+        self._backlog_size = backlog_size
+        self._reconnect_interval = reconnect_interval
+        self._backlog = deque()
+        self._condition = threading.Condition(threading.Lock())
+        self._sending = False
+        self._closed = False
+
+        # The number of messages at the front of the backlog that have
+        # already been counted as delayed.
+        self._counted_delayed = 0
+        self.dropped = 0
+        self.delayed = 0
+
+        self._thread = threading.Thread(target=self._run, name="SyslogSender")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def emit(self, record):
+        try:
+            msg = self.format(record) + "\000"
+            if isinstance(msg, unicode):
+                msg = msg.encode("utf-8")
+            priority = "<%d>" % self.encodePriority(
+                self.facility, self.mapPriority(record.levelname))
+            with self._condition:
+                if len(self._backlog) >= self._backlog_size:
+                    self._drop_oldest()
+                self._backlog.append(priority + msg)
+                self._condition.notify()
+        except (KeyboardInterrupt, SystemExit): #pragma: no cover
+            raise
+        except:
+            self.handleError(record)
+
+    def _drop_oldest(self):
+        self._backlog.popleft()
+        self.dropped += 1
+        if self._counted_delayed:
+            self._counted_delayed -= 1
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._backlog and not self._closed:
+                    self._condition.wait()
+                if not self._backlog:
+                    return
+                batch = list(self._backlog)
+                self._backlog.clear()
+                counted = self._counted_delayed
+                self._counted_delayed = 0
+                self._sending = True
+
+            sent, rejected = self._send(batch)
+
+            with self._condition:
+                self._sending = False
+                self.dropped += rejected
+                unsent = batch[sent:]
+                if unsent:
+                    # Count the messages that haven't been delayed before, and
+                    # put them all back at the front of the backlog, dropping
+                    # the oldest if there's no longer room.
+                    self.delayed += len(unsent) - max(0, counted - sent)
+                    self._backlog.extendleft(reversed(unsent))
+                    self._counted_delayed = len(unsent)
+                    while len(self._backlog) > self._backlog_size:
+                        self._drop_oldest()
+                self._condition.notify_all()
+                if unsent and self._closed:
+                    return
+
+            if unsent:
+                self._wait_for_syslog()
+
+    def _send(self, batch):
+        """Sends as many messages from batch as possible without blocking.
+        Returns how many messages from the start of batch are done with, and
+        how many of those were rejected."""
+        if self.socket is None and not self._connect():
+            return 0, 0
+        rejected = 0
+        for sent, msg in enumerate(batch):
+            try:
+                self.socket.send(msg)
+            except socket.error as e:
+                if e.errno in _SYSLOG_BUSY_ERRORS:
+                    return sent, rejected
+                if e.errno in _SYSLOG_DISCONNECTED_ERRORS:
+                    self._disconnect()
+                    return sent, rejected
+                rejected += 1
+        return len(batch), rejected
+
+    def _connect(self):
+        try:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sock.connect(self.address)
+        except socket.error:
+            sock.close()
+            return False
+        sock.setblocking(False)
+        self.socket = sock
+        return True
+
+    def _disconnect(self):
+        self.socket.close()
+        self.socket = None
+
+    def _wait_for_syslog(self):
+        """Waits until syslog is likely to accept more messages."""
+        if self.socket is None:
+            time.sleep(self._reconnect_interval)
+        else:
+            select.select([], [self.socket], [], self._reconnect_interval)
+
+    def flush(self, timeout=ASYNC_FLUSH_TIMEOUT):
+        """Waits for the backlog to be sent to syslog."""
+        deadline = time.time() + timeout
+        with self._condition:
+            while ((self._backlog or self._sending) and
+                   self._thread.is_alive()):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+
+    def close(self):
+        """Sends what can be sent of the backlog, and stops the sender."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join(ASYNC_FLUSH_TIMEOUT)
+        if self.socket is not None:
+            self._disconnect()
+        logging.Handler.close(self)
+
+
+# What ThrottlingFilter counts records against: the logger they were logged to,
+# or the line of code that logged them.
+THROTTLE_BY_LOGGER = "logger"
+THROTTLE_BY_CALL_SITE = "call-site"
+
+DEFAULT_THROTTLE_RATE = 100
+DEFAULT_THROTTLE_BURST = 1000
+
+# How often a steady stream of repeated messages is summarized.
+DEFAULT_SUMMARY_INTERVAL = 10
+
+
+class _ThrottleState(object):
+    """What ThrottlingFilter knows about the records for one key."""
+    __slots__ = ("throttler", "last_message", "repeats", "last_summary",
+                 "throttled", "debug_count")
+
+    def __init__(self, rate_per_second, burst_count):
+        self.throttler = Throttler(rate_per_second, burst_count)
+        self.last_message = None
+        self.repeats = 0
+        self.last_summary = 0
+        self.throttled = 0
+        self.debug_count = 0
+
+
+class ThrottlingFilter(logging.Filter):
+    """Filter limiting the rate of records per logger or per call site.
+
+    For each key (see THROTTLE_BY_LOGGER and THROTTLE_BY_CALL_SITE):
+    - only 1 in debug_sample_rate DEBUG records are kept
+    - when the same message is logged repeatedly, only the first is kept,
+      and the number of repeats is reported when a different message is
+      logged, or every summary_interval seconds while the repeats continue
+    - records are limited to rate_per_second, with bursts of up to
+      burst_count, and the number dropped is reported with the next record
+      that is allowed.
+
+    Reports are logged through handler, which should be the handler the
+    filter is added to, and are not themselves filtered."""
+
+    def __init__(self,
+                 handler,
+                 rate_per_second=DEFAULT_THROTTLE_RATE,
+                 burst_count=DEFAULT_THROTTLE_BURST,
+                 key=THROTTLE_BY_CALL_SITE,
+                 debug_sample_rate=1,
+                 summary_interval=DEFAULT_SUMMARY_INTERVAL):
+        logging.Filter.__init__(self)
+        if key not in (THROTTLE_BY_LOGGER, THROTTLE_BY_CALL_SITE):
+            raise ValueError("Unknown throttling key: {}".format(key))
+        self._handler = handler
+        self._rate_per_second = rate_per_second
+        self._burst_count = burst_count
+        self._by_logger = (key == THROTTLE_BY_LOGGER)
+        self._debug_sample_rate = debug_sample_rate
+        self._summary_interval = summary_interval
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if getattr(record, "_throttle_summary", False):
+            return True
+
+        key = record.name if self._by_logger else (record.pathname, record.lineno)
+        summaries = []
+        with self._lock:
+            state = self._states.get(key)
+            if state is None:
+                state = _ThrottleState(self._rate_per_second, self._burst_count)
+                self._states[key] = state
+            allowed = self._check(state, record, summaries)
+
+        for summary in summaries:
+            self._handler.handle(summary)
+        return allowed
+
+    def _check(self, state, record, summaries):
+        """Decides whether to keep a record, adding any reports due to
+        summaries.  Called with the lock held."""
+        if record.levelno <= logging.DEBUG and self._debug_sample_rate > 1:
+            state.debug_count += 1
+            if state.debug_count % self._debug_sample_rate != 1:
+                return False
+
+        message = record.getMessage()
+        if message == state.last_message:
+            state.repeats += 1
+            if record.created - state.last_summary >= self._summary_interval:
+                summaries.append(self._summary(
+                    record, "Previous message repeated %d times", state.repeats))
+                state.repeats = 0
+                state.last_summary = record.created
+            return False
+
+        if state.repeats:
+            summaries.append(self._summary(
+                record, "Previous message repeated %d times", state.repeats))
+            state.repeats = 0
+
+        if not state.throttler.is_allowed():
+            state.throttled += 1
+            return False
+
+        if state.throttled:
+            summaries.append(self._summary(
+                record, "%d messages dropped by rate limiting", state.throttled))
+            state.throttled = 0
+        state.last_message = message
+        state.last_summary = record.created
+        return True
+
+    @staticmethod
+    def _summary(record, msg, count):
+        summary = logging.LogRecord(record.name,
+                                    record.levelno,
+                                    record.pathname,
+                                    record.lineno,
+                                    msg,
+                                    (count,),
+                                    None,
+                                    record.funcName)
+        summary._throttle_summary = True
+        return summary
+
+
+# Default size of the flight recorder's ring buffer.
+DEFAULT_FLIGHT_RECORDER_SIZE = 1024 * 1024
+
+# Flight recorder header: magic, format version and the total number of bytes
+# ever written, from which the position in the ring can be worked out.
+_FLIGHT_RECORDER_MAGIC = "CWFR"
+_FLIGHT_RECORDER_VERSION = 1
+_FLIGHT_RECORDER_HEADER = struct.Struct("!4sBQ")
+
+
+def _read_ring(buf, size):
+    """Returns the contents of a flight recorder ring buffer, oldest first.
+
+    This doesn't take any locks, so it is safe to call from a signal handler.
+    A record being written at the time may be torn."""
+    magic, version, written = _FLIGHT_RECORDER_HEADER.unpack_from(buf, 0)
+    if magic != _FLIGHT_RECORDER_MAGIC or version != _FLIGHT_RECORDER_VERSION:
+        raise ValueError("Not a flight recorder buffer")
+    start = _FLIGHT_RECORDER_HEADER.size
+    if written <= size:
+        return buf[start:start + written]
+
+    # The ring has wrapped, so the oldest data starts at the write position,
+    # usually part way through a record.  Drop everything up to the first
+    # record boundary.
+    pos = written % size
+    data = buf[start + pos:start + size] + buf[start:start + pos]
+    return data[data.find("\n") + 1:]
+
+
+def read_flight_recorder(filename):
+    """Returns the contents of a file-backed flight recorder, for example one
+    left behind by a process that was killed."""
+    with open(filename, "rb") as f:
+        return _read_ring(f.read(), os.path.getsize(filename) -
+                                    _FLIGHT_RECORDER_HEADER.size)
+
+
+class FlightRecorderHandler(logging.Handler):
+    """Handler keeping the most recent records in a fixed-size ring buffer.
+
+    Logging to the ring is just a memory copy, so it's cheap enough to record
+    DEBUG logs permanently, and dump them when something goes wrong (see
+    utils.install_sigusr1_handler and configure_logging).
+
+    The ring is anonymous memory by default.  If filename is given it is a
+    shared mapping of that file instead, so the records survive the process
+    being killed and can be read with read_flight_recorder.  Any previous
+    contents of the file are discarded.
+
+    A forked child process gets its own copy of the ring, starting with the
+    records logged before the fork, so it never writes over the parent's
+    records.  Only the process that created a file-backed ring writes to the
+    file."""
+
+    def __init__(self,
+                 size=DEFAULT_FLIGHT_RECORDER_SIZE,
+                 filename=None,
+                 process_name=None):
+        logging.Handler.__init__(self, logging.DEBUG)
+        self.process_name = process_name
+        self._size = size
+        self._start = _FLIGHT_RECORDER_HEADER.size
+        self._pid = os.getpid()
+        self._file_backed = bool(filename)
+        length = self._start + size
+        if filename:
+            fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0644)
+            try:
+                os.ftruncate(fd, length)
+                self._buffer = mmap.mmap(fd, length)
+            finally:
+                os.close(fd)
+        else:
+            # Anonymous mappings are shared with forked children unless they
+            # are private.
+            self._buffer = mmap.mmap(-1, length, flags=mmap.MAP_PRIVATE)
+        self._written = 0
+        self._write_header()
+
+    def _check_fork(self):
+        """Moves a forked child's file-backed ring into private memory."""
+        if self._file_backed and self._pid != os.getpid():
+            shared = self._buffer
+            self._buffer = mmap.mmap(-1, len(shared), flags=mmap.MAP_PRIVATE)
+            self._buffer[:] = shared[:]
+            shared.close()
+            self._file_backed = False
+
+    def _write_header(self):
+        _FLIGHT_RECORDER_HEADER.pack_into(self._buffer,
+                                          0,
+                                          _FLIGHT_RECORDER_MAGIC,
+                                          _FLIGHT_RECORDER_VERSION,
+                                          self._written)
+
+    def emit(self, record):
+        if self._buffer is None:
+            return
+        try:
+            self._check_fork()
+            msg = self.format(record) + "\n"
+            if isinstance(msg, unicode):
+                msg = msg.encode("utf-8")
+            if len(msg) > self._size:
+                msg = msg[-self._size:]
+
+            # Copy the record in at the write position, wrapping round to the
+            # start of the ring if necessary.
+            buf = self._buffer
+            start = self._start
+            pos = self._written % self._size
+            first = min(len(msg), self._size - pos)
+            buf[start + pos:start + pos + first] = msg[:first]
+            if first < len(msg):
+                buf[start:start + len(msg) - first] = msg[first:]
+            self._written += len(msg)
+            self._write_header()
+        except (KeyboardInterrupt, SystemExit): #pragma: no cover
+            raise
+        except:
+            self.handleError(record)
+
+    def dump(self):
+        """Returns the recorded logs, oldest first."""
+        if self._buffer is None:
+            return ""
+        self._check_fork()
+        return _read_ring(self._buffer, self._size)
+
+    def close(self):
+        self.acquire()
+        try:
+            if self._buffer is not None:
+                self._buffer.close()
+                self._buffer = None
+        finally:
+            self.release()
+        logging.Handler.close(self)
+
+
+def get_flight_recorder():
+    """Returns the flight recorder configured by configure_logging, or None."""
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, FlightRecorderHandler):
+            return handler
+    return None
 
 
 def configure_logging(log_level,
                       log_dir,
                       log_prefix,
                       task_id=None,
-                      show_thread=False):
+                      show_thread=False,
+                      asynchronous=False,
+                      queue_size=DEFAULT_ASYNC_QUEUE_SIZE,
+                      overflow_policy=OVERFLOW_DROP_DEBUG_FIRST,
+                      buffered=False,
+                      flush_bytes=DEFAULT_FLUSH_BYTES,
+                      flush_interval=DEFAULT_FLUSH_INTERVAL,
+                      preallocate_bytes=0,
+                      compression=None,
+                      max_total_bytes=None,
+                      compress_bytes_per_second=None,
+                      shared=False,
+                      flight_recorder_size=0,
+                      flight_recorder_file=None,
+                      throttling=None,
+                      output_format=OUTPUT_TEXT):
     """Utility function for configuring python logging.
     - log_dir specifies the directory logs will be written to
     - log_prefix is a prefix applied to each file in that directory.
-    - if show_thread is True, include the thread name in logs."""
+    - task_id is added to log_prefix, so that each task has its own files,
+      unless shared is True, in which case all processes using log_prefix
+      append to the same files.
+    - if show_thread is True, include the thread name in logs.
+    - output_format is OUTPUT_TEXT for lines of text, or OUTPUT_JSON for a
+      JSON object per line.  See JsonFormatter.
+    - if asynchronous is True, logs are written by a background thread from
+      a queue of up to queue_size records, applying overflow_policy when it
+      is full.  See AsyncLogHandler.
+    - if buffered is True, logs are written in batches of up to flush_bytes,
+      at least every flush_interval seconds, and immediately for errors.
+    - preallocate_bytes reserves disk space for each hourly file.  See
+      ClearwaterLogHandler.
+    - compression ("gzip" or "zstd") compresses hourly files once they are
+      closed, reading no more than compress_bytes_per_second.
+    - max_total_bytes limits the disk space used by the log files, deleting
+      the oldest first.  See LogCompressor.
+    - if flight_recorder_size is non-zero, logs at all levels are also kept in
+      a ring buffer of that size (backed by flight_recorder_file, if given)
+      which is dumped to a core file on an uncaught exception.  Pass
+      get_flight_recorder() to utils.install_sigusr1_handler to dump it on
+      SIGUSR1 too.  See FlightRecorderHandler.
+    - throttling is a dictionary of ThrottlingFilter options.  If it is
+      given, that filter limits the logs written to file (but not those kept
+      by the flight recorder)."""
     # Construct the handler to pass in to the common logging function.
-    if task_id:
+    if task_id and not shared:
         log_prefix += "-{}".format(task_id)
-    handler = ClearwaterLogHandler(log_dir, log_prefix)
 
-    log_format = THREAD_FORMAT if show_thread else NO_THREAD_FORMAT
+    compressor = None
+    if compression or max_total_bytes is not None:
+        compressor = LogCompressor(log_dir,
+                                   log_prefix,
+                                   method=compression,
+                                   max_total_bytes=max_total_bytes,
+                                   max_bytes_per_second=compress_bytes_per_second)
+        compressor.start()
+
+    handler = ClearwaterLogHandler(log_dir,
+                                   log_prefix,
+                                   buffered=buffered,
+                                   flush_bytes=flush_bytes,
+                                   flush_interval=flush_interval,
+                                   preallocate_bytes=preallocate_bytes,
+                                   compressor=compressor,
+                                   shared=shared)
 
-    common_logging(handler, log_level, log_format)
+    if asynchronous:
+        handler = AsyncLogHandler(handler, queue_size, overflow_policy)
+        _flush_on_sigterm(handler)
 
+    if output_format == OUTPUT_JSON:
+        log_format = JsonFormatter()
+    else:
+        log_format = THREAD_FORMAT if show_thread else NO_THREAD_FORMAT
 
-def configure_syslog(tag, log_level, facility=SysLogHandler.LOG_USER):
+    common_logging(handler, log_level, log_format, throttling)
+
+    if flight_recorder_size:
+        recorder = FlightRecorderHandler(flight_recorder_size,
+                                         flight_recorder_file,
+                                         process_name=log_prefix)
+        recorder.setFormatter(log_format)
+        _add_root_handler(recorder, logging.DEBUG)
+
+
+def configure_syslog(tag,
+                     log_level,
+                     facility=SysLogHandler.LOG_USER,
+                     throttling=None,
+                     batched=False,
+                     backlog_size=DEFAULT_SYSLOG_BACKLOG,
+                     output_format=OUTPUT_TEXT):
     """Utility function for sending logs to the local syslog daemon. Users can
-    specify the facility the message is sent with.
+    specify the facility the message is sent with, and ThrottlingFilter
+    options to limit the rate of logs.
+
+    If batched is True, logs are sent by a background thread so that logging
+    never blocks, keeping up to backlog_size messages while syslog is busy or
+    unavailable.  See BatchingSysLogHandler.
+
+    If output_format is OUTPUT_JSON, each message is the tag followed by a
+    JSON object.  See JsonFormatter.
 
     Note that a separate rsyslog script will need to be written to write the
     incoming syslog messages to file. It is suggested that it filters based on
     the configured tag."""
-    handler = SysLogHandler(address="/dev/log", facility=facility)
-    syslog_format = logging.Formatter(NO_TIME_FORMAT_STRING.format(tag=tag))
-    common_logging(handler, log_level, syslog_format)
+    if batched:
+        handler = BatchingSysLogHandler(SYSLOG_ADDRESS, facility, backlog_size)
+    else:
+        handler = SysLogHandler(address=SYSLOG_ADDRESS, facility=facility)
+    if output_format == OUTPUT_JSON:
+        syslog_format = JsonFormatter(tag)
+    else:
+        syslog_format = logging.Formatter(NO_TIME_FORMAT_STRING.format(tag=tag))
+    common_logging(handler, log_level, syslog_format, throttling)
+
+
+# The levels of the handlers this module has added to the root logger, and the
+# handler whose level set_log_level changes.
+_handler_levels = {}
+_main_handler = None
+
+
+def _update_root_level():
+    """Sets the root logger's level to that of the most verbose handler, so
+    that calls for levels no handler wants are discarded by the logger before
+    a record is even created."""
+    if _handler_levels:
+        logging.getLogger().setLevel(min(_handler_levels.values()))
 
 
-def common_logging(handler, log_level, log_format):
-    # Configure the root logger to accept all messages. We control the log
-    # level through the handler attached to it.
+def _add_root_handler(handler, log_level):
+    handler.setLevel(log_level)
+    logging.getLogger().addHandler(handler)
+    # log_level may be a level name, so use the number setLevel stored.
+    _handler_levels[handler] = handler.level
+    _update_root_level()
+
+
+def _remove_root_handlers():
+    """Removes and closes the root logger's handlers, which stops any threads
+    they have started."""
+    global _main_handler
     root_log = logging.getLogger()
-    root_log.setLevel(logging.DEBUG)
-    for h in root_log.handlers:
+    for h in list(root_log.handlers):
         root_log.removeHandler(h)
+        h.close()
+    _handler_levels.clear()
+    _main_handler = None
+
+
+def set_log_level(log_level):
+    """Changes the level of logs written by the handler set up by
+    configure_logging or configure_syslog, at runtime."""
+    if _main_handler is None:
+        raise RuntimeError("Logging has not been configured")
+    _main_handler.setLevel(log_level)
+    _handler_levels[_main_handler] = _main_handler.level
+    _update_root_level()
+
+
+def common_logging(handler, log_level, log_format, throttling=None):
+    global _main_handler
+    # The log level is controlled through the handler attached to the root
+    # logger.  The root logger itself only lets through the levels that some
+    # handler wants.
+    _remove_root_handlers()
 
     log_format.converter = time.gmtime
     handler.setFormatter(log_format)
-    handler.setLevel(log_level)
-    root_log.addHandler(handler)
+    if throttling is not None:
+        handler.addFilter(ThrottlingFilter(handler, **throttling))
+    _add_root_handler(handler, log_level)
+    _main_handler = handler
 
     def exception_logging_handler(type, value, tb): #pragma: no cover
         root_log = logging.getLogger()
@@ -107,6 +1134,15 @@ def common_logging(handler, log_level, log_format):
   {2}""".format(str(type.__name__),
                 str(value),
                 "".join(traceback.format_tb(tb))))
+
+        # Dump the recent logs alongside the exception.
+        recorder = get_flight_recorder()
+        if recorder:
+            write_core_file(recorder.process_name,
+                            "Uncaught exception\n" +
+                            "".join(traceback.format_exception(type, value, tb)) +
+                            "\nRecent log records:\n" +
+                            recorder.dump())
         sys.__excepthook__(type, value, tb)
 
     # Install exception handler
@@ -127,9 +1163,8 @@ def configure_test_logging():
     logfile = os.getenv('LOGFILE')
 
     root_logger = logging.getLogger()
+    _remove_root_handlers()
     root_logger.setLevel(level)
-    for handler in root_logger.handlers:
-        root_logger.removeHandler(handler)
 
     if logfile: #pragma: no cover
         file_handler = logging.FileHandler(logfile)
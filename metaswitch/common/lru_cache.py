@@ -0,0 +1,109 @@
+# @file lru_cache.py
+#
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+
+import threading
+
+# Indices into the entries of the linked list.
+_PREV, _NEXT, _KEY, _VALUE = 0, 1, 2, 3
+
+
+class LRUCache(object):
+    """Bounded, thread-safe cache that evicts the least recently used entry.
+
+    Entries are kept in a dictionary and a circular doubly linked list in
+    order of use, as functools.lru_cache does in later versions of Python,
+    so lookups and insertions are constant time."""
+
+    def __init__(self, maxsize):
+        """Constructor.
+
+        Arguments:
+        maxsize -- the maximum number of entries to keep.  Must be positive.
+        """
+        if maxsize <= 0:
+            raise ValueError("LRUCache maxsize must be positive")
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """Remove all entries and reset the counters."""
+        with self._lock:
+            self._cache = {}
+            self._root = []
+            self._root[:] = [self._root, self._root, None, None]
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def get(self, key, default=None):
+        """Returns the value cached for key, or default if there isn't one,
+        counting the lookup as a hit or miss."""
+        with self._lock:
+            link = self._cache.get(key)
+            if link is None:
+                self.misses += 1
+                return default
+
+            # Move the entry to the most recently used end of the list.
+            link_prev, link_next = link[_PREV], link[_NEXT]
+            link_prev[_NEXT] = link_next
+            link_next[_PREV] = link_prev
+            root = self._root
+            last = root[_PREV]
+            last[_NEXT] = root[_PREV] = link
+            link[_PREV] = last
+            link[_NEXT] = root
+            self.hits += 1
+            return link[_VALUE]
+
+    def put(self, key, value):
+        """Caches value for key, evicting the least recently used entry if the
+        cache is full."""
+        with self._lock:
+            root = self._root
+            link = self._cache.get(key)
+            if link is not None:
+                link[_VALUE] = value
+                return
+
+            if len(self._cache) >= self.maxsize:
+                # Reuse the old root as the new entry, and make the oldest
+                # entry the new root.
+                old_root = root
+                old_root[_KEY] = key
+                old_root[_VALUE] = value
+                root = self._root = old_root[_NEXT]
+                del self._cache[root[_KEY]]
+                root[_KEY] = root[_VALUE] = None
+                self._cache[key] = old_root
+                self.evictions += 1
+            else:
+                last = root[_PREV]
+                link = [last, root, key, value]
+                last[_NEXT] = root[_PREV] = self._cache[key] = link
+
+    def pop(self, key, default=None):
+        """Removes the entry for key and returns its value, or default if
+        there isn't one."""
+        with self._lock:
+            link = self._cache.pop(key, None)
+            if link is None:
+                return default
+            link_prev, link_next = link[_PREV], link[_NEXT]
+            link_prev[_NEXT] = link_next
+            link_next[_PREV] = link_prev
+            return link[_VALUE]
+
+    def __contains__(self, key):
+        return key in self._cache
+
+    def __len__(self):
+        return len(self._cache)
@@ -6,14 +6,104 @@
 # Metaswitch Networks in a separate written agreement.
 
 import phonenumbers
+from metaswitch.common.lru_cache import LRUCache
+from metaswitch.common.utils import map_in_chunks, DEFAULT_PARALLEL_THRESHOLD
 
-def format_phone_number(number):
+DEFAULT_REGION = "US"
+DEFAULT_CACHE_SIZE = 10000
+
+def _format(number, region):
     try:
-        # TODO support non-US
-        numobj = phonenumbers.parse(number, "US")
+        numobj = phonenumbers.parse(number, region)
         number = phonenumbers.format_number(numobj,
                                             phonenumbers.PhoneNumberFormat.NATIONAL)
     except Exception:
         return number
     return number
 
+def _format_chunk(args):
+    """Formats a chunk of numbers in a pool worker.  This is module-level so
+    that it can be pickled."""
+    region, numbers = args
+    return [_format(number, region) for number in numbers]
+
+class PhoneNumberFormatter(object):
+    """Formats phone numbers for display in the national format of a region,
+    caching the results for recently formatted numbers.
+
+    Numbers that can't be parsed are returned unchanged."""
+
+    def __init__(self,
+                 region=DEFAULT_REGION,
+                 cache_size=DEFAULT_CACHE_SIZE,
+                 parallel_threshold=DEFAULT_PARALLEL_THRESHOLD):
+        """Constructor.
+
+        Arguments:
+        region -- the region numbers are assumed to be in if they don't have
+        a country code.
+        cache_size -- the number of formatted numbers to keep, or 0 to turn
+        off caching.
+        parallel_threshold -- the number of distinct uncached numbers in a
+        call to format_many above which they are formatted by a process
+        pool.
+        """
+        self.region = region
+        self.parallel_threshold = parallel_threshold
+        self._cache = LRUCache(cache_size) if cache_size else None
+
+    @property
+    def hits(self):
+        return self._cache.hits if self._cache is not None else 0
+
+    @property
+    def misses(self):
+        return self._cache.misses if self._cache is not None else 0
+
+    def format(self, number):
+        """Formats a single number."""
+        if self._cache is None:
+            return _format(number, self.region)
+
+        formatted = self._cache.get(number)
+        if formatted is None:
+            formatted = _format(number, self.region)
+            self._cache.put(number, formatted)
+        return formatted
+
+    def format_many(self, numbers, processes=None):
+        """Formats a list of numbers, returning a list of the results in the
+        same order.
+
+        Each distinct number is only formatted once.  If there are more than
+        parallel_threshold distinct numbers that aren't cached, they are
+        shared out over a pool of processes (by default, one per CPU)."""
+        results = {}
+        uncached = []
+        for number in numbers:
+            if number in results:
+                continue
+            # An empty cache is falsy, so compare with None.
+            formatted = (self._cache.get(number)
+                         if self._cache is not None else None)
+            results[number] = formatted
+            if formatted is None:
+                uncached.append(number)
+
+        formatted = map_in_chunks(_format_chunk,
+                                  self.region,
+                                  uncached,
+                                  processes,
+                                  self.parallel_threshold)
+
+        for number, formatted_number in zip(uncached, formatted):
+            results[number] = formatted_number
+            if self._cache is not None:
+                self._cache.put(number, formatted_number)
+
+        return [results[number] for number in numbers]
+
+_default_formatter = PhoneNumberFormatter()
+
+def format_phone_number(number):
+    return _default_formatter.format(number)
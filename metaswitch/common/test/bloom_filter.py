@@ -0,0 +1,77 @@
+# @file bloom_filter.py
+#
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from metaswitch.common.bloom_filter import BloomFilter
+
+class BloomFilterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_membership(self):
+        """Items added are always found."""
+        bloom = BloomFilter(1000, 0.01)
+        items = ["item%d" % i for i in xrange(1000)]
+        for item in items:
+            bloom.add(item)
+        for item in items:
+            self.assertTrue(item in bloom)
+        self.assertTrue(u"item1" in bloom)
+        self.assertEquals(bloom.count, 1000)
+
+    def test_false_positive_rate(self):
+        """The false positive rate at capacity is close to that requested."""
+        bloom = BloomFilter(10000, 0.01)
+        for i in xrange(10000):
+            bloom.add("present%d" % i)
+        false_positives = sum(1 for i in xrange(10000) if ("absent%d" % i) in bloom)
+        self.assertLess(false_positives, 200)
+
+    def test_size(self):
+        """The filter uses about 9.6 bits per item for a 1% error rate."""
+        bloom = BloomFilter(10000, 0.01)
+        self.assertEquals(bloom.num_bits, 95851)
+        self.assertEquals(bloom.num_hashes, 7)
+
+    def test_save_load(self):
+        """Filters can be saved to and loaded from disk."""
+        filename = os.path.join(self.tmpdir, "ids.bloom")
+        bloom = BloomFilter(100)
+        bloom.add("abc")
+        bloom.save(filename)
+
+        loaded = BloomFilter.load(filename)
+        self.assertTrue("abc" in loaded)
+        self.assertFalse("def" in loaded)
+        self.assertEquals(loaded.num_bits, bloom.num_bits)
+        self.assertEquals(loaded.num_hashes, bloom.num_hashes)
+        self.assertEquals(loaded.count, 1)
+
+    def test_load_bad_file(self):
+        """Loading something that isn't a filter fails cleanly."""
+        filename = os.path.join(self.tmpdir, "ids.bloom")
+        with open(filename, "wb") as f:
+            f.write("not a bloom filter at all")
+        self.assertRaises(ValueError, BloomFilter.load, filename)
+
+        BloomFilter(100).save(filename)
+        with open(filename, "r+b") as f:
+            f.truncate(30)
+        self.assertRaises(ValueError, BloomFilter.load, filename)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,153 @@
+# @file digest_auth.py
+#
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+
+import unittest
+import mock
+
+from metaswitch.common.digest_auth import (calculate_ha1,
+                                           calculate_ha1s,
+                                           calculate_ha2,
+                                           calculate_response,
+                                           verify_response,
+                                           DigestAuthenticator,
+                                           MD5,
+                                           MD5_SESS,
+                                           SHA256,
+                                           QOP_AUTH,
+                                           QOP_AUTH_INT)
+from metaswitch.common.utils import md5
+
+# Example from RFC 2617 section 3.5.
+RFC2617 = dict(username="Mufasa",
+               realm="testrealm@host.com",
+               password="Circle Of Life",
+               nonce="dcd98b7102dd2f0e8b11d0f600bfb0c093",
+               method="GET",
+               uri="/dir/index.html",
+               nc="00000001",
+               cnonce="0a4f113b",
+               response="6629fae49393a05397450978507c4ef1")
+
+# Example from RFC 7616 section 3.9.1.
+RFC7616 = dict(username="Mufasa",
+               realm="http-auth@example.org",
+               password="Circle of Life",
+               nonce="7ypf/xlj9XXwfDPEoM4URrv/xwf94BcCAzFZH4GiTo0v",
+               method="GET",
+               uri="/dir/index.html",
+               nc="00000001",
+               cnonce="f2/wE4q74E6zIJEtWaHKaf5wv/H5QzzpXusqGemxURZJ",
+               md5_response="8ca523f5e9506fed4657c9700eebdbec",
+               sha256_response="753927fa0e85d155564e2e272a28d1802ca10daf4496794697cf8db5856cb6c1")
+
+
+class DigestTestCase(unittest.TestCase):
+    def test_rfc2617(self):
+        """The RFC 2617 example response is calculated correctly."""
+        e = RFC2617
+        ha1 = calculate_ha1(e["username"], e["realm"], e["password"])
+        response = calculate_response(ha1, e["nonce"], e["method"], e["uri"],
+                                      QOP_AUTH, e["nc"], e["cnonce"])
+        self.assertEqual(response, e["response"])
+        self.assertTrue(verify_response(e["response"].upper(), ha1, e["nonce"],
+                                        e["method"], e["uri"],
+                                        QOP_AUTH, e["nc"], e["cnonce"]))
+        self.assertFalse(verify_response("0" * 32, ha1, e["nonce"],
+                                         e["method"], e["uri"],
+                                         QOP_AUTH, e["nc"], e["cnonce"]))
+
+    def test_rfc7616(self):
+        """The RFC 7616 example responses are calculated correctly."""
+        e = RFC7616
+        for algorithm, expected in ((MD5, e["md5_response"]),
+                                    (SHA256, e["sha256_response"])):
+            ha1 = calculate_ha1(e["username"], e["realm"], e["password"], algorithm)
+            response = calculate_response(ha1, e["nonce"], e["method"], e["uri"],
+                                          QOP_AUTH, e["nc"], e["cnonce"],
+                                          algorithm=algorithm)
+            self.assertEqual(response, expected)
+
+    def test_no_qop(self):
+        """Without qop, the response is H(HA1:nonce:HA2)."""
+        ha2 = calculate_ha2("REGISTER", "sip:example.com")
+        self.assertEqual(calculate_response("ha1", "nonce", "REGISTER", "sip:example.com"),
+                         calculate_ha1("ha1", "nonce", ha2))
+
+    def test_auth_int(self):
+        """auth-int includes the body hash in HA2."""
+        self.assertEqual(calculate_ha2("INVITE", "sip:a@b", QOP_AUTH_INT, "body"),
+                         md5("INVITE:sip:a@b:" + md5("body")))
+        self.assertNotEqual(calculate_ha2("INVITE", "sip:a@b", QOP_AUTH_INT, "body"),
+                            calculate_ha2("INVITE", "sip:a@b", QOP_AUTH_INT, "other"))
+
+    def test_sess(self):
+        """-sess algorithms hash the nonce and cnonce into HA1."""
+        ha1 = calculate_ha1("user", "realm", "password")
+        session_ha1 = calculate_ha1(ha1, "nonce", "cnonce")
+        self.assertEqual(calculate_response(ha1, "nonce", "GET", "/", QOP_AUTH,
+                                            "00000001", "cnonce", algorithm=MD5_SESS),
+                         calculate_response(session_ha1, "nonce", "GET", "/", QOP_AUTH,
+                                            "00000001", "cnonce"))
+
+    def test_bad_algorithm(self):
+        self.assertRaises(ValueError, calculate_ha1, "user", "realm", "password", "SHA-1")
+
+    def test_calculate_ha1s(self):
+        """Batch HA1s match individual ones, in and out of a process pool."""
+        credentials = [("user%d" % i, "realm", "password%d" % i) for i in xrange(50)]
+        expected = [calculate_ha1(*c) for c in credentials]
+        self.assertEqual(calculate_ha1s(credentials), expected)
+        self.assertEqual(calculate_ha1s(iter(credentials), processes=2, parallel_threshold=10),
+                         expected)
+
+
+class DigestAuthenticatorTestCase(unittest.TestCase):
+    def setUp(self):
+        e = RFC2617
+        self.ha1 = calculate_ha1(e["username"], e["realm"], e["password"])
+        self.get_ha1 = mock.Mock(side_effect=lambda username, realm, algorithm:
+                                 self.ha1 if username == "Mufasa" else None)
+        self.authenticator = DigestAuthenticator(self.get_ha1, cache_size=10)
+
+    def verify(self, username="Mufasa", response=RFC2617["response"]):
+        e = RFC2617
+        return self.authenticator.verify(username, e["realm"], e["nonce"],
+                                         e["method"], e["uri"], response,
+                                         QOP_AUTH, e["nc"], e["cnonce"])
+
+    def test_verify_caches_ha1(self):
+        """HA1 is only fetched once per user."""
+        self.assertTrue(self.verify())
+        self.assertTrue(self.verify())
+        self.assertFalse(self.verify(response="0" * 32))
+        self.assertEqual(self.get_ha1.call_count, 1)
+        self.assertEqual((self.authenticator.hits, self.authenticator.misses), (2, 1))
+
+    def test_unknown_user(self):
+        """Unknown users fail and aren't cached."""
+        self.assertFalse(self.verify(username="Scar"))
+        self.assertFalse(self.verify(username="Scar"))
+        self.assertEqual(self.get_ha1.call_count, 2)
+
+    def test_invalidate(self):
+        """Invalidated HA1s are fetched again."""
+        self.verify()
+        self.authenticator.invalidate("Mufasa", RFC2617["realm"])
+        self.verify()
+        self.assertEqual(self.get_ha1.call_count, 2)
+
+    def test_prime(self):
+        """Primed HA1s don't need fetching."""
+        self.authenticator.prime([("Mufasa", RFC2617["realm"], self.ha1)])
+        self.assertTrue(self.verify())
+        self.assertFalse(self.get_ha1.called)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,189 @@
+# @file log_compressor.py
+#
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+
+import calendar
+import gzip
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from fcntl import flock, LOCK_EX
+
+import mock
+
+from metaswitch.common import log_compressor
+from metaswitch.common.log_compressor import LogCompressor
+from metaswitch.common.logging_config import _preallocate
+
+# 2017-03-01 12:30 UTC, and the names of the log files for that hour and the
+# two before it.
+NOW = calendar.timegm((2017, 3, 1, 12, 30, 0))
+CURRENT = "test_20170301T120000Z.txt"
+PREVIOUS = "test_20170301T110000Z.txt"
+OLDEST = "test_20170301T100000Z.txt"
+
+
+class LogCompressorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_file(self, name, contents, mtime=NOW - 3600):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, "wb") as f:
+            f.write(contents)
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def files(self):
+        """Returns the files in the log directory, other than the lock
+        file."""
+        return sorted(name for name in os.listdir(self.tmpdir)
+                      if not name.startswith("."))
+
+    def test_compress(self):
+        """Files for earlier hours are compressed and the originals deleted."""
+        self.write_file(OLDEST, "oldest\n" * 1000)
+        self.write_file(PREVIOUS, "previous\n" * 1000)
+        self.write_file(CURRENT, "current\n", mtime=NOW)
+        self.write_file("other_20170301T100000Z.txt", "other prefix\n")
+
+        LogCompressor(self.tmpdir, "test").run_once(now=NOW)
+
+        self.assertEqual(self.files(), ["other_20170301T100000Z.txt",
+                                        OLDEST + ".gz",
+                                        PREVIOUS + ".gz",
+                                        CURRENT])
+        with gzip.open(os.path.join(self.tmpdir, PREVIOUS + ".gz")) as f:
+            self.assertEqual(f.read(), "previous\n" * 1000)
+
+    def test_settle_time(self):
+        """Files that have been written to recently are left alone."""
+        self.write_file(PREVIOUS, "previous\n", mtime=NOW - 10)
+        LogCompressor(self.tmpdir, "test").run_once(now=NOW)
+        self.assertEqual(self.files(), [PREVIOUS])
+
+    def test_budget(self):
+        """The oldest files are deleted to keep within the budget, but the
+        current file is kept even if it is over budget on its own."""
+        self.write_file(OLDEST, "a" * 100000)
+        self.write_file(PREVIOUS, "b" * 100000)
+        self.write_file(CURRENT, "c" * 100000, mtime=NOW)
+
+        compressor = LogCompressor(self.tmpdir, "test",
+                                   method=None, max_total_bytes=250000)
+        compressor.run_once(now=NOW)
+        self.assertEqual(self.files(), [PREVIOUS, CURRENT])
+
+        compressor = LogCompressor(self.tmpdir, "test",
+                                   method=None, max_total_bytes=50000)
+        compressor.run_once(now=NOW)
+        self.assertEqual(self.files(), [CURRENT])
+
+    def test_budget_counts_preallocated_space(self):
+        """The budget applies to the disk space files use, including space
+        preallocated beyond the end of the file."""
+        path = self.write_file(OLDEST, "a" * 100)
+        with open(path, "r+b") as f:
+            _preallocate(f.fileno(), 1024 * 1024)
+        self.write_file(PREVIOUS, "b" * 100)
+        LogCompressor(self.tmpdir, "test",
+                      method=None, max_total_bytes=512 * 1024).run_once(now=NOW)
+        self.assertEqual(self.files(), [PREVIOUS])
+
+    def test_budget_counts_compressed_size(self):
+        """The budget applies to the files after compression."""
+        self.write_file(OLDEST, "a" * 100000)
+        self.write_file(PREVIOUS, "b" * 100000)
+        LogCompressor(self.tmpdir, "test",
+                      max_total_bytes=100000).run_once(now=NOW)
+        self.assertEqual(self.files(), [OLDEST + ".gz", PREVIOUS + ".gz"])
+
+    def test_rate_limit(self):
+        """Compression reads no faster than the configured rate."""
+        self.write_file(PREVIOUS, "x" * 1024 * 1024)
+        start = time.time()
+        LogCompressor(self.tmpdir, "test",
+                      max_bytes_per_second=8 * 1024 * 1024).run_once(now=NOW)
+        self.assertGreaterEqual(time.time() - start, 0.12)
+        self.assertEqual(self.files(), [PREVIOUS + ".gz"])
+
+    def test_background_thread(self):
+        """The background thread does the work when notified."""
+        self.write_file(PREVIOUS, "previous\n", mtime=time.time() - 3600)
+        compressor = LogCompressor(self.tmpdir, "test")
+        compressor.start()
+        compressor.notify()
+        for _ in range(100):
+            if self.files() == [PREVIOUS + ".gz"]:
+                break
+            time.sleep(0.01)
+        compressor.stop()
+        self.assertEqual(self.files(), [PREVIOUS + ".gz"])
+
+    def test_locked(self):
+        """Nothing is done while another compressor holds the lock for the
+        prefix, such as one in another process sharing the log files."""
+        self.write_file(PREVIOUS, "previous\n")
+        compressor = LogCompressor(self.tmpdir, "test")
+        with open(os.path.join(self.tmpdir, ".test.compress.lock"), "a") as lockfile:
+            flock(lockfile, LOCK_EX)
+            compressor.run_once(now=NOW)
+        self.assertEqual(self.files(), [PREVIOUS])
+
+        compressor.run_once(now=NOW)
+        self.assertEqual(self.files(), [PREVIOUS + ".gz"])
+
+    def test_stop_during_compression(self):
+        """Stopping abandons a compression in progress, deleting the
+        partially compressed file and leaving the original."""
+        self.write_file(PREVIOUS, "x" * 1024 * 1024, mtime=time.time() - 3600)
+        # Each chunk takes a minute at this rate.
+        compressor = LogCompressor(self.tmpdir, "test",
+                                   max_bytes_per_second=1024)
+        compressor.start()
+        thread = compressor._thread
+        compressor.notify()
+        for _ in range(100):
+            if len(self.files()) == 2:
+                break
+            time.sleep(0.01)
+        self.assertEqual(len(self.files()), 2)
+
+        start = time.time()
+        compressor.stop()
+        self.assertLess(time.time() - start, 1)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(self.files(), [PREVIOUS])
+
+    def test_stale_temporary_files(self):
+        """Partially compressed files left behind by an earlier compressor
+        are deleted, so they don't use up the budget."""
+        self.write_file(OLDEST + ".gz", "a" * 100000)
+        self.write_file(PREVIOUS + ".gz.1234.tmp", "b" * 100000)
+        self.write_file(PREVIOUS, "b" * 100000)
+        compressor = LogCompressor(self.tmpdir, "test",
+                                   method=None, max_total_bytes=250000)
+        compressor.run_once(now=NOW)
+        self.assertEqual(self.files(), [OLDEST + ".gz", PREVIOUS])
+
+    def test_invalid_method(self):
+        self.assertRaises(ValueError, LogCompressor, self.tmpdir, "test", "lzma")
+
+    @mock.patch.object(log_compressor, "zstandard", None)
+    def test_zstd_unavailable(self):
+        self.assertRaises(ValueError, LogCompressor, self.tmpdir, "test", "zstd")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,199 @@
+# @file log_reader.py
+#
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+
+import calendar
+import gzip
+import logging
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import mock
+
+from metaswitch.common import log_reader
+from metaswitch.common.log_reader import (LogFile,
+                                          find_log_files,
+                                          iter_log_records)
+from metaswitch.common.logging_config import THREAD_FORMAT, JsonFormatter
+
+# 2017-03-01 12:00 UTC.
+HOUR = calendar.timegm((2017, 3, 1, 12, 0, 0))
+
+
+def format_record(formatter, created, msg, level=logging.INFO, exc_info=None):
+    record = logging.LogRecord("test", level, "test.py", 1, msg, None, exc_info)
+    record.created = created
+    record.msecs = (created - int(created)) * 1000
+    formatter.converter = time.gmtime
+    return formatter.format(record) + "\n"
+
+
+class LogReaderTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_log(self, prefix, hour, records, formatter=THREAD_FORMAT, compress=None):
+        """Writes a log file of records, each a (time, message, level) tuple
+        of the time as an offset from the start of the hour, the message and
+        the level.  compress is "gzip" or "zstd" to write a compressed
+        file (or True for gzip)."""
+        name = "{}_{}.txt".format(prefix, time.strftime("%Y%m%dT%H0000Z", time.gmtime(hour)))
+        path = os.path.join(self.tmpdir, name)
+        data = "".join(format_record(formatter, hour + offset, msg, level)
+                       for offset, msg, level in records)
+        if compress == "zstd":
+            path += ".zst"
+            with open(path, "wb") as f:
+                f.write(log_reader.zstandard.ZstdCompressor().compress(data))
+        elif compress:
+            path += ".gz"
+            with gzip.open(path, "wb") as f:
+                f.write(data)
+        else:
+            with open(path, "wb") as f:
+                f.write(data)
+        return path
+
+    def messages(self, entries):
+        return [entry.text.split(": ", 1)[1] for entry in entries]
+
+    def test_records(self):
+        """Records are read in order, with their timestamp and level."""
+        path = self.write_log("test", HOUR, [(0.5, "first", logging.INFO),
+                                              (1, "second", logging.ERROR)])
+        entries = list(LogFile(path).records())
+        self.assertEqual([(e.timestamp, e.level) for e in entries],
+                         [(HOUR + 0.5, "INFO"), (HOUR + 1, "ERROR")])
+        self.assertEqual(self.messages(entries), ["first", "second"])
+        self.assertEqual(entries[0].filename, path)
+
+    def test_multi_line_records(self):
+        """Lines that don't start a record belong to the previous record."""
+        path = self.write_log("test", HOUR, [(0, "first\nTraceback:\n  line 1", logging.ERROR),
+                                              (1, "second", logging.INFO)])
+        entries = list(LogFile(path).records())
+        self.assertEqual(self.messages(entries),
+                         ["first\nTraceback:\n  line 1", "second"])
+
+    def test_time_range(self):
+        """Records can be found by time, using the index."""
+        path = self.write_log("test", HOUR, [(i, "record %d" % i, logging.INFO)
+                                              for i in xrange(0, 3600, 2)])
+        log_file = LogFile(path, index_interval=1000)
+        timestamps, offsets = log_file.index()
+        self.assertGreater(len(offsets), 50)
+        self.assertEqual(timestamps, sorted(timestamps))
+
+        entries = list(log_file.records(start=HOUR + 1001, end=HOUR + 1010))
+        self.assertEqual(self.messages(entries),
+                         ["record %d" % i for i in xrange(1002, 1011, 2)])
+        self.assertEqual(list(log_file.records(start=HOUR + 3600)), [])
+        self.assertEqual(len(list(log_file.records(end=HOUR + 10))), 6)
+
+    def test_index_cached(self):
+        """The index is only built once for an unchanged file."""
+        path = self.write_log("test", HOUR, [(i, "record %d" % i, logging.INFO)
+                                              for i in xrange(100)])
+        with mock.patch.object(log_reader, "_build_index",
+                               wraps=log_reader._build_index) as mock_build:
+            list(LogFile(path).records(start=HOUR + 50))
+            list(LogFile(path).records(start=HOUR + 60))
+            self.assertEqual(mock_build.call_count, 1)
+
+            with open(path, "a") as f:
+                f.write(format_record(THREAD_FORMAT, HOUR + 100, "record 100"))
+            entries = list(LogFile(path).records(start=HOUR + 99))
+            self.assertEqual(mock_build.call_count, 2)
+        self.assertEqual(self.messages(entries), ["record 99", "record 100"])
+
+    def test_level(self):
+        path = self.write_log("test", HOUR, [(0, "debug", logging.DEBUG),
+                                              (1, "warning", logging.WARNING),
+                                              (2, "error", logging.ERROR)])
+        self.assertEqual(self.messages(LogFile(path).records(min_level="WARNING")),
+                         ["warning", "error"])
+        self.assertEqual(self.messages(LogFile(path).records(min_level=logging.ERROR)),
+                         ["error"])
+
+    def test_json(self):
+        """Files in the JSON output format can be read too."""
+        path = self.write_log("test", HOUR, [(0, "first", logging.DEBUG),
+                                              (1.25, "second", logging.ERROR)],
+                              formatter=JsonFormatter())
+        entries = list(LogFile(path).records(min_level="INFO"))
+        self.assertEqual([(e.timestamp, e.level) for e in entries],
+                         [(HOUR + 1.25, "ERROR")])
+
+    def test_empty_file(self):
+        path = self.write_log("test", HOUR, [])
+        self.assertEqual(list(LogFile(path).records(start=HOUR)), [])
+
+    def test_compressed(self):
+        """Compressed files are decompressed in chunks and indexed like
+        uncompressed ones."""
+        records = [(i, "record %d" % i, logging.INFO) for i in xrange(1000)]
+        path = self.write_log("test", HOUR, records, compress=True)
+        with mock.patch.object(log_reader, "_DECOMPRESS_CHUNK_SIZE", 1024):
+            log_file = LogFile(path, index_interval=1024)
+        self.assertGreater(len(log_file.index()[1]), 10)
+        entries = list(log_file.records(start=HOUR + 500, end=HOUR + 501))
+        log_file.close()
+        self.assertEqual(self.messages(entries), ["record 500", "record 501"])
+
+    @unittest.skipUnless(log_reader.zstandard, "zstandard isn't installed")
+    def test_zstd(self): #pragma: no cover
+        path = self.write_log("test", HOUR, [(0, "first", logging.INFO)], compress="zstd")
+        self.assertEqual(find_log_files(self.tmpdir, "test"), [path])
+        self.assertEqual(self.messages(LogFile(path).records()), ["first"])
+
+    @mock.patch.object(log_reader, "zstandard", None)
+    def test_zstd_unavailable(self):
+        """zstd-compressed files are found, but can't be read without the
+        zstandard module."""
+        path = os.path.join(self.tmpdir, "test_20170301T120000Z.txt.zst")
+        open(path, "wb").close()
+        self.assertEqual(find_log_files(self.tmpdir, "test"), [path])
+        self.assertRaises(ValueError, LogFile, path)
+
+    def test_find_log_files(self):
+        """Files are found by prefix and hour, preferring an uncompressed
+        file to a compressed one for the same hour."""
+        first = self.write_log("test", HOUR - 3600, [], compress=True)
+        second = self.write_log("test", HOUR, [])
+        self.write_log("test", HOUR, [], compress=True)
+        self.write_log("test-2", HOUR, [])
+        self.assertEqual(find_log_files(self.tmpdir, "test"), [first, second])
+        self.assertEqual(find_log_files(self.tmpdir, "test", start=HOUR), [second])
+        self.assertEqual(find_log_files(self.tmpdir, "test", end=HOUR - 1), [first])
+
+    def test_merge(self):
+        """Records for several prefixes, across hours and compressed files,
+        are merged into timestamp order."""
+        self.write_log("test-1", HOUR - 3600, [(3599, "1a", logging.INFO)], compress=True)
+        self.write_log("test-1", HOUR, [(1, "1b", logging.INFO),
+                                         (4, "1c", logging.INFO)])
+        self.write_log("test-2", HOUR, [(0, "2a", logging.INFO),
+                                         (2, "2b", logging.INFO),
+                                         (5, "2c", logging.INFO)])
+        entries = iter_log_records(self.tmpdir, ["test-1", "test-2"])
+        self.assertEqual(self.messages(entries), ["1a", "2a", "1b", "2b", "1c", "2c"])
+
+        entries = iter_log_records(self.tmpdir, ["test-1", "test-2"],
+                                   start=HOUR + 1, end=HOUR + 4)
+        self.assertEqual(self.messages(entries), ["1b", "2b", "1c"])
+
+
+if __name__ == "__main__":
+    unittest.main()
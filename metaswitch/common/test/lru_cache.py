@@ -0,0 +1,72 @@
+# @file lru_cache.py
+#
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+
+import unittest
+
+from metaswitch.common.lru_cache import LRUCache
+
+class LRUCacheTestCase(unittest.TestCase):
+    def test_get_put(self):
+        """Values can be cached and looked up, and lookups are counted."""
+        cache = LRUCache(2)
+        self.assertEquals(cache.get("a"), None)
+        self.assertEquals(cache.get("a", "default"), "default")
+        cache.put("a", 1)
+        self.assertEquals(cache.get("a"), 1)
+        cache.put("a", 2)
+        self.assertEquals(cache.get("a"), 2)
+        self.assertEquals(len(cache), 1)
+        self.assertEquals((cache.hits, cache.misses), (2, 2))
+
+    def test_eviction(self):
+        """The least recently used entry is evicted when the cache is full."""
+        cache = LRUCache(3)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.put("c", 3)
+        cache.get("a")
+        cache.put("d", 4)
+        self.assertFalse("b" in cache)
+        self.assertTrue("a" in cache)
+        cache.put("e", 5)
+        self.assertFalse("c" in cache)
+        self.assertEquals(len(cache), 3)
+        self.assertEquals(cache.evictions, 2)
+        self.assertEquals([cache.get(k) for k in "ade"], [1, 4, 5])
+
+    def test_pop(self):
+        """Entries can be removed."""
+        cache = LRUCache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEquals(cache.pop("a"), 1)
+        self.assertEquals(cache.pop("a", "default"), "default")
+        cache.put("c", 3)
+        cache.put("d", 4)
+        self.assertEquals(cache.evictions, 1)
+        self.assertFalse("b" in cache)
+        self.assertEquals([cache.get(k) for k in "cd"], [3, 4])
+
+    def test_clear(self):
+        """Clearing the cache removes entries and resets the counters."""
+        cache = LRUCache(3)
+        cache.put("a", 1)
+        cache.get("a")
+        cache.clear()
+        self.assertEquals(len(cache), 0)
+        self.assertEquals(cache.hits, 0)
+        self.assertEquals(cache.get("a"), None)
+
+    def test_bad_size(self):
+        """The cache must have room for something."""
+        self.assertRaises(ValueError, LRUCache, 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -6,7 +6,9 @@
 # Metaswitch Networks in a separate written agreement.
 
 import unittest
-from metaswitch.common.phonenumber_utils import format_phone_number
+import mock
+from metaswitch.common.phonenumber_utils import (format_phone_number,
+                                                 PhoneNumberFormatter)
 
 class PhonenumberUtilTestCase(unittest.TestCase):
     def testValidUSDN(self):
@@ -17,5 +19,55 @@ class PhonenumberUtilTestCase(unittest.TestCase):
         number = format_phone_number('+991 415 513-1500')
         self.assertEqual(number, '+991 415 513-1500', msg="Failed to return original number on error")
 
+    def testRegion(self):
+        formatter = PhoneNumberFormatter(region="GB")
+        self.assertEqual(formatter.format('02079460000'), '020 7946 0000')
+        self.assertEqual(formatter.format('not a number'), 'not a number')
+
+    @mock.patch('metaswitch.common.phonenumber_utils.phonenumbers.parse',
+                side_effect=Exception)
+    def testCache(self, mock_parse):
+        formatter = PhoneNumberFormatter(cache_size=2)
+        for _ in xrange(3):
+            self.assertEqual(formatter.format('1234'), '1234')
+        self.assertEqual(mock_parse.call_count, 1)
+        self.assertEqual((formatter.hits, formatter.misses), (2, 1))
+
+    @mock.patch('metaswitch.common.phonenumber_utils.phonenumbers.parse',
+                side_effect=Exception)
+    def testNoCache(self, mock_parse):
+        formatter = PhoneNumberFormatter(cache_size=0)
+        formatter.format('1234')
+        formatter.format('1234')
+        self.assertEqual(mock_parse.call_count, 2)
+        self.assertEqual((formatter.hits, formatter.misses), (0, 0))
+
+    def testFormatMany(self):
+        formatter = PhoneNumberFormatter()
+        formatter.format('+1 415 513-1500')
+        numbers = ['+1 415 513-1500', '+991 415 513-1500', '+1 415 513-1500', '4155131501']
+        self.assertEqual(formatter.format_many(numbers),
+                         ['(415) 513-1500', '+991 415 513-1500', '(415) 513-1500', '(415) 513-1501'])
+        self.assertEqual(formatter.hits, 1)
+        self.assertEqual(formatter.format('4155131501'), '(415) 513-1501')
+        self.assertEqual(formatter.hits, 2)
+
+    def testFormatManyEmptyCache(self):
+        """The first batch formatted is cached, and counted as misses."""
+        formatter = PhoneNumberFormatter()
+        numbers = ['4155131500', '4155131501', '4155131500']
+        formatter.format_many(numbers)
+        self.assertEqual((formatter.hits, formatter.misses), (0, 2))
+        formatter.format_many(numbers)
+        self.assertEqual((formatter.hits, formatter.misses), (2, 2))
+
+    def testFormatManyInPool(self):
+        formatter = PhoneNumberFormatter(parallel_threshold=10)
+        numbers = ['415513%04d' % i for i in xrange(100)] + ['bad']
+        expected = ['(415) 513-%04d' % i for i in xrange(100)] + ['bad']
+        self.assertEqual(formatter.format_many(numbers, processes=2), expected)
+        self.assertEqual(formatter.format_many(numbers, processes=2), expected)
+        self.assertEqual(formatter.hits, 101)
+
 if __name__ == "__main__":
     unittest.main()
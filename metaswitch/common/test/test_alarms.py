@@ -11,6 +11,7 @@ import mock
 import threading
 import time
 import logging
+from monotonic import monotonic
 
 _log = logging.getLogger()
 
@@ -18,8 +19,11 @@ from metaswitch.common.alarms import (AlarmState,
                                       BaseAlarm,
                                       Alarm,
                                       MultiSeverityAlarm,
+                                      BATCH_RETRY_INTERVAL,
+                                      NO_REPLY_BACKOFF,
                                       CLEARED,
-                                      _AlarmManager)
+                                      _AlarmManager,
+                                      _issue_alarms)
 
 
 class TimeoutError(Exception):
@@ -66,23 +70,191 @@ class TestAlarmState(unittest.TestCase):
                                                   '1000.6'])
 
 
-class TestBaseAlarm(unittest.TestCase):
+def batching_state(confirmed=False, retry_at=0):
+    """Patches whether the alarm agent is known to accept batches of
+    alarms."""
+    return mock.patch.multiple('metaswitch.common.alarms',
+                               _batching_confirmed=confirmed,
+                               _batch_retry_at=retry_at,
+                               _no_reply_backoff=NO_REPLY_BACKOFF)
+
+
+def agent_reply(capabilities="issue-alarm issue-alarms get-capabilities"):
+    """Returns a sendrequest side effect for an alarm agent with the given
+    capabilities, that accepts every other request."""
+    return lambda request: capabilities if request == ['get-capabilities'] else "ok"
+
+
+def requests_sent(mock_sendrequest):
+    return sorted(args[0] for args, _ in mock_sendrequest.call_args_list)
+
+
+class TestIssueAlarms(unittest.TestCase):
+    @batching_state()
+    @mock.patch('metaswitch.common.alarms._sendrequest')
+    def test_issue_single(self, mock_sendrequest):
+        """A single alarm is sent with the original request, without asking
+        about batches."""
+        _issue_alarms({'TestIssuer': ['1000.4']})
+        mock_sendrequest.assert_called_once_with(['issue-alarm',
+                                                  'TestIssuer',
+                                                  '1000.4'])
+
+    @batching_state()
+    @mock.patch('metaswitch.common.alarms.monotonic')
+    @mock.patch('metaswitch.common.alarms._sendrequest')
+    def test_not_confirmed(self, mock_sendrequest, mock_monotonic):
+        """Alarms are sent individually unless the alarm agent lists batches
+        in its capabilities, even if it replies "ok" to everything."""
+        mock_sendrequest.return_value = "ok"
+        mock_monotonic.return_value = 100
+        _issue_alarms({'TestIssuer': ['1000.4', '2000.3']})
+        self.assertEqual(requests_sent(mock_sendrequest),
+                         [['get-capabilities'],
+                          ['issue-alarm', 'TestIssuer', '1000.4'],
+                          ['issue-alarm', 'TestIssuer', '2000.3']])
+
+        # The alarm agent isn't asked again for a while.
+        mock_sendrequest.reset_mock()
+        mock_monotonic.return_value = 100 + BATCH_RETRY_INTERVAL - 1
+        _issue_alarms({'TestIssuer': ['1000.4', '2000.3']})
+        self.assertEqual(requests_sent(mock_sendrequest),
+                         [['issue-alarm', 'TestIssuer', '1000.4'],
+                          ['issue-alarm', 'TestIssuer', '2000.3']])
+
+        mock_sendrequest.reset_mock()
+        mock_monotonic.return_value = 100 + BATCH_RETRY_INTERVAL
+        _issue_alarms({'TestIssuer': ['1000.4', '2000.3']})
+        self.assertIn(['get-capabilities'], requests_sent(mock_sendrequest))
+
+    @batching_state()
+    @mock.patch('metaswitch.common.alarms._sendrequest')
+    def test_confirmed(self, mock_sendrequest):
+        """Once the alarm agent has said that it accepts batches, the alarms
+        for an issuer are sent in a single request."""
+        mock_sendrequest.side_effect = agent_reply()
+        _issue_alarms({'TestIssuer': ['1000.4', '2000.3']})
+        self.assertEqual(len(requests_sent(mock_sendrequest)), 3)
+
+        mock_sendrequest.reset_mock()
+        _issue_alarms({'TestIssuer': ['1000.4', '2000.3']})
+        mock_sendrequest.assert_called_once_with(['issue-alarms',
+                                                  'TestIssuer',
+                                                  '1000.4',
+                                                  '2000.3'])
+
+    @batching_state(confirmed=True)
+    @mock.patch('metaswitch.common.alarms.monotonic')
+    @mock.patch('metaswitch.common.alarms._sendrequest')
+    def test_batch_rejected(self, mock_sendrequest, mock_monotonic):
+        """If the alarm agent rejects a batch, the alarms are sent
+        individually, and batches aren't used until it says it accepts them
+        again."""
+        mock_sendrequest.return_value = "error"
+        mock_monotonic.return_value = 100
+        _issue_alarms({'TestIssuer': ['1000.4', '2000.3']})
+        self.assertEqual(requests_sent(mock_sendrequest),
+                         [['issue-alarm', 'TestIssuer', '1000.4'],
+                          ['issue-alarm', 'TestIssuer', '2000.3'],
+                          ['issue-alarms', 'TestIssuer', '1000.4', '2000.3']])
+
+        mock_sendrequest.reset_mock()
+        mock_monotonic.return_value = 100 + BATCH_RETRY_INTERVAL - 1
+        _issue_alarms({'TestIssuer': ['1000.4', '2000.3']})
+        self.assertEqual(len(requests_sent(mock_sendrequest)), 2)
+
+        mock_sendrequest.reset_mock()
+        mock_sendrequest.side_effect = agent_reply()
+        mock_monotonic.return_value = 100 + BATCH_RETRY_INTERVAL
+        _issue_alarms({'TestIssuer': ['1000.4', '2000.3']})
+        self.assertEqual(len(requests_sent(mock_sendrequest)), 3)
+        mock_sendrequest.reset_mock()
+        _issue_alarms({'TestIssuer': ['1000.4', '2000.3']})
+        self.assertEqual(mock_sendrequest.call_count, 1)
+
+    @batching_state(confirmed=True)
+    @mock.patch('metaswitch.common.alarms._sendrequest')
+    def test_batch_no_reply(self, mock_sendrequest):
+        """If the alarm agent doesn't reply to a batch, the alarms are sent
+        individually and in parallel, and batches aren't sent again until
+        a backoff interval has passed."""
+        def sendrequest(request):
+            time.sleep(0.5)
+        mock_sendrequest.side_effect = sendrequest
+        identifiers = ['{}.4'.format(index) for index in range(1000, 1016)]
+
+        start = time.time()
+        _issue_alarms({'TestIssuer': identifiers})
+        self.assertLess(time.time() - start, 1.5)
+        self.assertEqual(len(requests_sent(mock_sendrequest)), 17)
+
+        mock_sendrequest.reset_mock()
+        mock_sendrequest.side_effect = None
+        _issue_alarms({'TestIssuer': identifiers})
+        self.assertEqual(len(requests_sent(mock_sendrequest)), 16)
+
+        mock_sendrequest.reset_mock()
+        mock_sendrequest.return_value = "ok"
+        with mock.patch('metaswitch.common.alarms.monotonic',
+                        return_value=monotonic() + NO_REPLY_BACKOFF):
+            _issue_alarms({'TestIssuer': identifiers})
+        self.assertEqual(mock_sendrequest.call_count, 1)
+
+    @batching_state()
+    @mock.patch('metaswitch.common.alarms.monotonic')
+    @mock.patch('metaswitch.common.alarms._sendrequest')
+    def test_capabilities_no_reply(self, mock_sendrequest, mock_monotonic):
+        """If the alarm agent doesn't reply to a capabilities request, it
+        isn't asked again until a backoff interval has passed, which
+        doubles each time."""
+        mock_sendrequest.return_value = None
+        for now, asked in ((100, True),
+                           (100 + NO_REPLY_BACKOFF - 1, False),
+                           (100 + NO_REPLY_BACKOFF, True),
+                           (100 + 3 * NO_REPLY_BACKOFF - 1, False),
+                           (100 + 3 * NO_REPLY_BACKOFF, True)):
+            mock_sendrequest.reset_mock()
+            mock_monotonic.return_value = now
+            _issue_alarms({'TestIssuer': ['1000.4', '2000.3']})
+            self.assertEqual(['get-capabilities'] in requests_sent(mock_sendrequest),
+                             asked)
+
+
+class AlarmTestCase(unittest.TestCase):
+    """Base class for tests of alarms, which are delivered by an alarm
+    manager of their own."""
+
+    def setUp(self):
+        patcher = mock.patch('metaswitch.common.alarms.atexit', autospec=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.alarm_manager = TestAlarmManager()
+        self.addCleanup(self.terminate_alarm_manager)
+
+    def terminate_alarm_manager(self):
+        if self.alarm_manager.is_alive():
+            self.alarm_manager.safe_terminate()
+
+
+class TestBaseAlarm(AlarmTestCase):
     @mock.patch('metaswitch.common.alarms._sendrequest')
     def test_clear_base_alarm(self, mock_sendrequest):
         """Alarms can be cleared."""
-        base_alarm = BaseAlarm('TestIssuer', 1000)
+        base_alarm = BaseAlarm('TestIssuer', 1000, self.alarm_manager)
         base_alarm.clear()
+        self.alarm_manager.flush()
         mock_sendrequest.assert_called_once_with(['issue-alarm',
                                                   'TestIssuer',
                                                   '1000.1'])
 
 
-class TestAlarm(unittest.TestCase):
+class TestAlarm(AlarmTestCase):
     @mock.patch('metaswitch.common.alarms._sendrequest')
     def test_set_alarm(self, mock_sendrequest):
         """Alarms can be set."""
-        alarm = Alarm('TestIssuer', 1000, 3)
+        alarm = Alarm('TestIssuer', 1000, 3, self.alarm_manager)
         alarm.set()
+        self.alarm_manager.flush()
         mock_sendrequest.assert_called_once_with(['issue-alarm',
                                                   'TestIssuer',
                                                   '1000.3'])
@@ -91,25 +263,122 @@ class TestAlarm(unittest.TestCase):
     @mock.patch('metaswitch.common.alarms._sendrequest')
     def test_clear_alarm(self, mock_sendrequest):
         """Alarm can be cleared after they are set."""
-        alarm = Alarm('TestIssuer', 1000, 3)
+        alarm = Alarm('TestIssuer', 1000, 3, self.alarm_manager)
         alarm.set()
+        self.alarm_manager.flush()
         alarm.clear()
+        self.alarm_manager.flush()
         mock_sendrequest.assert_called_with(['issue-alarm',
                                              'TestIssuer',
                                              '1000.1'])
 
+    @mock.patch('metaswitch.common.alarms._sendrequest')
+    def test_set_does_not_block(self, mock_sendrequest):
+        """Setting an alarm returns straight away, even if the alarm agent is
+        slow to respond."""
+        gate = threading.Event()
+        mock_sendrequest.side_effect = lambda request: gate.wait(5)
+        alarm = Alarm('TestIssuer', 1000, 3, self.alarm_manager)
+
+        start = time.time()
+        alarm.set()
+        alarm.clear()
+        self.assertLess(time.time() - start, 1)
+        gate.set()
+        self.alarm_manager.flush()
+
+    @mock.patch('metaswitch.common.alarms._sendrequest')
+    def test_set_after_terminate(self, mock_sendrequest):
+        """Alarm states changed after the manager has been terminated are
+        delivered straight away, rather than lost."""
+        alarm = Alarm('TestIssuer', 1000, 3, self.alarm_manager)
+        alarm.set()
+        self.alarm_manager.flush()
+        self.alarm_manager.safe_terminate()
+        mock_sendrequest.reset_mock()
+
+        alarm.clear()
+        mock_sendrequest.assert_called_once_with(['issue-alarm',
+                                                  'TestIssuer',
+                                                  '1000.1'])
+
+        # Nothing is sent if the state hasn't changed.
+        alarm.clear()
+        self.assertEqual(mock_sendrequest.call_count, 1)
+
+    @batching_state(confirmed=True)
+    @mock.patch('metaswitch.common.alarms._sendrequest')
+    def test_coalesce(self, mock_sendrequest):
+        """Only the latest state of an alarm is delivered, and nothing is
+        delivered if the state hasn't changed."""
+        gate = threading.Event()
+        mock_sendrequest.side_effect = lambda request: gate.wait(5) and "ok"
+        alarm1 = Alarm('TestIssuer', 1000, 3, self.alarm_manager)
+        alarm2 = Alarm('TestIssuer', 2000, 3, self.alarm_manager)
+
+        # Hold up delivery of the first change while the alarms flap.
+        alarm1.clear()
+        time.sleep(0.1)
+        for _ in range(5):
+            alarm1.set()
+            alarm1.clear()
+            alarm2.set()
+            alarm2.clear()
+        alarm1.set()
+        alarm2.set()
+        alarm2.clear()
+        gate.set()
+        self.alarm_manager.flush()
+
+        self.assertEqual(mock_sendrequest.call_args_list,
+                         [mock.call(['issue-alarm', 'TestIssuer', '1000.1']),
+                          mock.call(['issue-alarms', 'TestIssuer', '1000.3', '2000.1'])])
+
+        # Clearing an alarm that is already cleared sends nothing.
+        mock_sendrequest.reset_mock()
+        alarm2.clear()
+        self.alarm_manager.flush()
+        self.assertFalse(mock_sendrequest.called)
 
-class TestMultiSeverityAlarm(unittest.TestCase):
+    @batching_state()
+    @mock.patch('metaswitch.common.alarms._sendrequest')
+    def test_coalesce_unconfirmed(self, mock_sendrequest):
+        """Coalesced changes are sent with a request per alarm until the alarm
+        agent says it accepts batches, even if it replies "ok" to
+        anything."""
+        gate = threading.Event()
+        mock_sendrequest.side_effect = lambda request: gate.wait(5) and "ok"
+        alarm1 = Alarm('TestIssuer', 1000, 3, self.alarm_manager)
+        alarm2 = Alarm('TestIssuer', 2000, 3, self.alarm_manager)
+
+        alarm1.clear()
+        time.sleep(0.1)
+        alarm1.set()
+        alarm2.set()
+        alarm2.clear()
+        gate.set()
+        self.alarm_manager.flush()
+
+        self.assertEqual(requests_sent(mock_sendrequest),
+                         [['get-capabilities'],
+                          ['issue-alarm', 'TestIssuer', '1000.1'],
+                          ['issue-alarm', 'TestIssuer', '1000.3'],
+                          ['issue-alarm', 'TestIssuer', '2000.1']])
+
+
+class TestMultiSeverityAlarm(AlarmTestCase):
     @mock.patch('metaswitch.common.alarms._sendrequest')
     def test_set_multi_severity_alarm(self, mock_sendrequest):
         """Multiple severities can be raised."""
-        alarm = MultiSeverityAlarm('TestIssuer', 1000, [3, 6])
+        alarm = MultiSeverityAlarm('TestIssuer', 1000, [3, 6], self.alarm_manager)
         alarm.set(3)
+        self.alarm_manager.flush()
         mock_sendrequest.assert_called_once_with(['issue-alarm',
                                                   'TestIssuer',
                                                   '1000.3'])
         mock_sendrequest.reset_mock()
         alarm.set(6)
+        self.alarm_manager.flush()
         mock_sendrequest.assert_called_once_with(['issue-alarm',
                                                   'TestIssuer',
                                                   '1000.6'])
@@ -117,7 +386,7 @@ class TestMultiSeverityAlarm(unittest.TestCase):
     @mock.patch('metaswitch.common.alarms._sendrequest')
     def test_bad_multi_severity_alarm(self, mock_sendrequest):
         """Attempting to raise an alarm with the wrong severity fails."""
-        alarm = MultiSeverityAlarm('TestIssuer', 1000, [3, 6])
+        alarm = MultiSeverityAlarm('TestIssuer', 1000, [3, 6], self.alarm_manager)
         self.assertRaises(KeyError, alarm.set, 5)
 
 
@@ -282,6 +551,70 @@ class TestAlarmManagerReSync(unittest.TestCase):
         finally:
             alarm_manager.safe_terminate()
 
+    @batching_state(retry_at=float('inf'))
+    @mock.patch('metaswitch.common.alarms._sendrequest')
+    @mock.patch('metaswitch.common.alarms.atexit', autospec=True)
+    def test_concurrent_resync(self, mock_atexit, mock_sendrequest):
+        """Check that a re-sync pass sends alarms in parallel, so that it
+        doesn't take much longer than one slow request, when the alarm agent
+        doesn't support batches of alarms."""
+        mock_sendrequest.side_effect = lambda request: time.sleep(0.5)
+        alarm_manager = TestAlarmManager()
+
+        with mock.patch.object(alarm_manager, 'start'):
+            alarms = [alarm_manager.get_alarm('DummyIssuer', (index, CLEARED, 4))
+                      for index in range(1000, 1016)]
+        for alarm in alarms:
+            alarm._last_state_raised = alarm._alarm_state
+
+        start = time.time()
+        alarm_manager._re_sync_alarms()
+        self.assertLess(time.time() - start, 1.5)
+        self.assertEqual(sorted(args[0][2] for args, _ in mock_sendrequest.call_args_list),
+                         ['{}.4'.format(index) for index in range(1000, 1016)])
+
+    @batching_state(retry_at=float('inf'))
+    @mock.patch('metaswitch.common.alarms._sendrequest')
+    @mock.patch('metaswitch.common.alarms.atexit', autospec=True)
+    def test_resync_failure(self, mock_atexit, mock_sendrequest):
+        """Check that a failure to re-sync one alarm doesn't stop the others
+        being re-synced."""
+        mock_sendrequest.side_effect = [Exception("Failed"), None]
+        alarm_manager = TestAlarmManager()
+
+        with mock.patch.object(alarm_manager, 'start'):
+            alarms = [alarm_manager.get_alarm('DummyIssuer', (index, CLEARED, 4))
+                      for index in (1000, 2000)]
+        for alarm in alarms:
+            alarm._last_state_raised = alarm._alarm_state
+
+        alarm_manager._re_sync_alarms()
+        self.assertEqual(len(requests_sent(mock_sendrequest)), 2)
+
+    @batching_state(confirmed=True)
+    @mock.patch('metaswitch.common.alarms._sendrequest')
+    @mock.patch('metaswitch.common.alarms.atexit', autospec=True)
+    def test_batched_resync(self, mock_atexit, mock_sendrequest):
+        """Check that a re-sync pass sends one request per issuer when the
+        alarm agent supports batches of alarms."""
+        mock_sendrequest.return_value = "ok"
+        alarm_manager = TestAlarmManager()
+
+        with mock.patch.object(alarm_manager, 'start'):
+            alarms = [alarm_manager.get_alarm(issuer, (index, CLEARED, 4))
+                      for issuer in ('Issuer1', 'Issuer2')
+                      for index in (1000, 2000, 3000)]
+        for alarm in alarms[:-1]:
+            alarm._last_state_raised = alarm._alarm_state
+
+        alarm_manager._re_sync_alarms()
+        requests = sorted(args[0] for args, _ in mock_sendrequest.call_args_list)
+        self.assertEqual(len(requests), 2)
+        self.assertEqual(requests[0][:2], ['issue-alarms', 'Issuer1'])
+        self.assertEqual(sorted(requests[0][2:]), ['1000.4', '2000.4', '3000.4'])
+        self.assertEqual(requests[1][:2], ['issue-alarms', 'Issuer2'])
+        self.assertEqual(sorted(requests[1][2:]), ['1000.4', '2000.4'])
+
     @mock.patch('metaswitch.common.alarms._sendrequest')
     @mock.patch('metaswitch.common.alarms.atexit', autospec=True)
     def test_start_once(self, mock_atexit, mock_sendrequest):
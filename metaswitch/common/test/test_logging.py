@@ -7,11 +7,75 @@
 
 import unittest
 import re
+import json
 import logging
+import os
+import sys
+import shutil
+import socket
+import tempfile
+import threading
+import time
 import mock
+from logging.handlers import SysLogHandler
 from metaswitch.common.logging_config import (configure_logging,
                                               configure_test_logging,
-                                              configure_syslog)
+                                              configure_syslog,
+                                              AsyncLogHandler,
+                                              BatchingSysLogHandler,
+                                              ClearwaterFormatter,
+                                              ClearwaterLogHandler,
+                                              FlightRecorderHandler,
+                                              JsonFormatter,
+                                              OUTPUT_JSON,
+                                              get_flight_recorder,
+                                              read_flight_recorder,
+                                              set_log_level,
+                                              ThrottlingFilter,
+                                              THROTTLE_BY_LOGGER,
+                                              _handler_levels,
+                                              THREAD_FORMAT,
+                                              OVERFLOW_BLOCK,
+                                              OVERFLOW_DROP_DEBUG_FIRST,
+                                              OVERFLOW_DROP_OLDEST)
+
+
+class ListHandler(logging.Handler):
+    """Handler that remembers the messages it is asked to log.  It can be
+    made to wait until released, to simulate a slow disk."""
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+        self.started = threading.Event()
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def emit(self, record):
+        self.started.set()
+        self.gate.wait()
+        self.messages.append(record.getMessage())
+
+
+def track_level(mock_class):
+    """Makes the handler created from a mocked handler class store the level
+    it is given as a number, as a real handler does."""
+    handler = mock_class.return_value
+
+    def set_level(level):
+        if isinstance(level, basestring):
+            level = logging.getLevelName(level)
+        handler.level = level
+
+    handler.setLevel.side_effect = set_level
+    return handler
+
+
+def make_record(msg, level=logging.INFO, args=None, created=None):
+    record = logging.LogRecord("test", level, "test.py", 1, msg, args, None)
+    if created is not None:
+        record.created = created
+        record.msecs = (created - int(created)) * 1000
+    return record
 
 
 class LoggingTestCase(unittest.TestCase):
@@ -43,13 +107,843 @@ class LoggingTestCase(unittest.TestCase):
                 autospec=True)
     def test_syslog(self, mock_syslog):
         """Test that messages are logged to syslog."""
+        track_level(mock_syslog)
         configure_syslog("test_logging", logging.DEBUG)
-        mock_syslog.return_value.level = logging.DEBUG
         log = logging.getLogger()
         log.info("Try writing a log")
 
         self.assertTrue(mock_syslog.return_value.handle.called)
 
+    @mock.patch('metaswitch.common.logging_config.SysLogHandler',
+                autospec=True)
+    def test_root_level(self, mock_syslog):
+        """Logs below the configured level are discarded by the logger."""
+        track_level(mock_syslog)
+        configure_syslog("test_logging", logging.INFO)
+        self.assertEqual(logging.getLogger().level, logging.INFO)
+
+        log = logging.getLogger("test")
+        log.debug("Discarded")
+        self.assertFalse(mock_syslog.return_value.handle.called)
+        log.info("Logged")
+        self.assertTrue(mock_syslog.return_value.handle.called)
+
+    @mock.patch('metaswitch.common.logging_config.SysLogHandler',
+                autospec=True)
+    def test_set_log_level(self, mock_syslog):
+        """The log level can be changed at runtime."""
+        track_level(mock_syslog)
+        configure_syslog("test_logging", logging.WARNING)
+        set_log_level(logging.DEBUG)
+        mock_syslog.return_value.setLevel.assert_called_with(logging.DEBUG)
+        self.assertEqual(logging.getLogger().level, logging.DEBUG)
+
+        set_log_level(logging.ERROR)
+        self.assertEqual(logging.getLogger().level, logging.ERROR)
+
+    @mock.patch('metaswitch.common.logging_config.ClearwaterLogHandler')
+    def test_level_name(self, mock_handler):
+        """Levels can be given by name, but are compared as numbers."""
+        track_level(mock_handler)
+        configure_logging("WARNING", ".", "prefix", flight_recorder_size=1000)
+        self.addCleanup(configure_test_logging)
+        self.assertEqual(sorted(_handler_levels.values()),
+                         [logging.DEBUG, logging.WARNING])
+        self.assertEqual(logging.getLogger().level, logging.DEBUG)
+
+        set_log_level("ERROR")
+        self.assertEqual(sorted(_handler_levels.values()),
+                         [logging.DEBUG, logging.ERROR])
+
+    def test_set_log_level_unconfigured(self):
+        configure_test_logging()
+        self.assertRaises(RuntimeError, set_log_level, logging.DEBUG)
+
+    @mock.patch('metaswitch.common.logging_config.ClearwaterLogHandler')
+    def test_root_level_flight_recorder(self, mock_handler):
+        """A flight recorder needs the logger to let through all levels."""
+        track_level(mock_handler)
+        configure_logging(logging.WARNING, ".", "prefix", flight_recorder_size=1000)
+        self.assertEqual(logging.getLogger().level, logging.DEBUG)
+        mock_handler.return_value.setLevel.assert_called_with(logging.WARNING)
+
+        # Reconfiguring removes the flight recorder.
+        configure_logging(logging.WARNING, ".", "prefix")
+        self.assertEqual(len(logging.getLogger().handlers), 1)
+        self.assertEqual(logging.getLogger().level, logging.WARNING)
+
+
+class AsyncLogHandlerTestCase(unittest.TestCase):
+    """Tests the asynchronous log handler."""
+
+    def make_blocked_handler(self, overflow_policy):
+        """Creates an AsyncLogHandler with a queue of 2 whose writer thread is
+        stuck writing a first record."""
+        target = ListHandler()
+        target.gate.clear()
+        handler = AsyncLogHandler(target, 2, overflow_policy)
+        self.addCleanup(handler.close)
+        self.addCleanup(target.gate.set)
+        handler.handle(make_record("first"))
+        self.assertTrue(target.started.wait(5))
+        return handler, target
+
+    def test_write(self):
+        """Records are written by the target handler, with their message
+        fixed when they are queued."""
+        target = ListHandler()
+        handler = AsyncLogHandler(target)
+        args = {"value": 1}
+        handler.handle(make_record("value %(value)s", args=(args,)))
+        args["value"] = 2
+        handler.flush()
+        self.assertEqual(target.messages, ["value 1"])
+
+        handler.handle(make_record("second"))
+        handler.close()
+        self.assertEqual(target.messages, ["value 1", "second"])
+        self.assertFalse(handler._thread.is_alive())
+
+    def test_drop_oldest(self):
+        """The oldest queued record is dropped when the queue is full."""
+        handler, target = self.make_blocked_handler(OVERFLOW_DROP_OLDEST)
+        for msg in ("a", "b", "c"):
+            handler.handle(make_record(msg))
+        target.gate.set()
+        handler.flush()
+        self.assertEqual(target.messages, ["first", "b", "c"])
+        self.assertEqual(handler.dropped, 1)
+
+    def test_drop_debug_first(self):
+        """Queued debug records are dropped before anything else."""
+        handler, target = self.make_blocked_handler(OVERFLOW_DROP_DEBUG_FIRST)
+        handler.handle(make_record("a"))
+        handler.handle(make_record("debug", logging.DEBUG))
+        handler.handle(make_record("b"))
+        handler.handle(make_record("new debug", logging.DEBUG))
+        handler.handle(make_record("c"))
+        target.gate.set()
+        handler.flush()
+        self.assertEqual(target.messages, ["first", "b", "c"])
+        self.assertEqual(handler.dropped, 3)
+        self.assertEqual(handler.dropped_debug, 2)
+
+    def test_drop_debug_first_mixed(self):
+        """Dropping debug records to make room keeps the order of the rest,
+        and falls back to dropping the oldest record once there are no
+        debug records left."""
+        handler, target = self.make_blocked_handler(OVERFLOW_DROP_DEBUG_FIRST)
+        handler.handle(make_record("debug 1", logging.DEBUG))
+        handler.handle(make_record("debug 2", logging.DEBUG))
+        for msg in ("a", "b", "c", "d"):
+            handler.handle(make_record(msg))
+        target.gate.set()
+        handler.flush()
+        self.assertEqual(target.messages, ["first", "c", "d"])
+        self.assertEqual(handler.dropped, 4)
+        self.assertEqual(handler.dropped_debug, 2)
+
+    def test_full_queue_no_debug(self):
+        """With the drop-debug-first policy and no DEBUG records queued, a
+        full queue keeps the newest records, as for drop-oldest."""
+        target = ListHandler()
+        target.gate.clear()
+        handler = AsyncLogHandler(target, 100, OVERFLOW_DROP_DEBUG_FIRST)
+        self.addCleanup(handler.close)
+        self.addCleanup(target.gate.set)
+        handler.handle(make_record("first"))
+        self.assertTrue(target.started.wait(5))
+
+        for i in xrange(1000):
+            handler.handle(make_record("info %d" % i))
+        target.gate.set()
+        handler.flush()
+        self.assertEqual(target.messages,
+                         ["first"] + ["info %d" % i for i in xrange(900, 1000)])
+        self.assertEqual(handler.dropped, 900)
+        self.assertEqual(handler.dropped_debug, 0)
+
+    def test_bad_arguments(self):
+        """A record whose message can't be formatted is reported by
+        handleError rather than raising into the caller."""
+        target = ListHandler()
+        handler = AsyncLogHandler(target)
+        self.addCleanup(handler.close)
+        with mock.patch.object(handler, "handleError") as mock_handle_error:
+            handler.handle(make_record("%s %s", args=(1,)))
+            self.assertEqual(mock_handle_error.call_count, 1)
+        handler.handle(make_record("next"))
+        handler.flush()
+        self.assertEqual(target.messages, ["next"])
+
+    def test_block(self):
+        """Logging waits for room in the queue."""
+        handler, target = self.make_blocked_handler(OVERFLOW_BLOCK)
+        handler.handle(make_record("a"))
+        handler.handle(make_record("b"))
+        blocked = threading.Thread(target=handler.handle, args=(make_record("c"),))
+        blocked.start()
+        blocked.join(0.2)
+        self.assertTrue(blocked.is_alive())
+
+        target.gate.set()
+        blocked.join(5)
+        handler.flush()
+        self.assertEqual(target.messages, ["first", "a", "b", "c"])
+        self.assertEqual(handler.dropped, 0)
+
+    def test_bad_policy(self):
+        self.assertRaises(ValueError, AsyncLogHandler, ListHandler(), 2, "drop-newest")
+
+    @mock.patch('metaswitch.common.logging_config._flush_on_sigterm')
+    @mock.patch('metaswitch.common.logging_config.ClearwaterLogHandler')
+    def test_configure_async(self, mock_handler, mock_flush_on_sigterm):
+        """configure_logging can write logs asynchronously."""
+        configure_logging(logging.DEBUG, ".", "test_log_prefix", asynchronous=True)
+        handler = logging.getLogger().handlers[0]
+        self.assertTrue(isinstance(handler, AsyncLogHandler))
+        self.assertEqual(handler.target, mock_handler.return_value)
+        mock_flush_on_sigterm.assert_called_once_with(handler)
+        handler.close()
+        configure_test_logging()
+
+
+class ClearwaterFormatterTestCase(unittest.TestCase):
+    """Tests the formatter and rollover check used on the logging hot path."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def make_formatters(self):
+        fmt = THREAD_FORMAT._fmt
+        datefmt = THREAD_FORMAT.datefmt
+        old_format = logging.Formatter(fmt, datefmt)
+        new_format = ClearwaterFormatter(fmt, datefmt)
+        old_format.converter = new_format.converter = time.gmtime
+        return old_format, new_format
+
+    def test_same_output(self):
+        """The output is the same as logging.Formatter's."""
+        old_format, new_format = self.make_formatters()
+        for created in (1000.0, 1000.5, 1000.999, 1001.0, 999.0, 1001.2):
+            record = make_record("msg", created=created)
+            self.assertEqual(new_format.format(record), old_format.format(record))
+
+        new_format.converter = time.localtime
+        record = make_record("msg", created=1001.2)
+        self.assertEqual(new_format.formatTime(record, "%H %Z"),
+                         time.strftime("%H %Z", time.localtime(1001.2)))
+        self.assertEqual(new_format.formatTime(record, "%S"), "41")
+
+    def test_should_rollover(self):
+        """The handler rolls over when a record is created in the next hour."""
+        handler = ClearwaterLogHandler(self.tmpdir, "test")
+        self.addCleanup(handler.close)
+        boundary = handler.next_file_change
+        self.assertFalse(handler.shouldRollover(make_record("msg", created=boundary - 0.001)))
+        self.assertTrue(handler.shouldRollover(make_record("msg", created=boundary)))
+
+
+class JsonFormatterTestCase(unittest.TestCase):
+    """Tests the JSON-lines output format."""
+
+    def format(self, record, tag=None):
+        formatter = JsonFormatter(tag)
+        formatter.converter = time.gmtime
+        return formatter.format(record)
+
+    def test_fields(self):
+        record = make_record("Handled request %d", args=(7,), created=1488371400.25)
+        record.threadName = "Worker-1"
+        self.assertEqual(json.loads(self.format(record)),
+                         {"timestamp": "2017-03-01T12:30:00.250Z",
+                          "level": "INFO",
+                          "file": "test.py",
+                          "line": 1,
+                          "thread": "Worker-1",
+                          "message": "Handled request 7"})
+
+    def test_extra_fields(self):
+        """Fields passed as extra are included, and anything that isn't
+        JSON is logged as its repr."""
+        record = make_record(u"caf\xe9", created=0)
+        record.__dict__.update({"request_id": "abc", "peer": ("1.2.3.4", 5060),
+                                "level_name": object, "_private": 1})
+        fields = json.loads(self.format(record))
+        self.assertEqual(fields["message"], u"caf\xe9")
+        self.assertEqual(fields["request_id"], "abc")
+        self.assertEqual(fields["peer"], ["1.2.3.4", 5060])
+        self.assertEqual(fields["level_name"], repr(object))
+        self.assertNotIn("_private", fields)
+
+    def test_exception(self):
+        try:
+            raise RuntimeError("Crashed")
+        except RuntimeError:
+            record = logging.LogRecord("test", logging.ERROR, "test.py", 1,
+                                       "Failed", None, sys.exc_info())
+        fields = json.loads(self.format(record))
+        self.assertIn("RuntimeError: Crashed", fields["exception"])
+
+    def test_tag(self):
+        """A tag for syslog is written before the object."""
+        line = self.format(make_record("msg", created=0), tag="my-process")
+        self.assertTrue(line.startswith("my-process: {"))
+        self.assertEqual(json.loads(line[len("my-process: "):])["message"], "msg")
+
+    def test_message_formatted_once(self):
+        record = make_record("value %d", args=(1,))
+        with mock.patch.object(record, "getMessage", wraps=record.getMessage) as m:
+            self.format(record)
+        self.assertEqual(m.call_count, 1)
+
+    @mock.patch('metaswitch.common.logging_config.ClearwaterLogHandler')
+    def test_configure(self, mock_handler):
+        track_level(mock_handler)
+        configure_logging(logging.INFO, ".", "prefix", output_format=OUTPUT_JSON)
+        self.addCleanup(configure_test_logging)
+        formatter = mock_handler.return_value.setFormatter.call_args[0][0]
+        self.assertTrue(isinstance(formatter, JsonFormatter))
+
+
+class BufferedLogHandlerTestCase(unittest.TestCase):
+    """Tests the buffered-write mode of ClearwaterLogHandler."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def make_handler(self, **kwargs):
+        handler = ClearwaterLogHandler(self.tmpdir, "test", **kwargs)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        self.addCleanup(handler.close)
+        return handler
+
+    def read_log(self, handler):
+        with open(handler.baseFilename) as f:
+            return f.read()
+
+    def test_flush_on_size(self):
+        """Records are written in one go once flush_bytes are waiting."""
+        handler = self.make_handler(buffered=True, flush_bytes=200, flush_interval=60)
+        with mock.patch('os.write', side_effect=os.write) as mock_write:
+            for i in xrange(10):
+                handler.handle(make_record("message %d" % i))
+            self.assertEqual(self.read_log(handler), "")
+            self.assertFalse(mock_write.called)
+
+            for i in xrange(10, 20):
+                handler.handle(make_record("message %d" % i))
+            self.assertEqual(mock_write.call_count, 1)
+
+        self.assertEqual(self.read_log(handler),
+                         "".join("message %d\n" % i for i in xrange(20)))
+
+    def test_flush_on_error(self):
+        """Errors are written immediately, along with anything waiting."""
+        handler = self.make_handler(buffered=True, flush_interval=60)
+        handler.handle(make_record("info"))
+        handler.handle(make_record("error", logging.ERROR))
+        self.assertEqual(self.read_log(handler), "info\nerror\n")
+
+    def test_flush_on_time(self):
+        """Records don't wait much longer than flush_interval."""
+        handler = self.make_handler(buffered=True, flush_interval=0.05)
+        handler.handle(make_record(u"unicode \xe9"))
+        time.sleep(0.5)
+        self.assertEqual(self.read_log(handler), "unicode \xc3\xa9\n")
+
+    def test_flush_on_close(self):
+        """Records are written when the handler is closed."""
+        handler = self.make_handler(buffered=True, flush_interval=60)
+        handler.handle(make_record("info"))
+        handler.close()
+        self.assertEqual(self.read_log(handler), "info\n")
+
+    def test_preallocate(self):
+        """Space is reserved without changing the file size."""
+        handler = self.make_handler(buffered=True, preallocate_bytes=1024 * 1024)
+        handler.handle(make_record("error", logging.ERROR))
+        self.assertEqual(self.read_log(handler), "error\n")
+        self.assertEqual(os.path.getsize(handler.baseFilename), 6)
+        self.assertGreaterEqual(os.stat(handler.baseFilename).st_blocks * 512,
+                                1024 * 1024)
+
+    def test_preallocate_released(self):
+        """Unused preallocated space is given back on rollover and close."""
+        handler = self.make_handler(preallocate_bytes=1024 * 1024)
+        handler.handle(make_record("first"))
+        first_file = handler.baseFilename
+        next_hour = handler.next_file_change
+        with mock.patch('metaswitch.common.logging_config.time.time',
+                        return_value=next_hour):
+            handler.handle(make_record("next hour", created=next_hour))
+        self.assertNotEqual(handler.baseFilename, first_file)
+        self.assertLess(os.stat(first_file).st_blocks * 512, 1024 * 1024)
+        self.assertEqual(os.path.getsize(first_file), 6)
+
+        second_file = handler.baseFilename
+        handler.close()
+        self.assertLess(os.stat(second_file).st_blocks * 512, 1024 * 1024)
+
+    def test_compressor(self):
+        """The compressor is notified on rollover and stopped on close."""
+        compressor = mock.Mock()
+        handler = self.make_handler(compressor=compressor)
+        self.assertEqual(compressor.notify.call_count, 1)
+        handler.handle(make_record("next hour", created=handler.next_file_change))
+        self.assertEqual(compressor.notify.call_count, 2)
+        handler.close()
+        compressor.stop.assert_called_once_with()
+
+    @mock.patch('metaswitch.common.logging_config.ClearwaterLogHandler')
+    def test_configure_buffered(self, mock_handler):
+        """configure_logging passes the buffering options to the handler."""
+        track_level(mock_handler)
+        configure_logging(logging.DEBUG, ".", "prefix",
+                          buffered=True, flush_bytes=1000, flush_interval=1,
+                          preallocate_bytes=2000)
+        mock_handler.assert_called_once_with(".", "prefix",
+                                             buffered=True,
+                                             flush_bytes=1000,
+                                             flush_interval=1,
+                                             preallocate_bytes=2000,
+                                             compressor=None,
+                                             shared=False)
+        configure_test_logging()
+
+    @mock.patch('metaswitch.common.logging_config._flush_on_sigterm')
+    def test_reconfigure(self, mock_flush_on_sigterm):
+        """Reconfiguring logging closes the old handlers, stopping their
+        threads."""
+        self.addCleanup(configure_test_logging)
+        configure_test_logging()
+        threads = threading.active_count()
+        for _ in xrange(3):
+            configure_logging(logging.INFO, self.tmpdir, "test",
+                              asynchronous=True,
+                              buffered=True,
+                              compression="gzip",
+                              flight_recorder_size=1024)
+            configure_syslog("test", logging.INFO, batched=True)
+        configure_test_logging()
+        self.assertEqual(threading.active_count(), threads)
+
+
+class SharedLogHandlerTestCase(unittest.TestCase):
+    """Tests several processes logging to the same files."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def log_from_children(self, processes, records, **kwargs):
+        """Forks processes which each log records lines to shared files, and
+        returns the lines written."""
+        pids = []
+        for n in xrange(processes):
+            pid = os.fork()
+            if pid == 0: #pragma: no cover
+                try:
+                    handler = ClearwaterLogHandler(self.tmpdir, "test",
+                                                   shared=True, **kwargs)
+                    handler.setFormatter(logging.Formatter("%(message)s"))
+                    for i in xrange(records):
+                        handler.handle(make_record("%d %d " % (n, i) +
+                                                   "x" * (i % 500)))
+                    handler.close()
+                finally:
+                    os._exit(0)
+            pids.append(pid)
+        for pid in pids:
+            os.waitpid(pid, 0)
+
+        lines = []
+        for name in os.listdir(self.tmpdir):
+            with open(os.path.join(self.tmpdir, name)) as f:
+                lines.extend(f.read().splitlines())
+        return lines
+
+    def check_lines(self, lines, processes, records):
+        self.assertEqual(len(lines), processes * records)
+        seen = set()
+        for line in lines:
+            n, i, padding = line.split(" ")
+            self.assertEqual(padding, "x" * (int(i) % 500))
+            seen.add((int(n), int(i)))
+        self.assertEqual(len(seen), processes * records)
+
+    def test_concurrent_appends(self):
+        """Records from different processes never overwrite each other."""
+        lines = self.log_from_children(4, 500)
+        self.check_lines(lines, 4, 500)
+
+    def test_concurrent_buffered_appends(self):
+        """The same holds for buffered batches of records."""
+        lines = self.log_from_children(4, 500, buffered=True, flush_bytes=4096)
+        self.check_lines(lines, 4, 500)
+
+    @mock.patch('os.fdopen')
+    @mock.patch('os.open')
+    def test_append_flag(self, mock_open, mock_fdopen):
+        """Shared files are opened for appending."""
+        ClearwaterLogHandler(self.tmpdir, "test", shared=True)
+        self.assertTrue(mock_open.call_args[0][1] & os.O_APPEND)
+
+    @mock.patch('metaswitch.common.logging_config.ClearwaterLogHandler')
+    def test_configure_shared(self, mock_handler):
+        """Processes sharing files don't add their task ID to the prefix."""
+        track_level(mock_handler)
+        configure_logging(logging.DEBUG, ".", "prefix", task_id=3, shared=True)
+        self.assertEqual(mock_handler.call_args[0], (".", "prefix"))
+        self.assertTrue(mock_handler.call_args[1]["shared"])
+        configure_test_logging()
+
+
+class BatchingSysLogHandlerTestCase(unittest.TestCase):
+    """Tests the non-blocking syslog handler against a local stand-in for
+    the syslog daemon's socket."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.address = os.path.join(self.tmpdir, "log")
+        self.server = None
+
+    def tearDown(self):
+        if self.server:
+            self.server.close()
+        shutil.rmtree(self.tmpdir)
+
+    def start_server(self):
+        if os.path.exists(self.address):
+            os.unlink(self.address)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.server.bind(self.address)
+        self.server.settimeout(5)
+
+    def stop_server(self):
+        self.server.close()
+        self.server = None
+
+    def receive(self, count):
+        return [self.server.recv(65536) for _ in xrange(count)]
+
+    def make_handler(self, **kwargs):
+        handler = BatchingSysLogHandler(self.address,
+                                        reconnect_interval=0.05,
+                                        **kwargs)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        self.addCleanup(handler.close)
+        return handler
+
+    def test_send(self):
+        """Each record is sent as a syslog datagram."""
+        self.start_server()
+        handler = self.make_handler()
+        handler.handle(make_record("info"))
+        handler.handle(make_record(u"error \xe9", logging.ERROR))
+        self.assertEqual(self.receive(2), ["<14>info\000",
+                                           "<11>error \xc3\xa9\000"])
+        self.assertEqual((handler.dropped, handler.delayed), (0, 0))
+
+    def test_syslog_unavailable(self):
+        """Records are kept while syslog is unavailable, dropping the oldest
+        when the backlog is full."""
+        handler = self.make_handler(backlog_size=5)
+        for i in xrange(8):
+            handler.handle(make_record("message %d" % i))
+        handler.flush(0.2)
+        self.start_server()
+        self.assertEqual(self.receive(5), ["<14>message %d\000" % i
+                                           for i in xrange(3, 8)])
+        self.assertEqual(handler.dropped, 3)
+        self.assertGreaterEqual(handler.delayed, 5)
+
+    def test_syslog_busy(self):
+        """Logging doesn't block when syslog isn't keeping up."""
+        self.start_server()
+        handler = self.make_handler(backlog_size=100000)
+        start = time.time()
+        for i in xrange(5000):
+            handler.handle(make_record("message %d" % i))
+        self.assertLess(time.time() - start, 5)
+
+        received = self.receive(5000)
+        self.assertEqual(received, ["<14>message %d\000" % i
+                                    for i in xrange(5000)])
+        handler.flush()
+        self.assertEqual(handler.dropped, 0)
+        self.assertGreater(handler.delayed, 0)
+
+    def test_reconnect(self):
+        """The handler reconnects when syslog restarts."""
+        self.start_server()
+        handler = self.make_handler()
+        handler.handle(make_record("before"))
+        self.assertEqual(self.receive(1), ["<14>before\000"])
+
+        self.stop_server()
+        handler.handle(make_record("during"))
+        handler.flush(0.2)
+        self.start_server()
+        handler.handle(make_record("after"))
+        self.assertEqual(self.receive(2), ["<14>during\000", "<14>after\000"])
+
+    def test_oversized_record(self):
+        """A record too big for a datagram is dropped, without holding up
+        the records after it."""
+        self.start_server()
+        handler = self.make_handler()
+        handler.handle(make_record("x" * 400 * 1024))
+        handler.handle(make_record("after"))
+        self.assertEqual(self.receive(1), ["<14>after\000"])
+        handler.flush()
+        self.assertEqual(handler.dropped, 1)
+
+    @mock.patch('metaswitch.common.logging_config.BatchingSysLogHandler')
+    def test_configure(self, mock_handler):
+        track_level(mock_handler)
+        configure_syslog("test_logging", logging.INFO, batched=True,
+                         backlog_size=10)
+        self.addCleanup(configure_test_logging)
+        mock_handler.assert_called_once_with("/dev/log", SysLogHandler.LOG_USER, 10)
+
+
+class ThrottlingFilterTestCase(unittest.TestCase):
+    """Tests the rate-limiting and deduplicating filter."""
+
+    def setUp(self):
+        self.clock = 1000.0
+        patcher = mock.patch('time.time', side_effect=lambda: self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make_handler(self, **kwargs):
+        handler = ListHandler()
+        handler.addFilter(ThrottlingFilter(handler, **kwargs))
+        return handler
+
+    def log(self, handler, msg, level=logging.INFO, name="test", lineno=1):
+        record = logging.LogRecord(name, level, "test.py", lineno, msg, None, None)
+        record.created = self.clock
+        handler.handle(record)
+
+    def test_repeats(self):
+        """Repeated messages are collapsed into a summary."""
+        handler = self.make_handler()
+        for _ in xrange(5):
+            self.log(handler, "same")
+        self.log(handler, "different")
+        self.assertEqual(handler.messages, ["same",
+                                            "Previous message repeated 4 times",
+                                            "different"])
+
+    def test_summary_json(self):
+        """Summaries written in the JSON format have no extra fields."""
+        handler = self.make_handler()
+        lines = []
+        handler.emit = lambda record: lines.append(JsonFormatter().format(record))
+        self.log(handler, "same")
+        self.log(handler, "same")
+        self.log(handler, "different")
+        summary = json.loads(lines[1])
+        self.assertEqual(summary["message"], "Previous message repeated 1 times")
+        self.assertEqual(sorted(summary),
+                         ["file", "level", "line", "message", "thread", "timestamp"])
+
+    def test_repeats_summary_interval(self):
+        """A steady stream of repeats is summarized periodically."""
+        handler = self.make_handler(summary_interval=10)
+        for _ in xrange(25):
+            self.log(handler, "same")
+            self.clock += 1
+        self.assertEqual(handler.messages, ["same",
+                                            "Previous message repeated 10 times",
+                                            "Previous message repeated 10 times"])
+
+    def test_rate_limit(self):
+        """Records over the rate are dropped, and the number dropped is
+        reported with the next record allowed."""
+        handler = self.make_handler(rate_per_second=1, burst_count=2)
+        for i in xrange(5):
+            self.log(handler, "message %d" % i)
+        self.clock += 1.5
+        self.log(handler, "message 5")
+        self.assertEqual(handler.messages,
+                         ["message 0",
+                          "message 1",
+                          "3 messages dropped by rate limiting",
+                          "message 5"])
+
+    def test_keys(self):
+        """Records are counted per call site by default, or per logger."""
+        handler = self.make_handler(rate_per_second=1, burst_count=1)
+        self.log(handler, "first", lineno=1)
+        self.log(handler, "second", lineno=2)
+        self.log(handler, "third", name="other", lineno=1)
+        self.assertEqual(handler.messages, ["first", "second"])
+
+        handler = self.make_handler(rate_per_second=1,
+                                    burst_count=1,
+                                    key=THROTTLE_BY_LOGGER)
+        self.log(handler, "first", lineno=1)
+        self.log(handler, "second", lineno=2)
+        self.log(handler, "third", name="other", lineno=1)
+        self.assertEqual(handler.messages, ["first", "third"])
+
+    def test_debug_sampling(self):
+        """Only 1 in N DEBUG records are kept."""
+        handler = self.make_handler(debug_sample_rate=3)
+        for i in xrange(7):
+            self.log(handler, "debug %d" % i, logging.DEBUG)
+            self.log(handler, "info %d" % i)
+        self.assertEqual([m for m in handler.messages if m.startswith("debug")],
+                         ["debug 0", "debug 3", "debug 6"])
+        self.assertEqual(len(handler.messages), 10)
+
+    def test_bad_key(self):
+        self.assertRaises(ValueError, ThrottlingFilter, ListHandler(), key="thread")
+
+    @mock.patch('metaswitch.common.logging_config.SysLogHandler',
+                autospec=True)
+    def test_configure(self, mock_syslog):
+        """configure_syslog can add a throttling filter to its handler."""
+        track_level(mock_syslog)
+        configure_syslog("test_logging", logging.INFO,
+                         throttling={"rate_per_second": 10})
+        self.addCleanup(configure_test_logging)
+        log_filter = mock_syslog.return_value.addFilter.call_args[0][0]
+        self.assertTrue(isinstance(log_filter, ThrottlingFilter))
+
+
+class FlightRecorderTestCase(unittest.TestCase):
+    """Tests the in-memory ring buffer of recent logs."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def make_recorder(self, size, filename=None):
+        recorder = FlightRecorderHandler(size, filename)
+        recorder.setFormatter(logging.Formatter("%(message)s"))
+        self.addCleanup(recorder.close)
+        return recorder
+
+    def test_record(self):
+        """Records are kept in order, at all levels."""
+        recorder = self.make_recorder(1000)
+        self.assertEqual(recorder.dump(), "")
+        recorder.handle(make_record("first", logging.DEBUG))
+        recorder.handle(make_record(u"second \xe9"))
+        self.assertEqual(recorder.dump(), "first\nsecond \xc3\xa9\n")
+
+    def test_wrap(self):
+        """Once the ring is full, only the most recent whole records are
+        kept."""
+        recorder = self.make_recorder(100)
+        for i in xrange(50):
+            recorder.handle(make_record("record %d" % i))
+        dump = recorder.dump()
+        self.assertLessEqual(len(dump), 100)
+        self.assertEqual(dump, "".join("record %d\n" % i for i in xrange(41, 50)))
+
+    def check_fork(self, recorder):
+        """Logs in a forked child, and checks that the parent's ring is
+        unaffected."""
+        recorder.handle(make_record("before fork"))
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0: #pragma: no cover
+            ok = False
+            try:
+                # Wait for the parent to log, then log over the same part of
+                # the ring.
+                os.read(read_fd, 1)
+                recorder.handle(make_record("child record"))
+                ok = recorder.dump() == "before fork\nchild record\n"
+            finally:
+                os._exit(0 if ok else 1)
+        recorder.handle(make_record("parent"))
+        os.write(write_fd, "x")
+        _, status = os.waitpid(pid, 0)
+        os.close(read_fd)
+        os.close(write_fd)
+        self.assertEqual(status, 0)
+        self.assertEqual(recorder.dump(), "before fork\nparent\n")
+
+    def test_fork(self):
+        """A forked child logs to its own copy of the ring."""
+        self.check_fork(self.make_recorder(1000))
+
+    def test_fork_file(self):
+        """A forked child doesn't write to the parent's file."""
+        filename = os.path.join(self.tmpdir, "recorder")
+        self.check_fork(self.make_recorder(1000, filename))
+        self.assertEqual(read_flight_recorder(filename), "before fork\nparent\n")
+
+    def test_long_record(self):
+        """A record bigger than the ring keeps its end."""
+        recorder = self.make_recorder(10)
+        recorder.handle(make_record("a" * 20))
+        self.assertEqual(recorder.dump(), "aaaaaaaaa\n")
+        recorder.handle(make_record("b" * 5))
+        self.assertEqual(recorder.dump(), "bbbbb\n")
+
+    def test_file_backed(self):
+        """A file-backed ring can be read after the handler has gone."""
+        filename = os.path.join(self.tmpdir, "recorder")
+        recorder = self.make_recorder(100, filename)
+        for i in xrange(50):
+            recorder.handle(make_record("record %d" % i))
+        expected = recorder.dump()
+        recorder.close()
+        self.assertEqual(read_flight_recorder(filename), expected)
+
+        # Records logged after closing are ignored.
+        recorder.handle(make_record("ignored"))
+        self.assertEqual(recorder.dump(), "")
+
+    def test_read_bad_file(self):
+        filename = os.path.join(self.tmpdir, "recorder")
+        with open(filename, "w") as f:
+            f.write("not a flight recorder")
+        self.assertRaises(ValueError, read_flight_recorder, filename)
+
+    @mock.patch('sys.__excepthook__')
+    @mock.patch('metaswitch.common.logging_config.write_core_file')
+    @mock.patch('metaswitch.common.logging_config.ClearwaterLogHandler')
+    def test_configure(self, mock_handler, mock_write_core_file, mock_excepthook):
+        """configure_logging can add a flight recorder, which is dumped on an
+        uncaught exception."""
+        track_level(mock_handler)
+        configure_logging(logging.INFO, ".", "prefix", flight_recorder_size=1000)
+        self.addCleanup(configure_test_logging)
+        recorder = get_flight_recorder()
+        self.assertTrue(isinstance(recorder, FlightRecorderHandler))
+        logging.getLogger("test").debug("Recorded")
+
+        try:
+            raise RuntimeError("Crashed")
+        except RuntimeError:
+            sys.excepthook(*sys.exc_info())
+
+        name, contents = mock_write_core_file.call_args[0]
+        self.assertEqual(name, "prefix")
+        self.assertIn("RuntimeError: Crashed", contents)
+        self.assertIn("DEBUG test_logging.py", contents)
+        self.assertIn("Recorded", contents)
+        self.assertTrue(mock_excepthook.called)
+        recorder.close()
+
 
 if __name__ == "__main__":
     unittest.main()
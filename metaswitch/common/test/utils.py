@@ -7,15 +7,82 @@
 # Otherwise no rights are granted except for those provided to you by
 # Metaswitch Networks in a separate written agreement.
 
+import itertools
 import logging
+import math
+import os
+import re
+import threading
 import unittest
+import mock
+import urllib
+from metaswitch.common.bloom_filter import BloomFilter
 from metaswitch.common.utils import (_HUMAN_SAFE_ALPHABET,
+                                     _HUMAN_SAFE_MIXED_CASE_ALPHABET,
+                                     _URL_SAFE_ALPHABET,
+                                     _AUDIBLE_ALPHABET,
+                                     UUID_LEN_AUDIBLE,
+                                     _create_secure_id_length_function,
+                                     create_secure_mixed_case_human_readable_id,
+                                     create_secure_url_safe_id,
+                                     create_secure_url_safe_ids,
+                                     create_secure_audible_id,
+                                     canonicalise_human_readable_id,
+                                     generate_unique_secure_ids,
+                                     HumanReadableIdIndex,
                                      create_secure_human_readable_id,
+                                     create_secure_human_readable_ids,
+                                     create_secure_mixed_case_human_readable_ids,
+                                     create_efficient_secure_human_readable_id,
+                                     create_efficient_secure_human_readable_ids,
+                                     create_efficient_secure_mixed_case_human_readable_id,
+                                     _create_efficient_secure_chars_function,
+                                     _choose_random_window,
+                                     generate_sip_passwords,
+                                     generate_secure_random_bytes,
+                                     SecureRandomPool,
                                      append_url_params,
+                                     encode_query_string,
+                                     BaseUrl,
                                      safely_encode,
                                      sip_uri_to_phone_number,
                                      sip_uri_to_domain,
-                                     map_clearwater_log_level)
+                                     SipUri,
+                                     _SIP_URI_REGEXP,
+                                     iter_parse_sip_uris,
+                                     iter_unique_sip_uris,
+                                     group_sip_uris_by_domain,
+                                     iter_sip_uris_to_phone_numbers,
+                                     iter_sip_public_ids_to_private,
+                                     sip_lists_to_phone_list,
+                                     sip_public_id_to_private,
+                                     map_clearwater_log_level,
+                                     map_in_chunks)
+
+def _create_loop_secure_id_length_function(alphabet):
+    """The original per-character ID generator, kept to compare against."""
+    alphabet_length = len(alphabet)
+    greatest_multiple = alphabet_length * int(256 // alphabet_length)
+
+    def create_id(required_length):
+        id = ""
+        length = 0
+        random_iter = generate_secure_random_bytes(required_length * 2)
+        while length < required_length:
+            random_byte = next(random_iter)
+            if random_byte < greatest_multiple:
+                idx = random_byte % alphabet_length
+                length += 1
+                id += alphabet[idx]
+        return id
+
+    return create_id
+
+def multiply_chunk(args):
+    """Chunk function for map_in_chunks, at module level so it can be
+    pickled."""
+    factor, chunk = args
+    return [item * factor for item in chunk]
 
 class UtilsTestCase(unittest.TestCase):
     def doDistributionTest(self, fn, alphabet):
@@ -34,6 +101,33 @@ class UtilsTestCase(unittest.TestCase):
         for c in alphabet:
             self.assertTrue(dist[c] > total / 2 / len(alphabet))
 
+    def doChiSquaredTest(self, fn, alphabet):
+        """
+        Tests that the distribution of output characters from the given ID
+        generator function is flat, both overall and at each position in the
+        ID, using a chi-squared test with a very low false failure rate.
+        """
+        keys = [fn(50) for _ in xrange(2000)]
+        self.assertChiSquaredFlat("".join(keys), alphabet)
+        for position in xrange(len(keys[0])):
+            self.assertChiSquaredFlat([key[position] for key in keys], alphabet)
+
+    def assertChiSquaredFlat(self, chars, alphabet):
+        counts = dict.fromkeys(alphabet, 0)
+        for c in chars:
+            counts[c] += 1
+        expected = float(len(chars)) / len(alphabet)
+        chi_squared = sum((count - expected) ** 2 / expected
+                          for count in counts.values())
+
+        # Wilson-Hilferty approximation to the critical value at p = 1e-7.
+        # Each run of the tests makes several hundred of these checks, so a
+        # larger p makes the tests fail by chance every few dozen runs.
+        dof = len(alphabet) - 1
+        z = 5.199
+        critical = dof * (1 - 2.0 / (9 * dof) + z * math.sqrt(2.0 / (9 * dof))) ** 3
+        self.assertLess(chi_squared, critical)
+
     def testHumanReadableIdDistribution(self):
         """Test that the distribution of the human-readable ID generator is flat"""
         self.doDistributionTest(create_secure_human_readable_id, _HUMAN_SAFE_ALPHABET)
@@ -51,6 +145,250 @@ class UtilsTestCase(unittest.TestCase):
         over many runs"""
         self.doUniquenessTest(create_secure_human_readable_id)
 
+    def testHumanReadableIdsDistribution(self):
+        """Test that the distribution of the batch human-readable ID generator
+        is flat"""
+        self.doDistributionTest(lambda bits: create_secure_human_readable_ids(1, bits)[0],
+                                _HUMAN_SAFE_ALPHABET)
+        self.doDistributionTest(lambda bits: create_secure_mixed_case_human_readable_ids(1, bits)[0],
+                                _HUMAN_SAFE_MIXED_CASE_ALPHABET)
+
+    def testHumanReadableIdsBatch(self):
+        """Test that the batch human-readable ID generator returns the right
+        number of IDs, each of the same length as the single ID generator"""
+        ids = create_secure_human_readable_ids(1000, 50)
+        self.assertEquals(len(ids), 1000)
+        self.assertEquals(len(set(ids)), 1000)
+        for key in ids:
+            self.assertEquals(len(key), len(create_secure_human_readable_id(50)))
+            self.assertTrue(all(c in _HUMAN_SAFE_ALPHABET for c in key))
+
+        self.assertEquals(create_secure_human_readable_ids(0, 50), [])
+
+    def testZeroLengthIds(self):
+        """Test that the batch ID generators return empty IDs of length 0,
+        like the single ID generators"""
+        self.assertEquals(create_secure_human_readable_id(0), "")
+        self.assertEquals(create_secure_human_readable_ids(3, 0), ["", "", ""])
+        self.assertEquals(create_efficient_secure_human_readable_id(0), "")
+        self.assertEquals(create_efficient_secure_human_readable_ids(3, 0), ["", "", ""])
+
+    def testEfficientIdDistribution(self):
+        """Test that the distribution of the entropy-efficient ID generators is
+        flat"""
+        self.doDistributionTest(create_efficient_secure_human_readable_id,
+                                _HUMAN_SAFE_ALPHABET)
+        self.doChiSquaredTest(create_efficient_secure_human_readable_id,
+                              _HUMAN_SAFE_ALPHABET)
+        self.doChiSquaredTest(create_efficient_secure_mixed_case_human_readable_id,
+                              _HUMAN_SAFE_MIXED_CASE_ALPHABET)
+        self.doChiSquaredTest(lambda bits: create_efficient_secure_human_readable_ids(1, bits)[0],
+                              _HUMAN_SAFE_ALPHABET)
+
+    def testEfficientIdUniqueness(self):
+        """Tests that the entropy-efficient ID generators don't create
+        duplicates over many runs"""
+        self.doUniquenessTest(create_efficient_secure_human_readable_id)
+        self.assertEquals(len(set(create_efficient_secure_human_readable_ids(1000, 50))),
+                          1000)
+        self.assertEquals(len(create_efficient_secure_human_readable_id(50)),
+                          len(create_secure_human_readable_id(50)))
+
+    def testEfficientIdUsesFewerBytes(self):
+        """Test that the entropy-efficient generator needs far fewer random
+        bytes per character than one byte per character"""
+        window_bytes, chars_per_window, limit = _choose_random_window(len(_HUMAN_SAFE_ALPHABET))
+        chars_per_byte = float(chars_per_window * limit) / (256 ** window_bytes) / window_bytes
+        self.assertGreater(chars_per_byte, 1.5)
+
+    def doExhaustiveWindowTest(self, alphabet, window_bytes):
+        """Feeds every possible random window to the entropy-efficient
+        generator and checks that every string it can produce comes out
+        equally often, so the window extraction cannot introduce bias."""
+        _, chars_per_window, limit = _choose_random_window(len(alphabet), window_bytes)
+        all_windows = "".join("".join(window) for window in
+                              itertools.product(map(chr, xrange(256)),
+                                                repeat=window_bytes))
+
+        create_chars = _create_efficient_secure_chars_function(alphabet, window_bytes)
+        with mock.patch('metaswitch.common.utils.secure_random_pool') as mock_pool:
+            mock_pool.read.return_value = all_windows
+            chars = create_chars(limit * chars_per_window)
+
+        counts = {}
+        for i in xrange(0, len(chars), chars_per_window):
+            key = chars[i:i + chars_per_window]
+            counts[key] = counts.get(key, 0) + 1
+        self.assertEquals(len(counts), len(alphabet) ** chars_per_window)
+        self.assertEquals(set(counts.values()),
+                          set([limit // len(alphabet) ** chars_per_window]))
+        for key in itertools.islice(counts, 10):
+            self.assertTrue(all(c in alphabet for c in key))
+
+    def testEfficientIdExhaustiveSmallWindow(self):
+        """Test window extraction for a single-byte window"""
+        self.doExhaustiveWindowTest("abc", 1)
+
+    def testEfficientIdExhaustiveHumanWindow(self):
+        """Test window extraction for a two-byte window over the human-safe
+        alphabet"""
+        self.doExhaustiveWindowTest(_HUMAN_SAFE_ALPHABET, 2)
+
+    def testUrlSafeIdDistribution(self):
+        """Test that the distribution of the URL-safe ID generators is flat"""
+        self.doDistributionTest(create_secure_url_safe_id, _URL_SAFE_ALPHABET)
+        self.doChiSquaredTest(create_secure_url_safe_id, _URL_SAFE_ALPHABET)
+        self.doChiSquaredTest(lambda bits: create_secure_url_safe_ids(1, bits)[0],
+                              _URL_SAFE_ALPHABET)
+        self.doUniquenessTest(create_secure_url_safe_id)
+
+    def testMixedCaseIdDistribution(self):
+        """Test that the distribution of the mixed-case ID generator is flat"""
+        self.doChiSquaredTest(create_secure_mixed_case_human_readable_id,
+                              _HUMAN_SAFE_MIXED_CASE_ALPHABET)
+
+    def testAudibleIdDistribution(self):
+        """Test that the audible ID generator produces flat decimal digits"""
+        self.assertEquals(len(create_secure_audible_id()), UUID_LEN_AUDIBLE)
+        self.doChiSquaredTest(create_secure_audible_id, _AUDIBLE_ALPHABET)
+
+    def testTranslateTableMatchesLoop(self):
+        """Test that the table-based generator turns random bytes into the
+        same characters as the original loop"""
+        random_bytes = "".join(chr(b) for b in xrange(256)) * 2
+        expected = _create_loop_secure_id_length_function(_HUMAN_SAFE_ALPHABET)
+        with mock.patch('os.urandom', return_value=random_bytes):
+            expected_id = expected(200)
+        with mock.patch('metaswitch.common.utils.secure_random_pool') as mock_pool:
+            mock_pool.read.return_value = random_bytes
+            actual_id = _create_secure_id_length_function(_HUMAN_SAFE_ALPHABET)(200)
+        self.assertEquals(actual_id, expected_id)
+
+    def testCanonicaliseHumanReadableId(self):
+        """Test that typed IDs are converted back to their canonical form"""
+        self.assertEquals(canonicalise_human_readable_id("abc3"), "abc3")
+        self.assertEquals(canonicalise_human_readable_id("ABC3"), "abc3")
+        self.assertEquals(canonicalise_human_readable_id("ab-c 3"), "abc3")
+        self.assertEquals(canonicalise_human_readable_id(u"Ui2"), "vjz")
+        self.assertEquals(canonicalise_human_readable_id("abc0"), None)
+        self.assertEquals(canonicalise_human_readable_id("abcl"), None)
+        self.assertEquals(canonicalise_human_readable_id(u"abc\xe9"), None)
+        self.assertEquals(canonicalise_human_readable_id(" - "), None)
+
+        for key in create_secure_human_readable_ids(100, 50):
+            self.assertEquals(canonicalise_human_readable_id(key), key)
+            self.assertEquals(canonicalise_human_readable_id(key.upper()), key)
+
+    def testHumanReadableIdIndex(self):
+        """Test that the index resolves typed IDs to record keys"""
+        index = HumanReadableIdIndex([("vjz3", 1)])
+        index.add("ABC4", 2)
+        self.assertRaises(ValueError, index.add, "abc0", 3)
+
+        self.assertEquals(len(index), 2)
+        self.assertEquals(index.lookup("Ui2-3"), 1)
+        self.assertEquals(index.lookup("abc4"), 2)
+        self.assertEquals(index.lookup("abc5"), None)
+        self.assertEquals(index.lookup("abc0", "missing"), "missing")
+        self.assertTrue("a b c 4" in index)
+        self.assertFalse("abc5" in index)
+        self.assertEquals(list(index.resolve_many(["VJZ3", "abc5", "abc0"])),
+                          [("VJZ3", 1), ("abc5", None), ("abc0", None)])
+
+    def testUniqueIdsWithFilter(self):
+        """Test that the unique ID stream only checks filter hits with the
+        database, and skips duplicates"""
+        ids = ["aaa", "bbb", "aaa", "ccc", "ddd", "eee"]
+        create_ids = mock.Mock(side_effect=lambda count, bits: ids)
+        id_filter = BloomFilter(100)
+        id_filter.add("ccc")
+        database = set(["ccc"])
+        is_duplicate = mock.Mock(side_effect=lambda candidate: candidate in database)
+
+        stream = generate_unique_secure_ids(10, id_filter, is_duplicate, create_ids)
+        provisioned = []
+        for _ in xrange(3):
+            key = next(stream)
+            database.add(key)
+            provisioned.append(key)
+        self.assertEquals(provisioned, ["aaa", "bbb", "ddd"])
+        self.assertEquals(is_duplicate.call_args_list,
+                          [mock.call("aaa"), mock.call("ccc")])
+        self.assertTrue("ddd" in id_filter)
+
+    def testUniqueIdsWithoutDatabase(self):
+        """Test that the unique ID stream discards filter hits if there's no
+        database check"""
+        id_filter = BloomFilter(10000)
+        stream = generate_unique_secure_ids(20, id_filter)
+        ids = [next(stream) for _ in xrange(2000)]
+        self.assertEquals(len(set(ids)), 2000)
+        self.assertTrue(all(len(key) == 5 for key in ids))
+
+    def testUniqueIdsWithoutFilter(self):
+        """Test that the unique ID stream checks every ID with the database if
+        there's no filter"""
+        create_ids = mock.Mock(return_value=["aaa", "bbb"])
+        is_duplicate = mock.Mock(side_effect=lambda candidate: candidate == "aaa")
+        stream = generate_unique_secure_ids(10, is_duplicate=is_duplicate, create_ids=create_ids)
+        self.assertEquals(next(stream), "bbb")
+        self.assertEquals(is_duplicate.call_count, 2)
+
+    def testSipPasswords(self):
+        """Test that bulk SIP passwords are mixed-case human-readable IDs"""
+        passwords = generate_sip_passwords(10)
+        self.assertEquals(len(passwords), 10)
+        for password in passwords:
+            self.assertEquals(len(password), 9)
+            self.assertTrue(all(c in _HUMAN_SAFE_MIXED_CASE_ALPHABET for c in password))
+
+    @mock.patch('os.urandom', side_effect=lambda n: "x" * n)
+    def testSecureRandomBytesBufferSize(self, mock_urandom):
+        """Test that generate_secure_random_bytes reads buffer_size bytes at a
+        time"""
+        random_iter = generate_secure_random_bytes(16)
+        for _ in xrange(17):
+            self.assertEquals(next(random_iter), ord("x"))
+        self.assertEquals(mock_urandom.call_args_list, [mock.call(16)] * 2)
+
+    @mock.patch('os.urandom', side_effect=os.urandom)
+    def testSecureRandomPoolRefills(self, mock_urandom):
+        """Test that the pool only calls urandom when its buffer runs out"""
+        pool = SecureRandomPool(buffer_size=64)
+        data = "".join(pool.read(10) for _ in xrange(12))
+        self.assertEquals(len(data), 120)
+        self.assertEquals(mock_urandom.call_count, 2)
+
+        # Requests bigger than the buffer are served directly.
+        self.assertEquals(len(pool.read(1000)), 1000)
+        self.assertEquals(mock_urandom.call_args, mock.call(1000 - 8))
+
+    def testSecureRandomPoolThreads(self):
+        """Test that threads sharing a pool get different bytes"""
+        pool = SecureRandomPool(buffer_size=256)
+        results = []
+
+        def read():
+            results.append(pool.read(32))
+
+        threads = [threading.Thread(target=read) for _ in xrange(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(len(set(results)), 4)
+
+    def testSecureRandomPoolFork(self):
+        """Test that the pool discards its buffer when the pid changes"""
+        pool = SecureRandomPool(buffer_size=256)
+        first = pool.read(16)
+
+        with mock.patch('os.getpid', return_value=os.getpid() + 1):
+            with mock.patch('os.urandom', return_value="y" * 256):
+                self.assertEquals(pool.read(16), "y" * 16)
+
+        self.assertNotEqual(first, "y" * 16)
+
     def test_append_url_params(self):
         self.assertEquals(append_url_params("foo", bar="baz"),
                           "foo?bar=baz")
@@ -67,6 +405,42 @@ class UtilsTestCase(unittest.TestCase):
         self.assertEquals(append_url_params("foo#bif", bar="baz"),
                           "foo?bar=baz#bif")
 
+    def test_encode_query_string(self):
+        self.assertEquals(encode_query_string({"b": "x y+z", "a": u"caf\xe9"}),
+                          "a=caf%C3%A9&b=x%20y%2Bz")
+        self.assertEquals(encode_query_string({"a": 1, "b": ["x", "y/z"]}),
+                          "a=1&b=x&b=y/z")
+        self.assertEquals(encode_query_string([("b", "1"), ("a", "2"), ("b", "3")]),
+                          "b=1&a=2&b=3")
+        self.assertEquals(encode_query_string({}), "")
+
+    def test_encode_query_string_matches_quote(self):
+        """Test that every byte is escaped exactly as urllib.quote does"""
+        all_bytes = "".join(chr(b) for b in xrange(256))
+        self.assertEquals(encode_query_string({"k": all_bytes}),
+                          "k=" + urllib.quote(all_bytes))
+
+    def test_base_url(self):
+        base = BaseUrl("foo?bif=bop#frag")
+        self.assertEquals(base.with_params(bar="baz"), "foo?bif=bop&bar=baz#frag")
+        self.assertEquals(base.with_params([("a", "1"), ("a", "2")], bar="baz"),
+                          "foo?bif=bop&a=1&a=2&bar=baz#frag")
+        self.assertEquals(BaseUrl("foo").with_params({"a": ["1", "2"]}),
+                          "foo?a=1&a=2")
+
+    def test_encode_query_string_matches_urllib(self):
+        """The query string encoder gives the same result as urllib.quote"""
+        params = {"redirect": u"https://example.com/p\xe5th?a=b&c",
+                  "state": "abc123",
+                  "n": "5"}
+        expected = "&".join("%s=%s" % (urllib.quote(k.encode("utf-8")),
+                                       urllib.quote(v.encode("utf-8")))
+                            for k, v in sorted(params.items()))
+
+        base = BaseUrl("https://example.com/login?x=1")
+        self.assertEquals(base.with_params(params),
+                          "https://example.com/login?x=1&" + expected)
+
     def test_map_clearwater_log_level(self):
         # Error
         self.assertEquals(map_clearwater_log_level(0), logging.ERROR)
@@ -101,6 +475,80 @@ class UtilsTestCase(unittest.TestCase):
         self.assertEquals(sip_uri_to_domain("sip:1234@xyz.ngv.metaswitch.com;gobbledygook"),
                           "xyz.ngv.metaswitch.com")
 
+    def test_sip_uri_parse(self):
+        uri = SipUri.parse("sips:+1234:secret@abc.ngv.metaswitch.com;transport=tcp;lr")
+        self.assertEquals(uri.scheme, "sips")
+        self.assertEquals(uri.number, "+1234")
+        self.assertEquals(uri.user, "+1234")
+        self.assertEquals(uri.password, "secret")
+        self.assertEquals(uri.domain, "abc.ngv.metaswitch.com")
+        self.assertEquals(uri.raw_params, ";transport=tcp;lr")
+        self.assertEquals(uri.params, {"transport": "tcp", "lr": None})
+        self.assertEquals(uri, SipUri("sips", "+1234", "secret",
+                                      "abc.ngv.metaswitch.com", ";transport=tcp;lr"))
+
+        uri = SipUri.parse("sip:1234@ngv.metaswitch.com")
+        self.assertEquals(uri.scheme, "sip")
+        self.assertEquals(uri.password, None)
+        self.assertEquals(uri.params, {})
+        self.assertFalse(hasattr(uri, "__dict__"))
+
+        self.assertEquals(SipUri.parse("tel:1234"), None)
+        self.assertEquals(SipUri.parse("sip:alice@ngv.metaswitch.com"), None)
+
+    def test_iter_parse_sip_uris(self):
+        uris = ["sip:1@a.com", "tel:2", "sip:1@a.com", "sip:3@b.com"]
+        expected = [SipUri("sip", "1", None, "a.com"),
+                    None,
+                    SipUri("sip", "1", None, "a.com"),
+                    SipUri("sip", "3", None, "b.com")]
+        self.assertEquals(list(iter_parse_sip_uris(uris)), expected)
+
+        parsed = list(iter_parse_sip_uris(iter(uris), cache_size=2))
+        self.assertEquals(parsed, expected)
+        self.assertTrue(parsed[0] is parsed[2])
+
+    def test_iter_unique_sip_uris(self):
+        uris = ["sip:1@a.com", "tel:2", "sip:1@a.com", "sip:1@a.com;lr", "sip:3@b.com"]
+        self.assertEquals([uri.number for uri in iter_unique_sip_uris(uris)],
+                          ["1", "1", "3"])
+
+    def test_group_sip_uris_by_domain(self):
+        uris = ["sip:1@a.com", "tel:2", "sip:3@b.com", "sip:1@a.com", "sip:4@a.com"]
+        self.assertEquals(group_sip_uris_by_domain(uris),
+                          {"a.com": ["1", "1", "4"], "b.com": ["3"]})
+        self.assertEquals(group_sip_uris_by_domain(uris, dedupe=True, cache_size=10),
+                          {"a.com": ["1", "4"], "b.com": ["3"]})
+
+    def test_phone_numbers_and_private_ids(self):
+        uris = ["sip:1@a.com", "tel:2"]
+        self.assertEquals(list(iter_sip_uris_to_phone_numbers(uris)), ["1", "Unknown"])
+        self.assertEquals(sip_lists_to_phone_list(uris), ["1", "Unknown"])
+        self.assertEquals(sip_public_id_to_private("sip:1@a.com"), "1@a.com")
+        self.assertEquals(sip_public_id_to_private("tel:1"), "tel:1")
+        self.assertEquals(list(iter_sip_public_ids_to_private(["sip:1@a.com", "1@sip:"])),
+                          ["1@a.com", "1@sip:"])
+
+    def test_bulk_sip_uris_match_regex(self):
+        """Bulk SIP URI parsing matches a regex per URI, with or without
+        the cache"""
+        uris = ["sip:%d@domain%d.example.com;user=phone" % (i % 1000, i % 1000 % 7)
+                for i in xrange(5000)]
+        expected = [re.match(_SIP_URI_REGEXP, uri).group("number") for uri in uris]
+        self.assertEquals(list(iter_sip_uris_to_phone_numbers(uris)), expected)
+        self.assertEquals(list(iter_parse_sip_uris(uris, cache_size=100)),
+                          list(iter_parse_sip_uris(uris)))
+
+    def test_map_in_chunks(self):
+        """Items are processed in order, in and out of a process pool."""
+        items = range(100)
+        expected = [i * 3 for i in items]
+        self.assertEqual(map_in_chunks(multiply_chunk, 3, items), expected)
+        self.assertEqual(map_in_chunks(multiply_chunk, 3, iter(items),
+                                       processes=2, parallel_threshold=10),
+                         expected)
+        self.assertEqual(map_in_chunks(multiply_chunk, 3, []), [])
+
     def test_safely_encode(self):
         self.assertEquals(safely_encode(None), None)
         self.assertEquals(safely_encode(u'ASCII'), 'ASCII')
@@ -14,10 +14,15 @@ import logging
 import math
 import traceback
 import hashlib
+import itertools
+import binascii
+import multiprocessing
 import time
 import signal
-from urllib import quote
+import string
+import threading
 from fcntl import flock, LOCK_EX, LOCK_NB
+from metaswitch.common.lru_cache import LRUCache
 
 _log = logging.getLogger("metaswitch.utils")
 
@@ -47,8 +52,49 @@ _AUDIBLE_ALPHABET = "0123456789"
 # Map from commonly substituted letter back to letter of the safe alphabet.
 _HUMAN_SUBSTITUTIONS = {'u': 'v', 'i': 'j', '2': 'z'}
 
+# Characters that people add when typing an ID to make it easier to read, and
+# that are dropped when canonicalising it.
+_HUMAN_SEPARATORS = " \t-."
+
+def _create_human_canonicalisation_table():
+    """
+    Creates a str.translate table that lower-cases a typed ID and undoes the
+    common substitutions in _HUMAN_SUBSTITUTIONS.
+    """
+    table = list(string.maketrans("", ""))
+    for c in string.ascii_uppercase:
+        table[ord(c)] = c.lower()
+    for typed, safe in _HUMAN_SUBSTITUTIONS.items():
+        table[ord(typed)] = safe
+        table[ord(typed.upper())] = safe
+    return "".join(table)
+
+_HUMAN_CANONICALISATION_TABLE = _create_human_canonicalisation_table()
+
 # Regular expression splitting apart a SIP(S) URI.
-_SIP_URI_REGEXP = r'^sips?:(?P<number>[0-9+]+)(?::(?P<password>))?@(?P<domain>[^;]+).*$'
+_SIP_URI_REGEXP = r'^(?P<scheme>sips?):(?P<number>[0-9+]+)(?::(?P<password>[^@]*))?@(?P<domain>[^;]+)(?P<params>.*)$'
+_SIP_URI_PATTERN = re.compile(_SIP_URI_REGEXP)
+
+def _create_translation_table(alphabet):
+    """
+    Creates the arguments to str.translate that turn a string of random bytes
+    into characters of the given alphabet without bias.
+
+    To avoid bias we need to restrict the random byte values that we use to
+    a subset whose size is divisible by the size of the alphabet.  The table
+    maps every byte value onto its character in the alphabet, and the
+    returned deletechars lists the byte values outside that subset so that
+    translate drops them.  The entries of the table for the deleted byte
+    values are never used.
+
+    Returns a tuple of (table, deletechars, acceptance), where acceptance is
+    the fraction of random bytes that are not deleted.
+    """
+    alphabet_length = len(alphabet)
+    greatest_multiple = alphabet_length * int(256 // alphabet_length)
+    table = "".join(alphabet[b % alphabet_length] for b in xrange(256))
+    rejected = "".join(chr(b) for b in xrange(greatest_multiple, 256))
+    return table, rejected, greatest_multiple / 256.0
 
 def _create_secure_id_length_function(alphabet):
     """
@@ -56,47 +102,188 @@ def _create_secure_id_length_function(alphabet):
     returned function accepts a single argument which is the length of
     the id to generate.
     """
-    # To avoid bias we need to restrict the random byte values that we use to
-    # a subset whose size is divisible by the size of the alphabet.
-    alphabet_length = len(alphabet)
-    greatest_multiple = alphabet_length * int(256 // alphabet_length)
+    table, rejected, _ = _create_translation_table(alphabet)
 
     def create_id(required_length):
         id = ""
-        length = 0
-        random_iter = generate_secure_random_bytes(required_length * 2)
-        while length < required_length:
+        while len(id) < required_length:
             # The id isn't long enough yet, add some more random stuff on the
-            # end.  First, pick a random byte and truncate it to the greatest
-            # multiple of the alphabet length that fits in a byte.
-            random_byte = next(random_iter)
-            if random_byte < greatest_multiple:
-                # The truncated byte is within our truncated space, use it.  If
-                # it wasn't, we'd just loop again and have another chance at
-                # picking a value within our alphabet.  Schemes without a retry
-                # in that case have to be very clever to avoid introducing bias.
-                idx = random_byte % alphabet_length
-                length += 1
-                id += alphabet[idx]
-        return id
+            # end.  Any random bytes outside the truncated space are dropped;
+            # we just go round again if that leaves us short.  Schemes without
+            # a retry in that case have to be very clever to avoid introducing
+            # bias.  Twice the required length is nearly always plenty.
+            random_bytes = secure_random_pool.read(required_length * 2)
+            id += random_bytes.translate(table, rejected)
+        return id[:required_length]
 
     return create_id
 
-def _create_secure_id_bits_function(alphabet):
+def _create_secure_ids_length_function(alphabet):
+    """
+    Creates a batch ID generator function that uses the given alphabet.  The
+    returned function accepts the number of IDs to generate and the length of
+    each of them, and returns a list of IDs.
+
+    This draws a single large block of random bytes and translates the whole
+    block at once, rather than drawing random bytes for each ID.
+    """
+    table, rejected, acceptance = _create_translation_table(alphabet)
+
+    def create_ids(count, required_length):
+        if required_length == 0:
+            # As for a single ID of length 0.
+            return [""] * count
+        total_length = count * required_length
+        chunks = []
+        length = 0
+        while length < total_length:
+            # Ask for enough random bytes to cover what we still need once the
+            # expected fraction has been rejected, plus a little slack so we
+            # rarely have to go round again.
+            remaining = total_length - length
+            request_length = int(remaining / acceptance) + 16
+            chunk = secure_random_pool.read(request_length).translate(table, rejected)
+            chunks.append(chunk)
+            length += len(chunk)
+        chars = "".join(chunks)
+        return [chars[i:i + required_length]
+                for i in xrange(0, total_length, required_length)]
+
+    return create_ids
+
+# The largest number of random bytes combined into a single rejection window
+# by the entropy-efficient ID generators.
+_MAX_RANDOM_WINDOW_BYTES = 32
+
+# The largest number of precomputed strings the entropy-efficient ID
+# generators will keep in order to extract several characters at once.
+_MAX_CHAR_TABLE_SIZE = 65536
+
+def _choose_random_window(alphabet_length, max_window_bytes=_MAX_RANDOM_WINDOW_BYTES):
+    """
+    Picks how many random bytes to combine into one big integer, and how many
+    characters to extract from it, so as to get the most characters per
+    random byte once rejected windows are taken into account.
+
+    Returns a tuple of (window_bytes, chars_per_window, limit), where windows
+    whose value is limit or more must be rejected.
+    """
+    best = None
+    for window_bytes in xrange(1, max_window_bytes + 1):
+        window_size = 256 ** window_bytes
+        chars = 0
+        while alphabet_length ** (chars + 1) <= window_size:
+            chars += 1
+        limit = (window_size // alphabet_length ** chars) * alphabet_length ** chars
+        chars_per_byte = float(chars * limit) / window_size / window_bytes
+        if best is None or chars_per_byte > best[0]:
+            best = (chars_per_byte, window_bytes, chars, limit)
+    return best[1:]
+
+def _create_efficient_secure_chars_function(alphabet,
+                                            max_window_bytes=_MAX_RANDOM_WINDOW_BYTES):
+    """
+    Creates a function that returns a string of securely-random characters
+    from the given alphabet, of the length given as its single argument.
+
+    Rather than spending a whole random byte on each character, this treats
+    a window of several random bytes as one big integer.  Windows at or above
+    the greatest multiple of alphabet_length ** chars_per_window that fits are
+    rejected, as for single bytes, and the remaining values are uniformly
+    distributed, so their lowest chars_per_window base-alphabet_length digits
+    are independent and unbiased.  For the human-safe alphabet this gets
+    about 1.5 characters per random byte, rather than about 0.9.
+    """
+    alphabet_length = len(alphabet)
+    window_bytes, chars_per_window, limit = _choose_random_window(alphabet_length,
+                                                                  max_window_bytes)
+    window_hex_length = window_bytes * 2
+    acceptance = float(limit) / (256 ** window_bytes)
+
+    # Pull out as many characters as we can per divmod by looking them up in
+    # a table of all the strings of that length.
+    step_chars = 1
+    while alphabet_length ** (step_chars + 1) <= _MAX_CHAR_TABLE_SIZE:
+        step_chars += 1
+    step_chars = min(step_chars, chars_per_window)
+    step_base = alphabet_length ** step_chars
+    step_table = ["".join(chars) for chars in itertools.product(alphabet, repeat=step_chars)]
+    steps, leftover_chars = divmod(chars_per_window, step_chars)
+
+    def create_chars(required_length):
+        chunks = []
+        length = 0
+        while length < required_length:
+            remaining = required_length - length
+            windows = int(math.ceil(remaining / (chars_per_window * acceptance))) + 1
+            random_hex = binascii.hexlify(secure_random_pool.read(windows * window_bytes))
+            for start in xrange(0, len(random_hex), window_hex_length):
+                value = long(random_hex[start:start + window_hex_length], 16)
+                if value >= limit:
+                    continue
+                for _ in xrange(steps):
+                    value, digits = divmod(value, step_base)
+                    chunks.append(step_table[digits])
+                for _ in xrange(leftover_chars):
+                    value, digit = divmod(value, alphabet_length)
+                    chunks.append(alphabet[digit])
+                length += chars_per_window
+                if length >= required_length:
+                    break
+        return "".join(chunks)[:required_length]
+
+    return create_chars
+
+def _create_efficient_secure_ids_length_function(alphabet):
+    """
+    Creates an entropy-efficient batch ID generator function that uses the
+    given alphabet.  The returned function accepts the number of IDs to
+    generate and the length of each of them, and returns a list of IDs.
+    """
+    create_chars = _create_efficient_secure_chars_function(alphabet)
+
+    def create_ids(count, required_length):
+        if required_length == 0:
+            return [""] * count
+        total_length = count * required_length
+        chars = create_chars(total_length)
+        return [chars[i:i + required_length]
+                for i in xrange(0, total_length, required_length)]
+
+    return create_ids
+
+def _create_secure_id_bits_function(alphabet,
+                                    length_function_factory=_create_secure_id_length_function):
     """
     Creates an ID generator function that uses the given alphabet.  The
     returned function will accept a single argument, which is the strength
     (in bits) of the id to generate.
     """
     bits_per_char = math.log(len(alphabet), 2)
-    id_length_function = _create_secure_id_length_function(alphabet)
+    id_length_function = length_function_factory(alphabet)
 
     def create_id(strength_in_bits):
-        required_length = math.ceil(strength_in_bits / bits_per_char)
+        required_length = int(math.ceil(strength_in_bits / bits_per_char))
         return id_length_function(required_length)
 
     return create_id
 
+def _create_secure_ids_bits_function(alphabet,
+                                     length_function_factory=_create_secure_ids_length_function):
+    """
+    Creates a batch ID generator function that uses the given alphabet.  The
+    returned function accepts the number of IDs to generate and the strength
+    (in bits) of each of them, and returns a list of IDs.
+    """
+    bits_per_char = math.log(len(alphabet), 2)
+    ids_length_function = length_function_factory(alphabet)
+
+    def create_ids(count, strength_in_bits):
+        required_length = int(math.ceil(strength_in_bits / bits_per_char))
+        return ids_length_function(count, required_length)
+
+    return create_ids
+
 create_secure_human_readable_id = _create_secure_id_bits_function(_HUMAN_SAFE_ALPHABET)
 """Securely creates an ID using characters that are appropriate for human
 copying.
@@ -115,6 +302,177 @@ into the key.  The function tries to minimize the length of the key while
 still providing that much entropy.
 """
 
+create_secure_human_readable_ids = _create_secure_ids_bits_function(_HUMAN_SAFE_ALPHABET)
+"""Securely creates a list of IDs using characters that are appropriate for
+human copying.  This is much cheaper per ID than repeatedly calling
+create_secure_human_readable_id when many IDs are needed at once.
+
+count: the number of IDs to create.
+
+strength_in_bits: the number of bits of entropy that must be incorporated
+into each key.
+"""
+
+create_secure_mixed_case_human_readable_ids = _create_secure_ids_bits_function(_HUMAN_SAFE_MIXED_CASE_ALPHABET)
+"""Securely creates a list of IDs using characters that are appropriate for
+human copying.  This is much cheaper per ID than repeatedly calling
+create_secure_mixed_case_human_readable_id when many IDs are needed at once.
+
+count: the number of IDs to create.
+
+strength_in_bits: the number of bits of entropy that must be incorporated
+into each key.
+"""
+
+create_efficient_secure_human_readable_id = _create_secure_id_bits_function(
+    _HUMAN_SAFE_ALPHABET, _create_efficient_secure_chars_function)
+"""As create_secure_human_readable_id, but extracts characters from multi-byte
+random windows, so it uses far fewer random bytes per ID at the cost of some
+big-integer arithmetic.
+"""
+
+create_efficient_secure_human_readable_ids = _create_secure_ids_bits_function(
+    _HUMAN_SAFE_ALPHABET, _create_efficient_secure_ids_length_function)
+"""As create_secure_human_readable_ids, but extracts characters from
+multi-byte random windows, so it uses far fewer random bytes per ID.
+"""
+
+create_efficient_secure_mixed_case_human_readable_id = _create_secure_id_bits_function(
+    _HUMAN_SAFE_MIXED_CASE_ALPHABET, _create_efficient_secure_chars_function)
+"""As create_secure_mixed_case_human_readable_id, but extracts characters from
+multi-byte random windows, so it uses far fewer random bytes per ID.
+"""
+
+create_efficient_secure_mixed_case_human_readable_ids = _create_secure_ids_bits_function(
+    _HUMAN_SAFE_MIXED_CASE_ALPHABET, _create_efficient_secure_ids_length_function)
+"""As create_secure_mixed_case_human_readable_ids, but extracts characters
+from multi-byte random windows, so it uses far fewer random bytes per ID.
+"""
+
+create_secure_url_safe_id = _create_secure_id_bits_function(_URL_SAFE_ALPHABET)
+"""Securely creates an ID using characters that are safe to use in URLs
+without escaping, but that are not intended for humans to copy.
+
+strength_in_bits: the number of bits of entropy that must be incorporated
+into the key.
+"""
+
+create_secure_url_safe_ids = _create_secure_ids_bits_function(_URL_SAFE_ALPHABET)
+"""Securely creates a list of IDs using characters that are safe to use in
+URLs without escaping.
+
+count: the number of IDs to create.
+
+strength_in_bits: the number of bits of entropy that must be incorporated
+into each key.
+"""
+
+_create_secure_audible_id = _create_secure_id_length_function(_AUDIBLE_ALPHABET)
+
+def create_secure_audible_id(length=UUID_LEN_AUDIBLE):
+    """Securely creates a string of decimal digits, suitable for playing to
+    a caller."""
+    return _create_secure_audible_id(length)
+
+def generate_unique_secure_ids(strength_in_bits,
+                               id_filter=None,
+                               is_duplicate=None,
+                               create_ids=create_secure_human_readable_ids,
+                               batch_size=1000):
+    """
+    Generator yielding an endless stream of securely-created IDs that are not
+    already in use, e.g. for bulk provisioning.
+
+    strength_in_bits: the number of bits of entropy in each ID.
+
+    id_filter: optional set-like object (typically a bloom_filter.BloomFilter
+    pre-loaded with the IDs already in use) that supports `in` and add().
+    Every ID yielded is added to it.
+
+    is_duplicate: optional function that makes the authoritative check of
+    whether an ID is in use, e.g. with a database lookup.  If there is an
+    id_filter, this is only called for IDs that hit in the filter; otherwise
+    it is called for every ID.  If there is an id_filter but no is_duplicate,
+    IDs that hit in the filter are simply discarded, as there are plenty more.
+    Note that is_duplicate must also recognise IDs this generator has already
+    yielded, e.g. because the caller stores each ID before asking for the
+    next one.
+
+    create_ids: the batch ID generator to use.
+    """
+    while True:
+        for candidate in create_ids(batch_size, strength_in_bits):
+            if id_filter is not None:
+                if candidate in id_filter:
+                    if is_duplicate is None or is_duplicate(candidate):
+                        continue
+                id_filter.add(candidate)
+            elif is_duplicate is not None and is_duplicate(candidate):
+                continue
+            yield candidate
+
+def canonicalise_human_readable_id(typed_id):
+    """
+    Converts an ID generated by create_secure_human_readable_id, as typed by
+    a human, back to the form it was generated in.  Case, separators and the
+    common substitutions in _HUMAN_SUBSTITUTIONS are forgiven.
+
+    Returns None if the typed ID can't be a valid human-readable ID.
+    """
+    if isinstance(typed_id, unicode):
+        try:
+            typed_id = typed_id.encode("ascii")
+        except UnicodeEncodeError:
+            return None
+    canonical_id = typed_id.translate(_HUMAN_CANONICALISATION_TABLE, _HUMAN_SEPARATORS)
+    if not canonical_id or canonical_id.translate(None, _HUMAN_SAFE_ALPHABET):
+        return None
+    return canonical_id
+
+class HumanReadableIdIndex(object):
+    """
+    In-memory index from human-readable IDs to the keys of the records they
+    identify, that can be queried with IDs as typed by humans.
+
+    The IDs are canonicalised once as they are added, so each lookup only
+    needs to canonicalise the typed ID.
+    """
+    def __init__(self, items=()):
+        self._index = {}
+        self.update(items)
+
+    def add(self, human_id, key):
+        """Adds a human-readable ID to the index.  Raises ValueError if it is
+        not a valid human-readable ID."""
+        canonical_id = canonicalise_human_readable_id(human_id)
+        if canonical_id is None:
+            raise ValueError("Invalid human-readable ID: %r" % human_id)
+        self._index[canonical_id] = key
+
+    def update(self, items):
+        """Adds an iterable of (human_id, key) pairs to the index."""
+        for human_id, key in items:
+            self.add(human_id, key)
+
+    def lookup(self, typed_id, default=None):
+        """Returns the key for a typed ID, or default if there isn't one."""
+        canonical_id = canonicalise_human_readable_id(typed_id)
+        return self._index.get(canonical_id, default)
+
+    def resolve_many(self, typed_ids, default=None):
+        """Generator yielding a (typed_id, key) pair for each of an iterable of
+        typed IDs, with default as the key if there isn't one."""
+        index_get = self._index.get
+        canonicalise = canonicalise_human_readable_id
+        for typed_id in typed_ids:
+            yield typed_id, index_get(canonicalise(typed_id), default)
+
+    def __contains__(self, typed_id):
+        return canonicalise_human_readable_id(typed_id) in self._index
+
+    def __len__(self):
+        return len(self._index)
+
 URANDOM_BUFFER_SIZE = 128
 def generate_secure_random_bytes(buffer_size=URANDOM_BUFFER_SIZE):
     """
@@ -124,27 +482,205 @@ def generate_secure_random_bytes(buffer_size=URANDOM_BUFFER_SIZE):
     the iterator should not be used by multiple threads concurrently.
     """
     while True:
-        bytes = os.urandom(URANDOM_BUFFER_SIZE)
+        bytes = os.urandom(buffer_size)
         for x in bytes:
             yield ord(x)
 
+URANDOM_POOL_BUFFER_SIZE = 4096
+
+class SecureRandomPool(object):
+    """
+    Process-wide source of securely-random bytes.
+
+    Each thread reads from its own buffer, which is refilled from os.urandom
+    buffer_size bytes at a time, so callers that only want a few bytes at a
+    time (such as the ID generators) don't make a syscall per call.  The pool
+    may be shared freely between threads.
+
+    The buffers are tagged with the pid that filled them and are discarded if
+    the pid changes, so that a child process (e.g. after daemonize) never
+    hands out the same bytes as its parent.
+    """
+    def __init__(self, buffer_size=URANDOM_POOL_BUFFER_SIZE):
+        self.buffer_size = buffer_size
+        self._local = threading.local()
+
+    def read(self, length):
+        """Returns a string of length securely-random bytes."""
+        local = self._local
+        pid = os.getpid()
+        if getattr(local, "pid", None) != pid:
+            local.pid = pid
+            local.buffer = ""
+            local.offset = 0
+
+        offset = local.offset
+        end = offset + length
+        if end <= len(local.buffer):
+            local.offset = end
+            return local.buffer[offset:end]
+
+        # Not enough left in this thread's buffer.  Use up what remains and
+        # refill it.  Requests bigger than the buffer are served directly.
+        result = local.buffer[offset:]
+        length -= len(result)
+        if length >= self.buffer_size:
+            local.buffer = ""
+            local.offset = 0
+            return result + os.urandom(length)
+
+        local.buffer = os.urandom(self.buffer_size)
+        local.offset = length
+        return result + local.buffer[:length]
+
+secure_random_pool = SecureRandomPool()
+"""The SecureRandomPool shared by everything in the process.  Its buffer_size
+can be changed at runtime, which takes effect on each thread's next refill."""
+
+class SipUri(object):
+    """
+    The parts of a SIP(S) URI of the form
+    sip[s]:<number>[:<password>]@<domain>[;<params>].
+
+    Use SipUri.parse to parse a URI once, rather than calling the
+    sip_uri_to_* helpers for each part.  The URI parameters are only split
+    apart if the params attribute is used.
+    """
+    __slots__ = ("scheme", "number", "password", "domain", "raw_params", "_params")
+
+    def __init__(self, scheme, number, password, domain, raw_params=""):
+        self.scheme = scheme
+        self.number = number
+        self.password = password
+        self.domain = domain
+        self.raw_params = raw_params
+        self._params = None
+
+    @classmethod
+    def parse(cls, sip_uri):
+        """Parses a SIP(S) URI.  Returns None if it isn't one."""
+        match = _SIP_URI_PATTERN.match(sip_uri)
+        if match is None:
+            return None
+        return cls(*match.group("scheme", "number", "password", "domain", "params"))
+
+    @property
+    def user(self):
+        return self.number
+
+    @property
+    def params(self):
+        """Dictionary of URI parameters.  Parameters without a value map to
+        None."""
+        if self._params is None:
+            params = {}
+            for param in self.raw_params.split(";"):
+                if param:
+                    name, sep, value = param.partition("=")
+                    params[name] = value if sep else None
+            self._params = params
+        return self._params
+
+    def __eq__(self, other):
+        return (isinstance(other, SipUri) and
+                (self.scheme, self.number, self.password, self.domain, self.raw_params) ==
+                (other.scheme, other.number, other.password, other.domain, other.raw_params))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.scheme, self.number, self.password, self.domain, self.raw_params))
+
+    def __repr__(self):
+        return "SipUri(%r, %r, %r, %r, %r)" % (self.scheme,
+                                               self.number,
+                                               self.password,
+                                               self.domain,
+                                               self.raw_params)
+
 def sip_uri_to_phone_number(sip_uri):
-    match = re.match(_SIP_URI_REGEXP, sip_uri)
-    if match:
-        return match.group("number")
+    uri = SipUri.parse(sip_uri)
+    if uri:
+        return uri.number
     else: # pragma: no cover
         return "Unknown"
 
 def sip_uri_to_domain(sip_uri):
-    match = re.match(_SIP_URI_REGEXP, sip_uri)
-    if match:
-        return match.group("domain")
+    uri = SipUri.parse(sip_uri)
+    if uri:
+        return uri.domain
     else: # pragma: no cover
         return "Unknown"
 
+def iter_parse_sip_uris(sip_uris, cache_size=0):
+    """
+    Generator parsing an iterable of SIP(S) URIs, yielding a SipUri (or None
+    if it isn't a valid SIP URI) for each one in turn.
+
+    If cache_size is non-zero, the results for the most recently seen
+    cache_size distinct URIs are kept, so lists with many repeated URIs are
+    cheaper to parse.  Repeated URIs then yield the same SipUri object.
+    """
+    parse = SipUri.parse
+    if not cache_size:
+        for sip_uri in sip_uris:
+            yield parse(sip_uri)
+        return
+
+    cache = LRUCache(cache_size)
+    missing = object()
+    for sip_uri in sip_uris:
+        uri = cache.get(sip_uri, missing)
+        if uri is missing:
+            uri = parse(sip_uri)
+            cache.put(sip_uri, uri)
+        yield uri
+
+def iter_unique_sip_uris(sip_uris, cache_size=0):
+    """
+    Generator parsing an iterable of SIP(S) URIs, yielding a SipUri for the
+    first occurrence of each distinct valid URI and skipping the rest.
+
+    Memory use grows with the number of distinct URIs, but not with the
+    length of the input.
+    """
+    seen = set()
+    for uri in iter_parse_sip_uris(sip_uris, cache_size):
+        if uri is not None and uri not in seen:
+            seen.add(uri)
+            yield uri
+
+def group_sip_uris_by_domain(sip_uris, dedupe=False, cache_size=0):
+    """
+    Parses an iterable of SIP(S) URIs and returns a dictionary mapping each
+    domain to the list of numbers in that domain, in input order.  Invalid
+    URIs are skipped.  If dedupe is True, each distinct URI is only counted
+    once.
+    """
+    if dedupe:
+        uris = iter_unique_sip_uris(sip_uris, cache_size)
+    else:
+        uris = iter_parse_sip_uris(sip_uris, cache_size)
+
+    groups = {}
+    for uri in uris:
+        if uri is not None:
+            groups.setdefault(uri.domain, []).append(uri.number)
+    return groups
+
+def iter_sip_uris_to_phone_numbers(sip_uris):
+    """Generator yielding the number from each of an iterable of SIP(S) URIs,
+    or "Unknown" if it isn't a valid SIP URI."""
+    # Matching is cheap compared to building a SipUri, so go straight to the
+    # pattern rather than using iter_parse_sip_uris.
+    match = _SIP_URI_PATTERN.match
+    for sip_uri in sip_uris:
+        m = match(sip_uri)
+        yield m.group("number") if m else "Unknown"
+
 def sip_lists_to_phone_list(list_of_sip_numbers): # pragma: no cover
-    return [sip_uri_to_phone_number(x)
-        for x in list_of_sip_numbers]
+    return list(iter_sip_uris_to_phone_numbers(list_of_sip_numbers))
 
 
 def delete_if_exists(fn): # pragma: no cover
@@ -162,41 +698,144 @@ def md5(s): # pragma: no cover
 
 BASE64_ALT_CHARS = '-_'
 
+# Characters that urllib.quote leaves unescaped with its default safe='/',
+# and the escaped form of every character.
+_QUERY_SAFE_CHARS = string.ascii_letters + string.digits + "_.-/"
+_QUERY_ESCAPES = dict((chr(b), chr(b) if chr(b) in _QUERY_SAFE_CHARS else "%%%02X" % b)
+                      for b in xrange(256))
+
+# Recently quoted strings.  Query strings tend to repeat the same values (e.g.
+# redirect targets), so this saves escaping them every time.  Like the re
+# module's cache, it is simply emptied when it fills up.
+_QUOTE_CACHE = {}
+_QUOTE_CACHE_SIZE = 1000
+_QUOTE_CACHE_MAX_STRING_LENGTH = 256
+
+def _quote_query_component(s):
+    """Equivalent to urllib.quote for a byte string."""
+    quoted = _QUOTE_CACHE.get(s)
+    if quoted is None:
+        if not s.translate(None, _QUERY_SAFE_CHARS):
+            # Everything is safe, which is the common case.
+            quoted = s
+        else:
+            quoted = "".join(map(_QUERY_ESCAPES.__getitem__, s))
+        if len(s) <= _QUOTE_CACHE_MAX_STRING_LENGTH:
+            if len(_QUOTE_CACHE) >= _QUOTE_CACHE_SIZE:
+                _QUOTE_CACHE.clear()
+            _QUOTE_CACHE[s] = quoted
+    return quoted
+
+def _encode_query_component(v):
+    if isinstance(v, unicode):
+        v = v.encode("utf-8")
+    elif not isinstance(v, str):
+        v = str(v)
+    return _quote_query_component(v)
+
 def encode_query_string(params):
     """
     Encode a query string, suitable for decoding by JavaScript's
     decodeURIComponent.  I.e. '+' is encoded as %2B, ' ' as %20, etc.
 
+    params is either a dictionary, whose items are encoded in key order, or a
+    sequence of (key, value) pairs, which are encoded in the order given so
+    keys may be repeated.  A list or tuple value is encoded as one key=value
+    pair per element.
+
     Note: urllib's urlencode function quotes ' ' as '+', which doesn't get
     decoded correctly by decodeURIComponent.
     """
+    if isinstance(params, dict):
+        params = sorted(params.items())
+
     kvps = []
-    for k, v in sorted(params.items()):
-        k = k.encode("utf-8")
-        if isinstance(v, basestring):
-            v = v.encode("utf-8")
-        else: # pragma: no cover
-            v = str(v)
-        kvps .append("%s=%s" % (quote(k.encode("utf-8")), quote(v.encode("utf-8"))))
+    for k, v in params:
+        k = _encode_query_component(k)
+        if isinstance(v, (list, tuple)):
+            for element in v:
+                kvps.append(k + "=" + _encode_query_component(element))
+        else:
+            kvps.append(k + "=" + _encode_query_component(v))
     return "&".join(kvps)
 
+class BaseUrl(object):
+    """
+    A URL split apart ready for query parameters to be appended to it, so
+    code that builds many URLs from the same base only splits it once.
+    """
+    __slots__ = ("_prefix", "_suffix")
+
+    def __init__(self, url):
+        hash = None
+        if "#" in url:
+            url, _, hash = url.partition("#")
+        if url == "": url = "?"
+        sep = "" if url[-1] in ("?", "&") else ("&" if "?" in url else "?")
+        self._prefix = url + sep
+        self._suffix = "#" + hash if hash else ""
+
+    def with_params(self, params=(), **kwparams):
+        """Returns the URL with the given query parameters appended, accepting
+        params as for encode_query_string and/or keyword arguments."""
+        query = encode_query_string(params)
+        if kwparams:
+            kwquery = encode_query_string(kwparams)
+            query = query + "&" + kwquery if query else kwquery
+        return self._prefix + query + self._suffix
+
 def append_url_params(url, **params):
-    hash = None
-    if "#" in url:
-        url, _, hash = url.partition("#")
-    if url == "": url = "?"
-    sep = "" if url[-1] in ("?", "&") else ("&" if "?" in url else "?")
-    url = url + sep + encode_query_string(params)
-    if hash:
-        url = url + "#" + hash
-    return url
+    return BaseUrl(url).with_params(params)
 
 def generate_sip_password(): # pragma: no cover
     return create_secure_mixed_case_human_readable_id(48)
 
+def generate_sip_passwords(count):
+    """Generates count SIP passwords, e.g. for bulk provisioning."""
+    return create_secure_mixed_case_human_readable_ids(count, 48)
+
 def sip_public_id_to_private(public_id): # pragma: no cover
     """returns the default private ID for a given public ID (by stripping any sip: prefix)"""
-    return re.sub('^sip:', '', public_id)
+    return public_id[4:] if public_id.startswith("sip:") else public_id
+
+def iter_sip_public_ids_to_private(public_ids):
+    """Generator yielding the default private ID for each of an iterable of
+    public IDs."""
+    for public_id in public_ids:
+        yield public_id[4:] if public_id.startswith("sip:") else public_id
+
+# Batches with fewer items than this are processed in this process by
+# map_in_chunks, as starting a pool costs more than it saves.
+DEFAULT_PARALLEL_THRESHOLD = 50000
+
+def map_in_chunks(function,
+                  argument,
+                  items,
+                  processes=None,
+                  parallel_threshold=DEFAULT_PARALLEL_THRESHOLD):
+    """Processes a list of items in chunks, returning a list of the results in
+    the same order.  function is called with an (argument, chunk) tuple for
+    each chunk, and returns a list of the results for that chunk.
+
+    If there are more than parallel_threshold items, the chunks are shared
+    out over a pool of processes (by default, one per CPU), so function must
+    be defined at module level so that it can be pickled."""
+    items = list(items)
+    if len(items) <= parallel_threshold or processes == 1:
+        return function((argument, items))
+
+    processes = processes or multiprocessing.cpu_count()
+    chunk_size = max(1, len(items) // (processes * 4))
+    chunks = [(argument, items[i:i + chunk_size])
+              for i in xrange(0, len(items), chunk_size)]
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        result_chunks = pool.map(function, chunks)
+    finally:
+        pool.close()
+        pool.join()
+    return [result for chunk in result_chunks for result in chunk]
 
 def daemonize(filename): # pragma: no cover
     """
@@ -260,15 +899,18 @@ def install_sigterm_handler(plugins): # pragma: no cover
         should_quit = True
     signal.signal(signal.SIGTERM, sigterm_handler)
 
-def install_sigusr1_handler(process_name): # pragma: no cover
+def install_sigusr1_handler(process_name, flight_recorder=None): # pragma: no cover
     """
-    Install SIGUSR1 handler to dump stack.
+    Install SIGUSR1 handler to dump stack, along with the contents of
+    flight_recorder (a logging_config.FlightRecorderHandler) if given.
     """
     def sigusr1_handler(sig, stack):
         """
         Handle SIGUSR1 by dumping stack and terminating.
         """
         stack_dump = "Caught SIGUSR1\n" + "".join(traceback.format_stack(stack))
+        if flight_recorder:
+            stack_dump += "\nRecent log records:\n" + flight_recorder.dump()
         write_core_file(process_name, stack_dump)
     signal.signal(signal.SIGUSR1, sigusr1_handler)
 